@@ -1,20 +1,176 @@
 import os
 import re
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 import pytesseract
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple, Union
 import json
-from mistral_llm_service import MistralLLMService
+from mistral_llm_service import MistralLLMService, LLMUsageTracker
+from deadline import Deadline
+from ocr_engines import create_engine, lines_to_text, mean_confidence, merge_tile_lines
+from receipt_region import crop_receipt
+
+# Modes d'appel à Mistral : nettoyage puis classification, ou les deux en un seul appel
+LLM_PIPELINE_MODES = ("two_call", "single_call")
+
+# Préréglages du prétraitement OCR (variable OCR_PREPROCESS_PRESET), à comparer avec benchmark_ocr.py
+#   target_dpi : mise à l'échelle pour que la largeur de l'image, supposée être celle du ticket
+#                (RECEIPT_WIDTH_MM), corresponde à cette résolution
+#   scale      : facteur fixe (agrandissement 2x historique)
+#   denoise    : 'nlm' (fastNlMeansDenoising, coûteux) ou 'median' (flou médian 3x3)
+PREPROCESS_PRESETS = {
+    "fast": {"target_dpi": 250, "denoise": "median"},
+    "balanced": {"target_dpi": 300, "denoise": "nlm", "nlm_search_window": 11},
+    "quality": {"scale": 2.0, "denoise": "nlm", "nlm_search_window": 21},
+}
+DEFAULT_PREPROCESS_PRESET = "quality"
+
+# Modes de segmentation de page Tesseract essayés, par ordre de préférence
+#   fallback   : PSM suivant seulement si le texte est vide (comportement historique)
+#   early_stop : PSM suivant tant que la confiance moyenne des mots reste sous OCR_PSM_MIN_CONFIDENCE
+#   concurrent : tous les PSM en parallèle, la meilleure confiance moyenne l'emporte
+PSM_CANDIDATES = (4, 6, 3)
+PSM_STRATEGIES = ("fallback", "early_stop", "concurrent")
+RECEIPT_WIDTH_MM = 80
+
+# Tickets très longs (hauteur > OCR_TILE_MIN_RATIO x largeur) : découpage en bandes horizontales
+# prétraitées et reconnues en parallèle, de TILE_HEIGHT_RATIO x la largeur chacune, qui se
+# chevauchent de TILE_OVERLAP_RATIO x la largeur (quelques lignes de texte)
+TILE_HEIGHT_RATIO = 3.0
+TILE_OVERLAP_RATIO = 0.15
+
+# Exemple de sortie JSON attendue pour la classification
+CLASSIFICATION_EXAMPLE_OUTPUT = """
+{
+  "vendor": "Carrefour Market",
+  "date": "2023-10-25",
+  "total": 25.68,
+  "payment_method": "Card",
+  "category": "Grocery",
+  "store_address": "25 Avenue des Champs-Élysées, 75008 Paris",
+  "store_phone": "+33 1 42 25 12 35",
+  "store_email": "",
+  "store_website": "www.carrefour.fr",
+  "tax": 4.28,
+  "subtotal": 21.40,
+  "siret": "552 081 317 00595",
+  "tva_number": "FR95 552081317",
+  "capital": "5,596,520,000 €",
+  "naf_code": "4711F",
+  "cashier": "Jean Dupont",
+  "client_type": "Particulier",
+  "line_items": [
+    {
+      "description": "Coca-Cola 330ml",
+      "quantity": 2,
+      "price": 1.50
+    },
+    {
+      "description": "Evian Water 1L",
+      "quantity": 1,
+      "price": 2.10
+    },
+    {
+      "description": "Baguette",
+      "quantity": 2,
+      "price": 1.20
+    },
+    {
+      "description": "Camembert",
+      "quantity": 1,
+      "price": 4.50
+    },
+    {
+      "description": "Oranges 1kg",
+      "quantity": 1,
+      "price": 3.20
+    },
+    {
+      "description": "Chicken Breast",
+      "quantity": 0.5,
+      "price": 12.40
+    }
+  ]
+}
+"""
+
+# Champs extraits lors de la classification
+CLASSIFICATION_FIELDS = """- vendor: Store name (e.g. "Carrefour")
+- date: Format as YYYY-MM-DD 
+- total: Total amount as number
+- payment_method: How the customer paid (e.g. "Cash", "Card", "Credit Card", "Check")
+- category: Type of store/purchase (e.g. "Grocery", "Restaurant", "Retail", "Pharmacy")
+- store_address: Complete store address if available
+- store_phone: Phone number if available
+- store_email: Email if available
+- store_website: Website if available
+- tax: Tax amount if specified
+- subtotal: Subtotal before tax if specified
+- siret: French business identification number if present (e.g. "552 081 317 00595")
+- tva_number: TVA/VAT number if present (e.g. "FR95 552081317")
+- capital: Company capital amount if present
+- naf_code: French business activity code if present
+- cashier: Name of the cashier if present
+- client_type: Type of customer if specified (e.g. "Particulier", "Professionnel")
+- line_items: Array of items with description, quantity and price"""
+
+# Extraction sans LLM (mode dégradé) : total, date et lignes d'articles "[2 x] DESCRIPTION  1,50"
+TOTAL_AMOUNT_PATTERN = re.compile(r'total(?:\s*ttc)?[^\n\d]{0,20}(\d+[.,]\d{2})', re.IGNORECASE)
+DATE_PATTERNS = [
+    (re.compile(r'\b(\d{4})-(\d{2})-(\d{2})\b'), (1, 2, 3)),
+    (re.compile(r'\b(\d{2})[/.-](\d{2})[/.-](\d{4})\b'), (3, 2, 1)),
+    (re.compile(r'\b(\d{2})[/.-](\d{2})[/.-](\d{2})\b'), (3, 2, 1)),
+]
+LINE_ITEM_PATTERN = re.compile(r'^(?:(?P<quantity>\d+)\s*[xX*]\s+)?(?P<description>.*?[A-Za-zÀ-ÿ].*?)\s+'
+                               r'(?P<amount>-?\d+[.,]\d{2})\s*(?:€|EUR)?\s*[A-Z]?$')
+NON_ITEM_KEYWORDS = re.compile(r'total|tva|taxe|carte|cb\b|esp[eè]ces|rendu|monnaie|paiement|remise', re.IGNORECASE)
+
+
+def parse_line_items(lines: List[str]) -> List[Dict[str, Any]]:
+    """
+    Lignes d'articles reconnues dans les lignes d'un ticket (hors total, TVA, paiement...)
+    
+    :param lines: Lignes du texte OCR, sans l'en-tête
+    :return: Articles (description, quantité, prix unitaire)
+    """
+    line_items = []
+    for line in lines:
+        line = line.strip()
+        if not line or NON_ITEM_KEYWORDS.search(line):
+            continue
+        match = LINE_ITEM_PATTERN.match(line)
+        if match:
+            # Le montant de la ligne couvre toute la quantité : le prix est unitaire
+            quantity = int(match.group('quantity') or 1) or 1
+            amount = float(match.group('amount').replace(',', '.'))
+            line_items.append({
+                "description": match.group('description').strip(),
+                "quantity": quantity,
+                "price": round(amount / quantity, 2)
+            })
+    return line_items
+
 
 class SimplifiedReceiptProcessor:
-    def __init__(self, lang: str = 'fra', log_level: int = logging.INFO):
+    def __init__(self, lang: str = 'fra', log_level: int = logging.INFO, preset: Optional[str] = None,
+                 engine: Optional[str] = None, tile_workers: Optional[int] = None, llm: bool = True):
         """
         Initialise un processeur de tickets de caisse avancé
         
         :param lang: Langue pour l'OCR
         :param log_level: Niveau de logging
+        :param preset: Préréglage de prétraitement 'fast', 'balanced' ou 'quality'
+                       (variable OCR_PREPROCESS_PRESET, 'quality' par défaut)
+        :param engine: Moteur Tesseract 'auto', 'tesserocr' ou 'pytesseract' (variable OCR_ENGINE,
+                       voir ocr_engines.py)
+        :param tile_workers: Threads reconnaissant les bandes d'un ticket très long (variable
+                             OCR_TILE_WORKERS, nombre de cœurs par défaut)
+        :param llm: Créer le service Mistral (False pour un processus qui ne fait que
+                    le prétraitement et l'OCR, voir ocr_pool.py)
         """
         # Configuration du logging
         logging.basicConfig(
@@ -48,134 +204,191 @@ class SimplifiedReceiptProcessor:
         os.environ['TESSDATA_PREFIX'] = tessdata_path
         
         # Initialize Mistral LLM service
-        self.llm_service = MistralLLMService()
+        self.llm_service = MistralLLMService() if llm else None
+        
+        # Mode d'appel à Mistral (variable LLM_PIPELINE_MODE) et consommation par mode
+        self.llm_mode = os.getenv("LLM_PIPELINE_MODE", "two_call").lower()
+        if self.llm_mode not in LLM_PIPELINE_MODES:
+            self.logger.warning(f"Mode LLM inconnu '{self.llm_mode}', utilisation du mode two_call")
+            self.llm_mode = "two_call"
+        self.llm_usage = LLMUsageTracker()
+        
+        # Préréglage de prétraitement de l'image
+        self.preset = (preset or os.getenv("OCR_PREPROCESS_PRESET", DEFAULT_PREPROCESS_PRESET)).lower()
+        if self.preset not in PREPROCESS_PRESETS:
+            self.logger.warning(f"Préréglage de prétraitement inconnu '{self.preset}', utilisation de '{DEFAULT_PREPROCESS_PRESET}'")
+            self.preset = DEFAULT_PREPROCESS_PRESET
+        
+        # Détection et redressement du ticket dans la photo (variable OCR_RECEIPT_CROP)
+        self.crop_to_receipt = os.getenv("OCR_RECEIPT_CROP", "true").lower() == "true"
         
-        # Langue
+        # Choix du mode de segmentation de page Tesseract (variables OCR_PSM_STRATEGY, OCR_PSM_MIN_CONFIDENCE)
+        self.psm_strategy = os.getenv("OCR_PSM_STRATEGY", "fallback").lower()
+        if self.psm_strategy not in PSM_STRATEGIES:
+            self.logger.warning(f"Stratégie PSM inconnue '{self.psm_strategy}', utilisation de 'fallback'")
+            self.psm_strategy = "fallback"
+        self.psm_min_confidence = float(os.getenv("OCR_PSM_MIN_CONFIDENCE", "70"))
+        self._psm_executor = None
+        self._psm_executor_lock = threading.Lock()
+        
+        # Découpage des tickets très longs (variables OCR_TILE_MIN_RATIO, 0 pour désactiver, et OCR_TILE_WORKERS)
+        self.tile_min_ratio = float(os.getenv("OCR_TILE_MIN_RATIO", "5"))
+        self.tile_workers = tile_workers or int(os.getenv("OCR_TILE_WORKERS", "0")) or os.cpu_count() or 1
+        self._tile_executor = None
+        
+        # Langue et moteur de reconnaissance
         self.lang = lang
-        self.logger.info(f"Tesseract initialisé avec la langue '{lang}' et le dossier tessdata: {tessdata_path}")
-        self.logger.info("SimplifiedReceiptProcessor initialized with Mistral LLM service.")
+        self.engine = create_engine(engine, lang=lang, tessdata_path=tessdata_path)
+        self.logger.info(f"Tesseract ({self.engine.name}) initialisé avec la langue '{lang}' et le dossier tessdata: {tessdata_path}")
+        if self.llm_service is not None:
+            self.logger.info("SimplifiedReceiptProcessor initialized with Mistral LLM service.")
     
-    def preprocess_image(self, image_path: str) -> np.ndarray:
+    def _load_image(self, image: Union[str, bytes, np.ndarray]) -> np.ndarray:
         """
-        Prétraite l'image pour améliorer la reconnaissance OCR
+        Charge une image depuis un chemin, un contenu en mémoire ou un tableau déjà décodé
         
-        :param image_path: Chemin de l'image
-        :return: Image prétraitée
+        :param image: Chemin, octets du fichier (upload) ou image OpenCV
+        :return: Image BGR
         """
-        try:
-            # Charger l'image
-            image = cv2.imread(image_path)
-            
-            # Vérifier si l'image est chargée
-            if image is None:
-                raise ValueError(f"Impossible de charger l'image : {image_path}")
-            
-            # Redimensionner l'image pour améliorer la qualité (2x plus grande)
-            height, width = image.shape[:2]
-            image = cv2.resize(image, (width*2, height*2), interpolation=cv2.INTER_CUBIC)
-            
-            # Convertir en niveaux de gris
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            
-            # Amélioration du contraste
-            clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-            enhanced = clahe.apply(gray)
-            
-            # Réduction du bruit avec préservation des détails
-            denoised = cv2.fastNlMeansDenoising(enhanced, None, 10, 7, 21)
-            
-            # Binarisation adaptative avec paramètres ajustés
-            binary = cv2.adaptiveThreshold(
-                denoised, 255, 
-                cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                cv2.THRESH_BINARY_INV, 13, 8  # Ajusté pour améliorer la détection des textes fins
-            )
-            
-            # Dilatation légère pour connecter les caractères fragmentés
-            kernel = np.ones((1,1), np.uint8)
-            dilated = cv2.dilate(binary, kernel, iterations=1)
-            
-            # Érosion pour restaurer la forme originale des caractères
-            eroded = cv2.erode(dilated, kernel, iterations=1)
-            
-            # Inverser l'image pour obtenir le texte en noir sur fond blanc
-            inverted = cv2.bitwise_not(eroded)
-            
-            # Sauvegarder l'image prétraitée pour le débogage (facultatif)
+        if isinstance(image, np.ndarray):
+            return image
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            decoded = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if decoded is None:
+                raise ValueError("Impossible de décoder l'image reçue en mémoire")
+            return decoded
+        decoded = cv2.imread(image)
+        if decoded is None:
+            raise ValueError(f"Impossible de charger l'image : {image}")
+        return decoded
+    
+    def _scale_factor(self, image: np.ndarray, settings: Dict[str, Any]) -> float:
+        """
+        Facteur de mise à l'échelle d'un préréglage
+        
+        :param image: Image BGR
+        :param settings: Paramètres du préréglage
+        :return: Facteur (1.0 = taille inchangée)
+        """
+        if settings.get("scale"):
+            return settings["scale"]
+        # Le plus petit côté approche la largeur du ticket, photo en portrait ou en paysage
+        target_width = settings["target_dpi"] * RECEIPT_WIDTH_MM / 25.4
+        return target_width / min(image.shape[:2])
+    
+    def _load_receipt(self, image_path: Union[str, bytes, np.ndarray]) -> np.ndarray:
+        """
+        Charge l'image et la recadre sur le ticket (photo sur une table) avant les étapes
+        coûteuses ; photo entière si le ticket n'est pas trouvé
+        """
+        image = self._load_image(image_path)
+        if self.crop_to_receipt:
+            image, region = crop_receipt(image)
+            if region.get("cropped"):
+                self.logger.debug(f"Ticket détecté sur {region['area_ratio']:.0%} de la photo, image recadrée")
+        return image
+    
+    def _save_debug_image(self, image_path: Union[str, bytes, np.ndarray], preprocessed: np.ndarray):
+        """Sauvegarde l'image prétraitée pour le débogage (facultatif, fichiers sur disque uniquement)"""
+        if isinstance(image_path, str):
             debug_dir = 'preprocessed_images'
             os.makedirs(debug_dir, exist_ok=True)
             base_filename = os.path.basename(image_path)
             debug_path = os.path.join(debug_dir, f"{os.path.splitext(base_filename)[0]}_preprocessed.jpg")
-            cv2.imwrite(debug_path, inverted)
-            
+            cv2.imwrite(debug_path, preprocessed)
+    
+    def preprocess_image(self, image_path: Union[str, bytes, np.ndarray], preset: Optional[str] = None) -> np.ndarray:
+        """
+        Prétraite l'image pour améliorer la reconnaissance OCR
+        
+        :param image_path: Chemin de l'image, octets du fichier ou image OpenCV
+        :param preset: Préréglage 'fast', 'balanced' ou 'quality' (celui du processeur par défaut)
+        :return: Image prétraitée
+        """
+        try:
+            settings = PREPROCESS_PRESETS[preset or self.preset]
+            image = self._load_receipt(image_path)
+            inverted = self._enhance(image, settings, self._scale_factor(image, settings))
+            self._save_debug_image(image_path, inverted)
             return inverted
             
         except Exception as e:
             self.logger.error(f"Erreur de prétraitement de l'image : {e}")
             raise
     
-    def extract_text(self, image_path: str) -> str:
+    def _enhance(self, image: np.ndarray, settings: Dict[str, Any], factor: float) -> np.ndarray:
+        """
+        Mise à l'échelle, contraste, débruitage et binarisation d'une image (ou d'une bande)
+        
+        :param image: Image BGR du ticket
+        :param settings: Paramètres du préréglage
+        :param factor: Facteur de mise à l'échelle, calculé sur le ticket entier
+        :return: Image prétraitée, texte noir sur fond blanc
+        """
+        # Mise à l'échelle : réduction des photos haute résolution (rapide), agrandissement sinon
+        if abs(factor - 1.0) > 0.05:
+            height, width = image.shape[:2]
+            interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_CUBIC
+            image = cv2.resize(image, (int(width * factor), int(height * factor)), interpolation=interpolation)
+        
+        # Convertir en niveaux de gris
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        
+        # Amélioration du contraste
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
+        enhanced = clahe.apply(gray)
+        
+        # Réduction du bruit : non-local means (préserve les détails) ou médian (bien plus rapide)
+        if settings["denoise"] == "nlm":
+            denoised = cv2.fastNlMeansDenoising(enhanced, None, 10, 7, settings["nlm_search_window"])
+        else:
+            denoised = cv2.medianBlur(enhanced, 3)
+        
+        # Binarisation adaptative avec paramètres ajustés
+        binary = cv2.adaptiveThreshold(
+            denoised, 255, 
+            cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
+            cv2.THRESH_BINARY_INV, 13, 8  # Ajusté pour améliorer la détection des textes fins
+        )
+        
+        # Inverser l'image pour obtenir le texte en noir sur fond blanc
+        inverted = cv2.bitwise_not(binary)
+        
+        return inverted
+
+    def extract_text(self, image_path: Union[str, bytes, np.ndarray], preset: Optional[str] = None,
+                     meta: Optional[Dict[str, Any]] = None) -> str:
         """
         Extraction de texte avec Tesseract
         
-        :param image_path: Chemin de l'image
+        :param image_path: Chemin de l'image, octets du fichier ou image OpenCV
+        :param preset: Préréglage de prétraitement (celui du processeur par défaut)
+        :param meta: Dictionnaire à compléter avec le PSM retenu et sa confiance (optionnel)
         :return: Texte extrait
         """
         try:
-            # Prétraitement de l'image
-            preprocessed = self.preprocess_image(image_path)
-            
-            # S'assurer que la variable d'environnement est définie avant chaque appel
-            tessdata_path = r'C:\Program Files\Tesseract-OCR\tessdata'
-            os.environ['TESSDATA_PREFIX'] = tessdata_path
-            
-            # Configuration Tesseract détaillée pour les tickets de caisse
-            # PSM 4 : Mode colonne unique pour mieux gérer les tickets
-            custom_config = r'--oem 3 --psm 4 ' \
-                        r'-c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz,.€/:- ' \
-                        r'--dpi 300'
-            
-            # Extraction du texte
-            text = pytesseract.image_to_string(
-                preprocessed, 
-                lang=self.lang, 
-                config=custom_config
-            )
-            
-            # Si aucun texte n'est extrait, essayez avec PSM 6 (bloc uniforme)
-            if not text.strip():
-                self.logger.warning(f"Aucun texte extrait avec PSM 4, essai avec PSM 6...")
-                custom_config = r'--oem 3 --psm 6 ' \
-                            r'-c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz,.€/:- ' \
-                            r'--dpi 300'
-                text = pytesseract.image_to_string(
-                    preprocessed, 
-                    lang=self.lang, 
-                    config=custom_config
-                )
-            
-            # Si toujours pas de texte, essayez PSM 3 (segmentation auto)
-            if not text.strip():
-                self.logger.warning(f"Aucun texte extrait avec PSM 6, essai avec PSM 3...")
-                custom_config = r'--oem 3 --psm 3 ' \
-                            r'-c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz,.€/:- ' \
-                            r'--dpi 300'
-                text = pytesseract.image_to_string(
-                    preprocessed, 
-                    lang=self.lang, 
-                    config=custom_config
-                )
+            settings = PREPROCESS_PRESETS[preset or self.preset]
+            image = self._load_receipt(image_path)
+            bounds = self._tile_bounds(image)
+            if len(bounds) > 1:
+                # Ticket très long : bandes prétraitées et reconnues en parallèle
+                text = self._recognize_tiled(image, bounds, settings, meta)
+            else:
+                preprocessed = self._enhance(image, settings, self._scale_factor(image, settings))
+                self._save_debug_image(image_path, preprocessed)
+                text = self.recognize(preprocessed, meta=meta)
                 
             if not text:
-                self.logger.warning(f"Aucun texte extrait de l'image {image_path}")
+                self.logger.warning(f"Aucun texte extrait de l'image {image_path if isinstance(image_path, str) else '(mémoire)'}")
                 
-            # Sauvegarder le texte brut pour débogage
-            debug_dir = 'ocr_results'
-            os.makedirs(debug_dir, exist_ok=True)
-            base_filename = os.path.basename(image_path)
-            debug_path = os.path.join(debug_dir, f"{os.path.splitext(base_filename)[0]}_ocr.txt")
-            with open(debug_path, 'w', encoding='utf-8') as f:
-                f.write(text)
+            # Sauvegarder le texte brut pour débogage (fichiers sur disque uniquement)
+            if isinstance(image_path, str):
+                debug_dir = 'ocr_results'
+                os.makedirs(debug_dir, exist_ok=True)
+                base_filename = os.path.basename(image_path)
+                debug_path = os.path.join(debug_dir, f"{os.path.splitext(base_filename)[0]}_ocr.txt")
+                with open(debug_path, 'w', encoding='utf-8') as f:
+                    f.write(text)
                 
             return self._clean_extracted_text(text)
             
@@ -183,6 +396,146 @@ class SimplifiedReceiptProcessor:
             self.logger.error(f"Erreur Tesseract : {e}")
             return ""
     
+    def recognize(self, preprocessed: np.ndarray, meta: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Reconnaissance Tesseract d'une image déjà prétraitée selon la stratégie PSM du processeur
+        
+        :param preprocessed: Image renvoyée par preprocess_image
+        :param meta: Dictionnaire à compléter avec le PSM retenu, sa confiance et les lignes
+                     reconnues avec les boîtes des mots (optionnel)
+        :return: Texte brut, une ligne par ligne du ticket
+        """
+        lines, psm, confidence = self._recognize_lines(preprocessed)
+        if meta is not None:
+            meta.update({
+                "engine": self.engine.name,
+                "psm_strategy": self.psm_strategy,
+                "psm": psm,
+                "confidence": round(confidence, 1),
+                "lines": lines
+            })
+        return lines_to_text(lines)
+    
+    def _recognize_lines(self, preprocessed: np.ndarray) -> Tuple[List[Dict[str, Any]], int, float]:
+        """Lignes reconnues selon la stratégie PSM du processeur, PSM retenu et confiance moyenne"""
+        if self.psm_strategy == "fallback":
+            return self._recognize_fallback(preprocessed)
+        if self.psm_strategy == "concurrent":
+            return self._recognize_concurrent(preprocessed)
+        return self._recognize_early_stop(preprocessed)
+    
+    def _tile_bounds(self, image: np.ndarray) -> List[Tuple[int, int]]:
+        """
+        Bandes horizontales d'un ticket très long
+        
+        :param image: Image BGR du ticket
+        :return: Liste de (haut, bas) en pixels ; une seule bande pour un ticket ordinaire
+        """
+        height, width = image.shape[:2]
+        if not self.tile_min_ratio or height <= width * self.tile_min_ratio:
+            return [(0, height)]
+        band, overlap = int(width * TILE_HEIGHT_RATIO), int(width * TILE_OVERLAP_RATIO)
+        bounds, top = [], 0
+        while True:
+            bottom = min(height, top + band)
+            bounds.append((top, bottom))
+            if bottom >= height:
+                return bounds
+            top = bottom - overlap
+    
+    def _recognize_tiled(self, image: np.ndarray, bounds: List[Tuple[int, int]], settings: Dict[str, Any],
+                         meta: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Prétraitement et reconnaissance en parallèle des bandes d'un ticket très long
+        
+        :param image: Image BGR du ticket
+        :param bounds: Bandes renvoyées par _tile_bounds
+        :param settings: Paramètres du préréglage
+        :param meta: Dictionnaire à compléter comme pour recognize() (optionnel)
+        :return: Texte brut, les lignes lues deux fois dans les chevauchements n'étant gardées qu'une fois
+        """
+        # Même facteur pour toutes les bandes : celui du ticket entier
+        factor = self._scale_factor(image, settings)
+        with self._psm_executor_lock:
+            if self._tile_executor is None:
+                self._tile_executor = ThreadPoolExecutor(max_workers=self.tile_workers,
+                                                         thread_name_prefix="tesseract-tile")
+        
+        def run(band):
+            top, bottom = band
+            return self._recognize_lines(self._enhance(image[top:bottom], settings, factor))
+        
+        results = list(self._tile_executor.map(run, bounds))
+        
+        # Limite entre deux bandes au milieu de leur chevauchement, en pixels de l'image prétraitée
+        cuts = [0] + [(bounds[i][1] + bounds[i + 1][0]) / 2 * factor for i in range(len(bounds) - 1)] + [float("inf")]
+        lines = merge_tile_lines([
+            (int(top * factor), cuts[i], cuts[i + 1], result[0])
+            for i, ((top, _), result) in enumerate(zip(bounds, results))
+        ])
+        self.logger.info(f"Ticket long découpé en {len(bounds)} bandes, {len(lines)} lignes après fusion")
+        
+        if meta is not None:
+            psms = [result[1] for result in results]
+            meta.update({
+                "engine": self.engine.name,
+                "psm_strategy": self.psm_strategy,
+                "psm": max(set(psms), key=psms.count),
+                "confidence": round(mean_confidence(lines), 1),
+                "tiles": len(bounds),
+                "lines": lines
+            })
+        return lines_to_text(lines)
+    
+    def _recognize_fallback(self, preprocessed: np.ndarray) -> Tuple[List[Dict[str, Any]], int, float]:
+        """PSM 4, puis 6 et 3 seulement si aucun texte n'est lu"""
+        # PSM 4 : Mode colonne unique pour mieux gérer les tickets
+        lines = self.engine.recognize_layout(preprocessed, psm=4)
+        psm = 4
+        
+        # Si aucun texte n'est extrait, essayez avec PSM 6 (bloc uniforme)
+        if not lines:
+            self.logger.warning(f"Aucun texte extrait avec PSM 4, essai avec PSM 6...")
+            lines = self.engine.recognize_layout(preprocessed, psm=6)
+            psm = 6
+        
+        # Si toujours pas de texte, essayez PSM 3 (segmentation auto)
+        if not lines:
+            self.logger.warning(f"Aucun texte extrait avec PSM 6, essai avec PSM 3...")
+            lines = self.engine.recognize_layout(preprocessed, psm=3)
+            psm = 3
+        return lines, psm, mean_confidence(lines)
+    
+    def _recognize_early_stop(self, preprocessed: np.ndarray) -> Tuple[List[Dict[str, Any]], int, float]:
+        """PSM candidats dans l'ordre, arrêt dès que la confiance moyenne atteint le seuil"""
+        best = None
+        for psm in PSM_CANDIDATES:
+            lines = self.engine.recognize_layout(preprocessed, psm=psm)
+            confidence = mean_confidence(lines)
+            if best is None or confidence > best[2]:
+                best = (lines, psm, confidence)
+            if confidence >= self.psm_min_confidence:
+                break
+            self.logger.info(f"Confiance {confidence:.1f} avec PSM {psm}, sous le seuil {self.psm_min_confidence}")
+        return best
+    
+    def _recognize_concurrent(self, preprocessed: np.ndarray) -> Tuple[List[Dict[str, Any]], int, float]:
+        """PSM candidats en parallèle, le résultat de meilleure confiance moyenne est retenu"""
+        with self._psm_executor_lock:
+            if self._psm_executor is None:
+                # Threads persistants : chacun garde son API tesserocr d'un ticket à l'autre
+                self._psm_executor = ThreadPoolExecutor(max_workers=len(PSM_CANDIDATES),
+                                                        thread_name_prefix="tesseract-psm")
+        futures = [(psm, self._psm_executor.submit(self.engine.recognize_layout, preprocessed, psm))
+                   for psm in PSM_CANDIDATES]
+        best = None
+        for psm, future in futures:
+            lines = future.result()
+            confidence = mean_confidence(lines)
+            if best is None or confidence > best[2]:
+                best = (lines, psm, confidence)
+        return best
+    
     def _clean_extracted_text(self, text: str) -> str:
         """
         Basic cleaning of OCR-extracted text.
@@ -196,63 +549,241 @@ class SimplifiedReceiptProcessor:
         # Remove problematic characters
         cleaned = text.replace('\x0c', '')  # Page break character
         
-        # Remove multiple spaces
-        cleaned = re.sub(r'\s+', ' ', cleaned)
+        # Remove repeated spaces and tabs within each line, keeping the line structure
+        lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in cleaned.split('\n')]
         
         # Remove empty lines
-        cleaned = '\n'.join([line for line in cleaned.split('\n') if line.strip()])
+        cleaned = '\n'.join([line for line in lines if line])
         
         return cleaned
     
-    def process_receipt(self, image_path: str) -> Dict[str, Any]:
+    def process_receipt(self, image_path: str, cache=None) -> Dict[str, Any]:
         """
         Traitement complet d'un ticket de caisse
         
         :param image_path: Chemin de l'image
+        :param cache: Instance de ResultCache (optionnelle) pour réutiliser un résultat déjà calculé
         :return: Dictionnaire avec le texte extrait et les données structurées
         """
         try:
+            image_hash, cached = self._cached_result(image_path, cache)
+            if cached:
+                return cached
+            
             # Extraction du texte
             extracted_text = self.extract_text(image_path)
-            
-            if not extracted_text:
-                self.logger.error(f"Échec de l'extraction de texte pour {image_path}")
-                return {
-                    "success": False,
-                    "error": "Aucun texte extrait de l'image",
-                    "extracted_text": "",
-                    "validated_data": {"vendor": "Unknown", "date": "Unknown", "total": 0.0, "line_items": []}
-                }
-            
-            # Nettoyage avec Mistral
-            cleaned_text = self.clean_text_with_mistral(extracted_text)
-            
-            # Classification avec Mistral
-            classified_data = self.classify_data_with_mistral(cleaned_text)
-            
-            return {
-                "success": True,
-                "extracted_text": cleaned_text,
-                "validated_data": classified_data
-            }
+            return self._analyze_text(image_path, extracted_text, image_hash, cache)
             
         except Exception as e:
             self.logger.error(f"Erreur lors du traitement du ticket : {str(e)}")
-            return {
-                "success": False,
-                "error": str(e),
-                "extracted_text": "",
-                "validated_data": {"vendor": "Unknown", "date": "Unknown", "total": 0.0, "line_items": []}
-            }
+            return self._failure(str(e))
+    
+    def process_receipts(self, image_paths: List[str], cache=None, pool=None) -> List[Dict[str, Any]]:
+        """
+        Traitement d'un lot de tickets : l'OCR des images absentes du cache est réparti
+        sur les processus du pool, puis les textes sont analysés par Mistral, en parallèle
+        avec le client asynchrone si aiohttp est installé
+        
+        :param image_paths: Chemins des images
+        :param cache: Instance de ResultCache (optionnelle)
+        :param pool: Instance de OCRProcessPool (optionnelle, OCR séquentiel sinon)
+        :return: Résultats dans l'ordre des images (même format que process_receipt)
+        """
+        # Analyses Mistral concurrentes avec le client asynchrone (aiohttp) dès qu'il y a plusieurs tickets
+        batch_llm = self.llm_service.async_available and len(image_paths) > 1
+        if pool is None and not batch_llm:
+            return [self.process_receipt(image_path, cache=cache) for image_path in image_paths]
+        
+        results = [None] * len(image_paths)
+        pending = []
+        for index, image_path in enumerate(image_paths):
+            try:
+                image_hash, cached = self._cached_result(image_path, cache)
+            except Exception as e:
+                self.logger.error(f"Erreur lors du traitement du ticket : {str(e)}")
+                results[index] = self._failure(str(e))
+                continue
+            if cached:
+                results[index] = cached
+            else:
+                pending.append((index, image_path, image_hash))
+        
+        if pool is not None:
+            texts = pool.extract_batch([image_path for _, image_path, _ in pending])
+        else:
+            texts = [self.extract_text(image_path) for _, image_path, _ in pending]
+        
+        analyses = [None] * len(pending)
+        extracted = [position for position, text in enumerate(texts) if text]
+        if batch_llm and len(extracted) > 1:
+            for position, analysis in zip(extracted, self.analyze_texts([texts[p] for p in extracted])):
+                analyses[position] = analysis
+        
+        for (index, image_path, image_hash), extracted_text, analysis in zip(pending, texts, analyses):
+            try:
+                results[index] = self._analyze_text(image_path, extracted_text, image_hash, cache, analysis)
+            except Exception as e:
+                self.logger.error(f"Erreur lors du traitement du ticket : {str(e)}")
+                results[index] = self._failure(str(e))
+        return results
+    
+    def _cached_result(self, image_path: str, cache=None) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """
+        Recherche du résultat d'une image déjà traitée
+        
+        :return: Tuple (empreinte de l'image ou None sans cache, résultat en cache ou None)
+        """
+        if cache is None:
+            return None, None
+        image_hash = cache.hash_file(image_path)
+        cached = cache.get_result(image_hash)
+        if not cached:
+            return image_hash, None
+        self.logger.info(f"Résultat trouvé dans le cache pour {image_path}")
+        return image_hash, {
+            "success": True,
+            "extracted_text": cached.get("cleaned_text", ""),
+            "validated_data": cached.get("structured_data", {}),
+            "cached": True
+        }
+    
+    def _failure(self, error: str) -> Dict[str, Any]:
+        """Résultat d'un ticket en échec"""
+        return {
+            "success": False,
+            "error": error,
+            "extracted_text": "",
+            "validated_data": {"vendor": "Unknown", "date": "Unknown", "total": 0.0, "line_items": []}
+        }
     
-    def clean_text_with_mistral(self, raw_text: str) -> str:
+    def _analyze_text(self, image_path: str, extracted_text: str, image_hash: Optional[str] = None,
+                      cache=None, analysis: Optional[Tuple[str, Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Nettoyage et classification Mistral du texte OCR d'un ticket
+        
+        :param image_path: Chemin de l'image (pour les logs)
+        :param extracted_text: Texte extrait par Tesseract
+        :param image_hash: Empreinte de l'image pour mettre le résultat en cache (optionnelle)
+        :param cache: Instance de ResultCache (optionnelle)
+        :param analysis: Résultat déjà obtenu par analyze_texts() (optionnel, appels Mistral sinon)
+        :return: Dictionnaire avec le texte extrait et les données structurées
+        """
+        if not extracted_text:
+            self.logger.error(f"Échec de l'extraction de texte pour {image_path}")
+            return self._failure("Aucun texte extrait de l'image")
+        
+        if analysis is None:
+            usage = {}
+            if self.llm_mode == "single_call":
+                # Nettoyage et classification en un seul appel Mistral
+                cleaned_text, classified_data = self.clean_and_classify_with_mistral(extracted_text, usage=usage)
+            else:
+                # Nettoyage avec Mistral
+                cleaned_text = self.clean_text_with_mistral(extracted_text, usage=usage)
+                
+                # Classification avec Mistral
+                classified_data = self.classify_data_with_mistral(cleaned_text, usage=usage)
+            self.llm_usage.record(self.llm_mode, usage, usage.get("calls", 0))
+        else:
+            cleaned_text, classified_data = analysis
+        
+        # Mêmes conditions que ReceiptPipeline.analyze : texte OCR lisible, appel Mistral abouti
+        # et classification non vide
+        cacheable = not extracted_text.startswith("Error:") and "error" not in classified_data
+        if str(classified_data.get("vendor", "")).startswith("Unknown") and not classified_data.get("total"):
+            cacheable = False
+        if image_hash and cacheable:
+            cache.put_result(image_hash, extracted_text, cleaned_text, classified_data, "tesseract")
+        
+        return {
+            "success": True,
+            "extracted_text": cleaned_text,
+            "validated_data": classified_data
+        }
+    
+    def analyze_texts(self, texts: List[str]) -> List[Optional[Tuple[str, Dict[str, Any]]]]:
+        """
+        Nettoyage et classification Mistral concurrents de textes OCR déjà extraits
+        
+        Les appels passent par le client asynchrone du service (MISTRAL_ASYNC_CONCURRENCY
+        requêtes en vol, MISTRAL_TOKENS_PER_MINUTE jetons par minute au plus) ; chaque
+        ticket garde l'enchaînement nettoyage puis classification du mode LLM. À appeler
+        hors d'une boucle asyncio.
+        
+        :param texts: Textes OCR non vides
+        :return: (texte nettoyé, données structurées) par texte, dans l'ordre, ou None pour
+                 un texte dont l'analyse a échoué
+        """
+        async def analyze_all():
+            return await asyncio.gather(*(self._aanalyze(text) for text in texts))
+        return self.llm_service.run_async(analyze_all())
+    
+    async def _aanalyze(self, text: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Version asynchrone de l'analyse Mistral de _analyze_text()"""
+        usage = {}
+        try:
+            short = len(text.strip()) < 10
+            if self.llm_mode == "single_call" and not short:
+                response = await self._agenerate(self._combined_prompt(text), 4000, 0.0, usage)
+                cleaned_text, classified_data = self._combined_result(text, response)
+            else:
+                cleaned_text = text if short else self._cleaned_text(
+                    text, await self._agenerate(self._clean_prompt(text), 3000, 0.1, usage))
+                if not cleaned_text.strip():
+                    classified_data = {"vendor": "Unknown", "date": "Unknown", "total": 0.0, "line_items": []}
+                else:
+                    classified_data = self._classified_data(
+                        await self._agenerate(self._classification_prompt(cleaned_text), 3000, 0.0, usage))
+        except Exception as e:
+            self.logger.error(f"Erreur lors de l'analyse Mistral asynchrone : {str(e)}")
+            return None
+        finally:
+            self.llm_usage.record(self.llm_mode, usage, usage.get("calls", 0))
+        return cleaned_text, classified_data
+    
+    def _generate(self, prompt: str, max_tokens: int, temperature: float, usage: Optional[Dict[str, Any]],
+                  deadline: Optional[Deadline] = None, model: Optional[str] = None) -> Optional[str]:
+        """
+        Appel Mistral en cumulant les jetons et la latence dans usage
+        
+        :param usage: Dictionnaire de consommation à compléter (optionnel)
+        :param deadline: Budget de temps limitant la durée de l'appel et ses tentatives (optionnel)
+        :param model: Modèle Mistral à utiliser à la place du modèle par défaut (optionnel)
+        :return: Texte généré
+        """
+        result = self.llm_service.generate_with_usage(prompt, max_tokens=max_tokens, temperature=temperature,
+                                                      deadline=deadline, model=model)
+        self._add_usage(usage, result)
+        return result["content"]
+    
+    async def _agenerate(self, prompt: str, max_tokens: int, temperature: float,
+                         usage: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Version asynchrone de _generate()"""
+        result = await self.llm_service.agenerate_with_usage(prompt, max_tokens=max_tokens, temperature=temperature)
+        self._add_usage(usage, result)
+        return result["content"]
+    
+    def _add_usage(self, usage: Optional[Dict[str, Any]], result: Dict[str, Any]):
+        # Une réponse du cache des prompts n'est pas un appel Mistral
+        if usage is not None and not result.get("cached"):
+            usage["calls"] = usage.get("calls", 0) + 1
+            for key in ("prompt_tokens", "completion_tokens", "latency_ms"):
+                usage[key] = usage.get(key, 0) + result[key]
+    
+    def clean_text_with_mistral(self, raw_text: str, usage: Optional[Dict[str, Any]] = None,
+                                deadline: Optional[Deadline] = None) -> str:
         """Clean OCR text using Mistral and calculate missing values"""
         # Skip processing if the text is very short
         if not raw_text or len(raw_text.strip()) < 10:
             self.logger.warning("Text too short to clean, returning original")
             return raw_text
             
-        clean_prompt = f"""You are an expert receipt OCR cleaner and calculator. Carefully clean this OCR text from a receipt:
+        cleaned = self._generate(self._clean_prompt(raw_text), max_tokens=3000, temperature=0.1, usage=usage,
+                                 deadline=deadline)
+        return self._cleaned_text(raw_text, cleaned)
+    
+    def _clean_prompt(self, raw_text: str) -> str:
+        return f"""You are an expert receipt OCR cleaner and calculator. Carefully clean this OCR text from a receipt:
 
 ```
 {raw_text}
@@ -276,13 +807,9 @@ DO NOT invent any information.
 
 Return ONLY the cleaned and numerically corrected text.
 """
-        
-        cleaned = self.llm_service.generate(
-            prompt=clean_prompt,
-            max_tokens=3000,
-            temperature=0.1
-        )
-        
+    
+    def _cleaned_text(self, raw_text: str, cleaned: Optional[str]) -> str:
+        """Texte nettoyé renvoyé par Mistral, ou texte d'origine si la réponse est vide"""
         # If we got back empty result or only whitespace
         if not cleaned or cleaned.isspace():
             self.logger.warning("Mistral returned empty cleaning result, using original text")
@@ -290,103 +817,22 @@ Return ONLY the cleaned and numerically corrected text.
             
         return cleaned
     
-    def classify_data_with_mistral(self, cleaned_text: str) -> Dict[str, Any]:
-        """Extract structured data from receipt text"""
+    def classify_data_with_mistral(self, cleaned_text: str, usage: Optional[Dict[str, Any]] = None,
+                                   deadline: Optional[Deadline] = None, model: Optional[str] = None) -> Dict[str, Any]:
+        """Extract structured data from receipt text (optionally with a lighter Mistral model)"""
         # Handle empty cleaned_text case
         if not cleaned_text or cleaned_text.strip() == "":
             self.logger.warning("Empty cleaned text received, using original text")
             return {"vendor": "Unknown", "date": "Unknown", "total": 0.0, "line_items": []}
             
-        # Example receipt
-        example_text = """
-Carrefour Market
-25 Avenue des Champs-Élysées
-75008 Paris
-Tel: +33 1 42 25 12 35
-www.carrefour.fr
-SIRET: 552 081 317 00595
-TVA Intracom: FR95 552081317
-Capital: 5,596,520,000 €
-NAF: 4711F
-
-25/10/2023 14:30
-Receipt #2568791
-Caissier: Jean Dupont
-Client: Particulier
-
-Coca-Cola 330ml      2x1.50     3.00
-Evian Water 1L       1x2.10     2.10
-Baguette             2x1.20     2.40
-Camembert            1x4.50     4.50
-Oranges 1kg          1x3.20     3.20
-Chicken Breast       0.5x12.40  6.20
-                     ---------
-SUBTOTAL:            21.40
-TVA (20%):            4.28
-TOTAL TTC:           25.68
-
-CARD PAYMENT: VISA **** 4217
-AUTHORIZED
-
-Thank you for shopping at Carrefour!
-        """
-        
-        example_output = """
-{
-  "vendor": "Carrefour Market",
-  "date": "2023-10-25",
-  "total": 25.68,
-  "payment_method": "Card",
-  "category": "Grocery",
-  "store_address": "25 Avenue des Champs-Élysées, 75008 Paris",
-  "store_phone": "+33 1 42 25 12 35",
-  "store_email": "",
-  "store_website": "www.carrefour.fr",
-  "tax": 4.28,
-  "subtotal": 21.40,
-  "siret": "552 081 317 00595",
-  "tva_number": "FR95 552081317",
-  "capital": "5,596,520,000 €",
-  "naf_code": "4711F",
-  "cashier": "Jean Dupont",
-  "client_type": "Particulier",
-  "line_items": [
-    {
-      "description": "Coca-Cola 330ml",
-      "quantity": 2,
-      "price": 1.50
-    },
-    {
-      "description": "Evian Water 1L",
-      "quantity": 1,
-      "price": 2.10
-    },
-    {
-      "description": "Baguette",
-      "quantity": 2,
-      "price": 1.20
-    },
-    {
-      "description": "Camembert",
-      "quantity": 1,
-      "price": 4.50
-    },
-    {
-      "description": "Oranges 1kg",
-      "quantity": 1,
-      "price": 3.20
-    },
-    {
-      "description": "Chicken Breast",
-      "quantity": 0.5,
-      "price": 12.40
-    }
-  ]
-}
-        """
-        
+        self.logger.info(f"Sending classification prompt to Mistral")
+        response = self._generate(self._classification_prompt(cleaned_text), max_tokens=3000, temperature=0.0,
+                                  usage=usage, deadline=deadline, model=model)
+        return self._classified_data(response)
+    
+    def _classification_prompt(self, cleaned_text: str) -> str:
         # Enhanced prompt with explicit test example
-        classification_prompt = f"""You are an expert receipt parser. Extract structured data from this receipt:
+        return f"""You are an expert receipt parser. Extract structured data from this receipt:
 
 RECEIPT TEXT:
 ```
@@ -402,36 +848,17 @@ If there's a discrepancy:
 
 EXAMPLE CORRECT OUTPUT:
 ```
-{example_output}
+{CLASSIFICATION_EXAMPLE_OUTPUT}
 ```
 
 Extract EXACTLY these fields in valid JSON format:
-- vendor: Store name (e.g. "Carrefour")
-- date: Format as YYYY-MM-DD 
-- total: Total amount as number
-- payment_method: How the customer paid (e.g. "Cash", "Card", "Credit Card", "Check")
-- category: Type of store/purchase (e.g. "Grocery", "Restaurant", "Retail", "Pharmacy")
-- store_address: Complete store address if available
-- store_phone: Phone number if available
-- store_email: Email if available
-- store_website: Website if available
-- tax: Tax amount if specified
-- subtotal: Subtotal before tax if specified
-- siret: French business identification number if present (e.g. "552 081 317 00595")
-- tva_number: TVA/VAT number if present (e.g. "FR95 552081317")
-- capital: Company capital amount if present
-- naf_code: French business activity code if present
-- cashier: Name of the cashier if present
-- client_type: Type of customer if specified (e.g. "Particulier", "Professionnel")
-- line_items: Array of items with description, quantity and price
-
+{CLASSIFICATION_FIELDS}
 Extract ONLY what's in the receipt. If you can't determine a value, use "Unknown" for text fields, 0 for numbers.
 Return ONLY the JSON data with no additional text or explanation.
 """
-        
-        self.logger.info(f"Sending classification prompt to Mistral")
-        response = self.llm_service.generate(classification_prompt, temperature=0.0)
-        
+    
+    def _classified_data(self, response: Optional[str]) -> Dict[str, Any]:
+        """Données structurées d'une réponse de classification Mistral"""
         if not response or response.isspace():
             self.logger.error("Empty response from Mistral API")
             return {"vendor": "Unknown", "date": "Unknown", "total": 0.0, "line_items": []}
@@ -440,6 +867,113 @@ Return ONLY the JSON data with no additional text or explanation.
         self.logger.info(f"Classified result: {json.dumps(result, indent=2)}")
         return result
 
+    def clean_and_classify_with_mistral(self, raw_text: str, usage: Optional[Dict[str, Any]] = None,
+                                        deadline: Optional[Deadline] = None) -> Tuple[str, Dict[str, Any]]:
+        """
+        Nettoie le texte OCR et en extrait les données structurées en un seul appel Mistral
+        
+        Le texte nettoyé n'est ainsi généré qu'une fois, sans être renvoyé en entrée
+        d'un second appel de classification.
+        
+        :param raw_text: Texte OCR brut
+        :param usage: Dictionnaire de consommation à compléter (optionnel)
+        :param deadline: Budget de temps de l'appel (optionnel)
+        :return: Tuple (texte nettoyé, données structurées)
+        """
+        if not raw_text or len(raw_text.strip()) < 10:
+            self.logger.warning("Text too short to clean, classifying original text")
+            return raw_text, self.classify_data_with_mistral(raw_text, usage=usage, deadline=deadline)
+        
+        self.logger.info("Sending combined cleaning/classification prompt to Mistral")
+        response = self._generate(self._combined_prompt(raw_text), max_tokens=4000, temperature=0.0, usage=usage,
+                                  deadline=deadline)
+        return self._combined_result(raw_text, response)
+    
+    def _combined_prompt(self, raw_text: str) -> str:
+        return f"""You are an expert receipt OCR cleaner and parser. Here is the OCR text of a receipt:
+
+```
+{raw_text}
+```
+
+STEP 1 - Clean the text by:
+1. Fixing character recognition errors (e.g., '0rangina' → 'Orangina')
+2. Removing irrelevant text not from the receipt
+3. Preserving numerical values, prices, dates, and product names exactly
+4. Maintaining original language and layout structure
+Only add calculated values (item totals, tax, subtotal, total) if they're missing and you have enough information to calculate them accurately.
+DO NOT invent any information.
+
+STEP 2 - Extract structured data from the cleaned text.
+Verify that the sum of all line items equals the total amount on the receipt and fix quantities or prices only if you can confidently determine the correct values.
+
+Extract EXACTLY these fields:
+{CLASSIFICATION_FIELDS}
+
+If you can't determine a value, use "Unknown" for text fields, 0 for numbers.
+
+EXAMPLE JSON:
+```
+{CLASSIFICATION_EXAMPLE_OUTPUT}
+```
+
+Answer with exactly these two sections and nothing else:
+<cleaned_text>
+the cleaned and numerically corrected receipt text
+</cleaned_text>
+<data>
+the JSON data
+</data>
+"""
+    
+    def _combined_result(self, raw_text: str, response: Optional[str]) -> Tuple[str, Dict[str, Any]]:
+        """Texte nettoyé et données structurées d'une réponse combinée Mistral"""
+        if not response or response.isspace():
+            self.logger.error("Empty response from Mistral API")
+            return raw_text, {"vendor": "Unknown", "date": "Unknown", "total": 0.0, "line_items": []}
+        
+        cleaned_match = re.search(r'<cleaned_text>\s*([\s\S]*?)\s*</cleaned_text>', response)
+        data_match = re.search(r'<data>\s*([\s\S]*?)\s*</data>', response)
+        cleaned_text = cleaned_match.group(1) if cleaned_match and cleaned_match.group(1).strip() else raw_text
+        result = self._parse_mistral_response(data_match.group(1) if data_match else response)
+        self.logger.info(f"Classified result: {json.dumps(result, indent=2)}")
+        return cleaned_text, result
+    
+    def parse_receipt_text(self, text: str) -> Dict[str, Any]:
+        """
+        Extraction déterministe des champs principaux, sans appel Mistral
+        
+        Utilisée en mode dégradé quand les files OCR/LLM sont saturées : enseigne
+        (première ligne lisible), date, total et lignes d'articles avec un prix.
+        
+        :param text: Texte OCR brut
+        :return: Données structurées au même format que la classification Mistral
+        """
+        lines = [line.strip() for line in (text or "").splitlines() if line.strip()]
+        vendor = next((line for line in lines[:5] if re.search(r'[A-Za-zÀ-ÿ]{3}', line)), "Unknown")
+        
+        date = "Unknown"
+        for pattern, (year, month, day) in DATE_PATTERNS:
+            match = pattern.search(text or "")
+            if match:
+                year_value = match.group(year)
+                if len(year_value) == 2:
+                    year_value = f"20{year_value}"
+                date = f"{year_value}-{match.group(month)}-{match.group(day)}"
+                break
+        
+        totals = TOTAL_AMOUNT_PATTERN.findall(text or "")
+        total = float(totals[-1].replace(',', '.')) if totals else 0.0
+        
+        return {
+            "vendor": vendor,
+            "date": date,
+            "total": total,
+            "line_items": parse_line_items(lines[1:]),
+            "category": "Uncategorized",
+            "payment_method": "Unknown"
+        }
+    
     def _parse_mistral_response(self, response: str) -> Dict[str, Any]:
         """Handle Mistral's JSON response format with improved error handling"""
         try:
@@ -454,6 +988,11 @@ Return ONLY the JSON data with no additional text or explanation.
             # Validate structure
             if not isinstance(data, dict):
                 raise ValueError("Response is not a dictionary")
+            
+            # Error payload of MistralLLMService (API key, status code, timeout...)
+            if data.get("status") == "error" and "error" in data:
+                self.logger.error(f"Mistral request failed: {data['error']}")
+                return {"vendor": "Unknown", "date": "Unknown", "total": 0.0, "line_items": [], "error": data["error"]}
                 
             # Ensure required fields exist
             default_data = {
@@ -494,8 +1033,11 @@ def main():
     """
     Point d'entrée pour le test du processeur
     """
-    # Initialiser le processeur
+    # Initialiser le processeur et le cache des résultats
+    from result_cache import ResultCache
+    from ocr_pool import OCRProcessPool
     processor = SimplifiedReceiptProcessor()
+    cache = ResultCache()
     
     # Répertoire des tickets de test
     input_directory = 'input_tickets'
@@ -512,24 +1054,39 @@ def main():
     if not image_files:
         print("Aucun ticket trouvé. Veuillez ajouter des images dans le dossier input_tickets.")
     
-    for filename in image_files:
-        try:
-            # Chemin complet de l'image
-            image_path = os.path.join(input_directory, filename)
-            
-            # Traitement du ticket
-            print(f"\n--- Traitement du ticket : {filename} ---")
-            result = processor.process_receipt(image_path)
-            
-            # Affichage des résultats
-            print("\nTexte extrait :")
-            print(result['extracted_text'])
-            
-            print("\nMontants extraits :")
-            print(json.dumps(result['validated_data'], indent=2, ensure_ascii=False))
+    # OCR réparti sur un processus Tesseract par cœur (OCR_PROCESS_POOL pour changer le nombre, 0 pour désactiver)
+    pool_setting = os.getenv("OCR_PROCESS_POOL", "auto").strip().lower()
+    pool = None
+    if len(image_files) > 1 and pool_setting not in ("0", "false"):
+        pool = OCRProcessPool(processes=None if pool_setting == "auto" else int(pool_setting))
+    
+    try:
+        image_paths = [os.path.join(input_directory, filename) for filename in image_files]
+        results = processor.process_receipts(image_paths, cache=cache, pool=pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    
+    for filename, result in zip(image_files, results):
+        # Affichage des résultats
+        print(f"\n--- Traitement du ticket : {filename} ---")
+        if not result['success']:
+            print(f"Erreur lors du traitement de {filename} : {result.get('error')}")
+            continue
         
-        except Exception as e:
-            print(f"Erreur lors du traitement de {filename} : {e}")
+        print("\nTexte extrait :")
+        print(result['extracted_text'])
+        
+        print("\nMontants extraits :")
+        print(json.dumps(result['validated_data'], indent=2, ensure_ascii=False))
+        if result.get('cached'):
+            print("(résultat issu du cache)")
+    
+    stats = cache.stats()
+    print(f"\nCache : {stats['hits']} succès, {stats['misses']} échecs (taux {stats['hit_ratio']:.0%})")
+    for mode, usage in processor.llm_usage.snapshot().items():
+        print(f"Mistral ({mode}) : {usage['receipts']} ticket(s), {usage['avg_prompt_tokens']} jetons en entrée, "
+              f"{usage['avg_completion_tokens']} en sortie, {usage['avg_latency_ms']} ms par ticket")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory, session, flash
+from flask import Flask, render_template, request, jsonify, redirect, url_for, send_from_directory, session, flash, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import os
 import socket
@@ -9,12 +9,23 @@ from pathlib import Path
 import pandas as pd
 from receipt_utils import ReceiptProcessor
 from advanced_receipt_ocr import SimplifiedReceiptProcessor
+from mistral_llm_service import MistralLLMService
 from dotenv import load_dotenv
 from db_integrator import DatabaseIntegrator
 from gcp_storage import GCPStorageManager
 from firestore_db import FirestoreManager
+from receipt_pipeline import ReceiptPipeline
+from job_queue import JobQueue
+from result_cache import ResultCache
+from worker import start_worker_threads
+from executors import get_executor
+from degradation import DegradationPolicy
+from ocr_rules import RuleEngine
+from receipt_validator import LLMGate
+from vendor_templates import VendorTemplates
 import logging
 import sys
+import time
 
 # Load environment variables
 load_dotenv()
@@ -23,7 +34,8 @@ app = Flask(__name__)
 # Ajout d'une clé secrète pour les sessions
 app.secret_key = os.getenv("SECRET_KEY", "default_secret_key_for_development")
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Taille maximale d'une requête, lots de tickets compris (/upload/batch)
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_MB", "128")) * 1024 * 1024
 app.config['DATA_DIR'] = Path(__file__).parent / 'data'
 app.config['DB_PATH'] = Path(__file__).parent / 'fidelity_db.sqlite'
 # Configurer le délai d'expiration de session à 1 heure
@@ -35,6 +47,36 @@ app.config['GCP_CREDENTIALS_PATH'] = os.getenv("GCP_CREDENTIALS_PATH", os.path.j
 # Disable local fallback
 app.config['USE_LOCAL_FALLBACK'] = False
 
+# File de traitement des tickets (consommée par worker.py)
+app.config['JOB_QUEUE_PATH'] = os.getenv("JOB_QUEUE_PATH", str(Path(__file__).parent / 'job_queue.sqlite'))
+# Nombre de workers lancés dans le processus Flask (0 = uniquement worker.py)
+app.config['INPROCESS_WORKERS'] = int(os.getenv("INPROCESS_WORKERS", "0"))
+# Flux SSE de progression des uploads
+app.config['SSE_POLL_INTERVAL'] = 0.5  # secondes entre deux lectures de la file
+app.config['SSE_MAX_DURATION'] = 600  # durée maximale d'un flux en secondes
+# Stockage des uploads avant traitement : 'disk' (dossier d'upload) ou 'memory'
+# (contenu transmis aux workers dans la file, sans fichier local)
+app.config['UPLOAD_STORAGE'] = os.getenv("UPLOAD_STORAGE", "disk").lower()
+# Envoi de tickets par lots (/upload/batch)
+app.config['BATCH_MAX_FILES'] = int(os.getenv("BATCH_MAX_FILES", "50"))
+# Cache des résultats OCR/Mistral par empreinte d'image (partagé avec worker.py)
+app.config['RESULT_CACHE_ENABLED'] = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+app.config['RESULT_CACHE_PATH'] = os.getenv("RESULT_CACHE_PATH", str(Path(__file__).parent / 'result_cache.sqlite'))
+# Contrôle d'admission : au-delà de MAX_QUEUED_JOBS jobs en attente ou en cours
+# (0 = sans limite), ou si un pool d'exécution est saturé, les uploads reçoivent un 429
+app.config['MAX_QUEUED_JOBS'] = int(os.getenv("MAX_QUEUED_JOBS", "500"))
+app.config['UPLOAD_RETRY_AFTER'] = int(os.getenv("UPLOAD_RETRY_AFTER", "10"))  # secondes
+# Âge maximal des indicateurs publiés par les workers (au-delà, le worker est considéré arrêté)
+app.config['WORKER_STATS_MAX_AGE'] = float(os.getenv("WORKER_STATS_MAX_AGE", "30"))
+# Mode dégradé sous charge : nettoyage Mistral sauté, modèle léger puis extraction sans Mistral
+app.config['DEGRADATION_ENABLED'] = os.getenv("DEGRADATION_ENABLED", "true").lower() == "true"
+# Extraction par les règles de regles_ocr, sans classification Mistral quand elles suffisent
+app.config['RULES_ENABLED'] = os.getenv("RULES_ENABLED", "true").lower() == "true"
+# Mistral sauté (ou nettoyage seul sauté) pour un texte OCR fiable dont les montants concordent
+app.config['LLM_GATE_ENABLED'] = os.getenv("LLM_GATE_ENABLED", "true").lower() == "true"
+# Modèles de mise en page par enseigne, appris sur les tickets classés par Mistral
+app.config['VENDOR_TEMPLATES_ENABLED'] = os.getenv("VENDOR_TEMPLATES_ENABLED", "true").lower() == "true"
+
 #----------------------------------------------------------DEBOGAGE ------------------------------------------------
 
 import traceback
@@ -145,7 +187,7 @@ try:
     
     # Create a function to initialize storage with timeout
     def initialize_storage_with_timeout():
-        from concurrent.futures import ThreadPoolExecutor, TimeoutError
+        from concurrent.futures import TimeoutError
         
         def init_storage():
             # Create the storage manager
@@ -162,14 +204,13 @@ try:
             app.logger.info(f"Bucket exists: {bucket_exists}")
             return storage_mgr
             
-        # Use ThreadPoolExecutor for timeout
-        with ThreadPoolExecutor() as executor:
-            future = executor.submit(init_storage)
-            try:
-                return future.result(timeout=10)  # 10 second timeout
-            except TimeoutError:
-                app.logger.error("GCP Storage initialization timed out after 10 seconds")
-                raise TimeoutError("GCP Storage initialization timed out")
+        # Pool de stockage partagé pour le délai d'attente
+        future = get_executor("storage").submit(init_storage)
+        try:
+            return future.result(timeout=10)  # 10 second timeout
+        except TimeoutError:
+            app.logger.error("GCP Storage initialization timed out after 10 seconds")
+            raise TimeoutError("GCP Storage initialization timed out")
                 
     # Initialize with timeout
     storage_manager = initialize_storage_with_timeout()
@@ -199,6 +240,9 @@ except Exception as e:
         def upload_file(self, filepath, blob_name):
             return f"/static/placeholder.jpg"
             
+        def upload_bytes(self, data, blob_name, content_type="image/jpeg"):
+            return f"/static/placeholder.jpg"
+            
         def upload_from_string(self, content, blob_name, content_type):
             return True
             
@@ -237,6 +281,28 @@ os.makedirs(app.config['DATA_DIR'] / 'csv', exist_ok=True)
 os.makedirs(app.config['DATA_DIR'] / 'images', exist_ok=True)
 os.makedirs(app.config['DATA_DIR'] / 'json', exist_ok=True)
 
+# Initialize processing queue and pipeline
+job_queue = JobQueue(app.config['JOB_QUEUE_PATH'])
+result_cache = ResultCache(app.config['RESULT_CACHE_PATH']) if app.config['RESULT_CACHE_ENABLED'] else None
+receipt_pipeline = ReceiptPipeline(
+    veryfi_processor=veryfi_processor,
+    ocr_processor=mistral_processor,
+    storage_manager=storage_manager,
+    db_integrator=db_integrator,
+    data_dir=app.config['DATA_DIR'],
+    result_cache=result_cache,
+    upload_dir=app.config['UPLOAD_FOLDER'],
+    degradation=DegradationPolicy(backlog_fn=job_queue.backlog) if app.config['DEGRADATION_ENABLED'] else None,
+    rule_engine=RuleEngine(app.config['DB_PATH']) if app.config['RULES_ENABLED'] else None,
+    llm_gate=LLMGate(mistral_processor.parse_receipt_text) if app.config['LLM_GATE_ENABLED'] else None,
+    vendor_templates=VendorTemplates(app.config['DB_PATH']) if app.config['VENDOR_TEMPLATES_ENABLED'] else None
+)
+if app.config['INPROCESS_WORKERS'] > 0:
+    start_worker_threads(job_queue, receipt_pipeline, app.config['INPROCESS_WORKERS'])
+    app.logger.info(f"{app.config['INPROCESS_WORKERS']} worker(s) de traitement démarré(s) dans le processus Flask")
+else:
+    app.logger.info(f"Tickets mis en file dans {app.config['JOB_QUEUE_PATH']} (lancer worker.py pour les traiter)")
+
 # Add Jinja filter to parse JSON
 @app.template_filter('from_json')
 def from_json(value):
@@ -428,273 +494,289 @@ def upload_file():
     if file.filename == '':
         return jsonify({'success': False, 'error': 'Aucun fichier sélectionné'}), 400
 
+    rejection = check_admission()
+    if rejection:
+        return rejection
+
     if file:
-        # Generate a unique filename to prevent collisions
-        import uuid
-        unique_id = str(uuid.uuid4())[:8]
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_filename = secure_filename(file.filename)
-        filename = f"{timestamp}_{unique_id}_{safe_filename}"
+        try:
+            # Le traitement (OCR, Mistral, GCS, fidélité) est confié aux workers
+            job = save_and_enqueue(file, session.get('client_id'))
+            return jsonify(dict(job, success=True)), 202
+            
+        except Exception as e:
+            app.logger.error(f"Erreur lors de la mise en file du ticket: {str(e)}")
+            app.logger.exception("Exception détaillée")
+            return jsonify({'success': False, 'error': str(e)}), 500
+
+admission_rejections = {"queue_full": 0, "pool_saturated": 0}
+
+def saturated_worker_pools():
+    """
+    Pools saturés dans tous les processus worker actifs, d'après les indicateurs
+    qu'ils publient dans la file (les pools du processus Flask ne traitent pas les tickets)
+    
+    :return: Liste des noms de pools saturés
+    """
+    workers = job_queue.worker_stats(app.config['WORKER_STATS_MAX_AGE'])
+    pools = [stats.get("pools", {}) for stats in workers.values()]
+    names = set().union(*pools) if pools else set()
+    return sorted(name for name in names if all(p.get(name, {}).get("saturated") for p in pools))
+
+def check_admission(incoming=1):
+    """
+    Refuse un upload quand la file de traitement ou un pool d'exécution est plein
+    
+    :param incoming: Nombre de tickets de la requête
+    :return: Réponse 429 (avec Retry-After) ou None si l'upload est accepté
+    """
+    max_jobs = app.config['MAX_QUEUED_JOBS']
+    try:
+        saturated = saturated_worker_pools()
+        backlog = job_queue.backlog() if max_jobs and not saturated else 0
+    except Exception as e:
+        app.logger.error(f"Impossible de lire l'état de la file: {str(e)}")
+        return None
+    if saturated:
+        reason = "pool_saturated"
+        error = f"Serveur saturé ({', '.join(saturated)}), réessayez plus tard"
+    elif not max_jobs or backlog + incoming <= max_jobs:
+        return None
+    else:
+        reason = "queue_full"
+        error = f"File de traitement pleine ({backlog} tickets en attente), réessayez plus tard"
+    
+    admission_rejections[reason] += 1
+    app.logger.warning(f"Upload refusé ({reason}): {error}")
+    retry_after = app.config['UPLOAD_RETRY_AFTER']
+    response = jsonify({'success': False, 'error': error, 'reason': reason, 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def save_and_enqueue(file, client_id, batch_id=None):
+    """
+    Sauvegarde un fichier envoyé et le dépose dans la file de traitement
+    
+    :param file: FileStorage reçu dans la requête
+    :param client_id: ID du client connecté
+    :param batch_id: ID du lot d'upload (optionnel)
+    :return: Dictionnaire du job pour la réponse JSON
+    """
+    # Generate a unique filename to prevent collisions
+    unique_id = str(uuid.uuid4())[:8]
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    safe_filename = secure_filename(file.filename)
+    filename = f"{timestamp}_{unique_id}_{safe_filename}"
+    
+    if app.config['UPLOAD_STORAGE'] == 'memory':
+        # Lecture unique du fichier : le même tampon sert à l'OCR, à Veryfi et à GCS
+        started = time.monotonic()
+        payload = file.read()
+        save_ms = int((time.monotonic() - started) * 1000)
+        job_id = job_queue.enqueue('', filename, client_id, batch_id, payload=payload)
+        job_queue.record_stage(job_id, "saved", "done", save_ms,
+                               {"filename": filename, "storage": "memory", "bytes": len(payload)})
+    else:
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         
+        # Ensure directory exists
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        started = time.monotonic()
+        file.save(filepath)
+        save_ms = int((time.monotonic() - started) * 1000)
+        app.logger.info(f"Fichier sauvegardé localement: {filepath}")
+        
         try:
-            # Ensure directory exists
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-            # Save file with a timeout
-            file.save(filepath)
-            app.logger.info(f"Fichier sauvegardé localement: {filepath}")
-            
-            # Process with timeouts to prevent hanging
-            from concurrent.futures import ThreadPoolExecutor, TimeoutError
-            
-            app.logger.info(f"Début du traitement du ticket: {filename}")
-            
-            # Define processing functions with timeouts
-            def process_with_veryfi():
-                try:
-                    return veryfi_processor.process_image(filepath)
-                except Exception as e:
-                    app.logger.error(f"Erreur Veryfi: {str(e)}")
-                    return {"ocr_text": "", "error": str(e)}
-            
-            def extract_with_tesseract():
-                try:
-                    return mistral_processor.extract_text(filepath)
-                except Exception as e:
-                    app.logger.error(f"Erreur Tesseract: {str(e)}")
-                    return ""
-                    
-            def clean_with_mistral(text):
-                try:
-                    return mistral_processor.clean_text_with_mistral(text)
-                except Exception as e:
-                    app.logger.error(f"Erreur nettoyage Mistral: {str(e)}")
-                    return text
-                    
-            def classify_with_mistral(text):
-                try:
-                    return mistral_processor.classify_data_with_mistral(text)
-                except Exception as e:
-                    app.logger.error(f"Erreur classification Mistral: {str(e)}")
-                    return {
-                        "vendor": "Unknown", 
-                        "date": datetime.now().strftime("%Y-%m-%d"),
-                        "total": 0,
-                        "line_items": []
-                    }
-            
-            # Use ThreadPoolExecutor for timeouts
-            with ThreadPoolExecutor() as executor:
-                # Step 1: Veryfi OCR with timeout
-                future = executor.submit(process_with_veryfi)
-                try:
-                    veryfi_result = future.result(timeout=30)  # 30 second timeout
-                    raw_ocr_text = veryfi_result.get('ocr_text', '')
-                    app.logger.info(f"Texte OCR extrait avec Veryfi: {len(raw_ocr_text)} caractères")
-                except TimeoutError:
-                    app.logger.error("Veryfi processing timed out after 30 seconds")
-                    veryfi_result = {"ocr_text": "", "error": "Timeout during processing"}
-                    raw_ocr_text = ""
-                except Exception as e:
-                    app.logger.error(f"Exception during Veryfi processing: {str(e)}")
-                    veryfi_result = {"ocr_text": "", "error": str(e)}
-                    raw_ocr_text = ""
-                
-                # Fallback to Tesseract if Veryfi fails
-                if not raw_ocr_text:
-                    app.logger.info("Pas de texte retourné par Veryfi, recours à Tesseract")
-                    future = executor.submit(extract_with_tesseract)
-                    try:
-                        raw_ocr_text = future.result(timeout=20)  # 20 second timeout
-                        app.logger.info(f"Texte OCR extrait avec Tesseract: {len(raw_ocr_text)} caractères")
-                    except TimeoutError:
-                        app.logger.error("Tesseract extraction timed out")
-                        raw_ocr_text = "Error: OCR timeout"
-                    except Exception as e:
-                        app.logger.error(f"Exception during Tesseract extraction: {str(e)}")
-                        raw_ocr_text = f"Error: {str(e)}"
-                
-                # Step 2: Clean text with Mistral
-                future = executor.submit(clean_with_mistral, raw_ocr_text)
-                try:
-                    cleaned_text = future.result(timeout=20)  # 20 second timeout
-                    app.logger.info("Nettoyage du texte avec Mistral terminé")
-                except TimeoutError:
-                    app.logger.error("Mistral text cleaning timed out")
-                    cleaned_text = raw_ocr_text
-                except Exception as e:
-                    app.logger.error(f"Exception during Mistral text cleaning: {str(e)}")
-                    cleaned_text = raw_ocr_text
-                
-                # Step 3: Classify with Mistral
-                future = executor.submit(classify_with_mistral, cleaned_text)
-                try:
-                    structured_data = future.result(timeout=20)  # 20 second timeout
-                    app.logger.info("Classification des données avec Mistral terminée")
-                except TimeoutError:
-                    app.logger.error("Mistral classification timed out")
-                    structured_data = {
-                        "vendor": "Unknown (timeout)", 
-                        "date": datetime.now().strftime("%Y-%m-%d"),
-                        "total": 0,
-                        "line_items": []
-                    }
-                except Exception as e:
-                    app.logger.error(f"Exception during Mistral classification: {str(e)}")
-                    structured_data = {
-                        "vendor": "Unknown (error)", 
-                        "date": datetime.now().strftime("%Y-%m-%d"),
-                        "total": 0,
-                        "line_items": []
-                    }
-            
-            # Combine results
-            combined_result = {
-                "vendor": structured_data.get("vendor", veryfi_result.get("vendor_name", "Unknown")),
-                "date": structured_data.get("date", veryfi_result.get("date", "")),
-                "total": structured_data.get("total", veryfi_result.get("total", 0)),
-                "line_items": structured_data.get("line_items", veryfi_result.get("line_items", [])),
-                "category": structured_data.get("category", veryfi_result.get("category", "Uncategorized")),
-                "payment_method": structured_data.get("payment_method", veryfi_result.get("payment_type", "Unknown")),
-                "store_address": structured_data.get("store_address", veryfi_result.get("vendor_address", "")),
-                "store_phone": structured_data.get("store_phone", veryfi_result.get("vendor_phone", "")),
-                "store_email": structured_data.get("store_email", veryfi_result.get("vendor_email", "")),
-                "store_website": structured_data.get("store_website", veryfi_result.get("vendor_website", "")),
-                "tax": structured_data.get("tax", veryfi_result.get("tax", 0)),
-                "subtotal": structured_data.get("subtotal", veryfi_result.get("subtotal", 0)),
-                "siret": structured_data.get("siret", ""),
-                "tva_number": structured_data.get("tva_number", ""),
-                "capital": structured_data.get("capital", ""),
-                "naf_code": structured_data.get("naf_code", ""),
-                "cashier": structured_data.get("cashier", ""),
-                "client_type": structured_data.get("client_type", ""),
-                "ocr_text": raw_ocr_text,
-                "cleaned_text": cleaned_text,
-                "veryfi_data": veryfi_result,
-                "storage_type": "Google Cloud Storage"
+            job_id = job_queue.enqueue(filepath, filename, client_id, batch_id)
+            job_queue.record_stage(job_id, "saved", "done", save_ms, {"filename": filename})
+        except Exception:
+            # Ensure file is cleaned up
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            raise
+    app.logger.info(f"Ticket {filename} mis en file, job {job_id}")
+    
+    return {
+        'job_id': job_id,
+        'status': JobQueue.STATUS_QUEUED,
+        'status_url': url_for('upload_status', job_id=job_id),
+        'events_url': url_for('upload_events', job_id=job_id)
+    }
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Envoi de plusieurs tickets en une requête (champ multipart 'files')"""
+    if not session.get('logged_in'):
+        app.logger.warning("Unauthenticated batch upload attempt")
+        return jsonify({'success': False, 'error': 'Veuillez vous connecter pour scanner des tickets'}), 401
+    
+    files = [f for f in request.files.getlist('files') if f and f.filename]
+    if not files:
+        return jsonify({'success': False, 'error': 'Aucun fichier sélectionné'}), 400
+    if len(files) > app.config['BATCH_MAX_FILES']:
+        return jsonify({
+            'success': False,
+            'error': f"Trop de fichiers : {app.config['BATCH_MAX_FILES']} maximum par lot"
+        }), 400
+    
+    rejection = check_admission(len(files))
+    if rejection:
+        return rejection
+    
+    # Les tickets du lot sont réservés ensemble par un worker (voir worker.run_batch)
+    batch_id = uuid.uuid4().hex
+    client_id = session.get('client_id')
+    app.logger.info(f"Lot {batch_id}: {len(files)} ticket(s) reçu(s)")
+    
+    results = []
+    for file in files:
+        try:
+            job = save_and_enqueue(file, client_id, batch_id)
+            results.append(dict(job, filename=file.filename, success=True))
+        except Exception as e:
+            app.logger.error(f"Erreur lors de la mise en file de {file.filename}: {str(e)}")
+            results.append({'filename': file.filename, 'success': False, 'error': str(e)})
+    
+    queued = sum(1 for r in results if r['success'])
+    return jsonify({
+        'success': queued > 0,
+        'batch_id': batch_id,
+        'queued': queued,
+        'failed': len(results) - queued,
+        'status_url': url_for('upload_batch_status', batch_id=batch_id),
+        'files': results
+    }), 202 if queued else 500
+
+@app.route('/upload/batch/<batch_id>')
+def upload_batch_status(batch_id):
+    """Etat de chaque ticket d'un lot"""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'error': 'Veuillez vous connecter'}), 401
+    
+    jobs = [job for job in job_queue.get_batch(batch_id)
+            if not job['client_id'] or job['client_id'] == session.get('client_id')]
+    if not jobs:
+        return jsonify({'success': False, 'error': 'Lot introuvable'}), 404
+    
+    counts = {}
+    for job in jobs:
+        counts[job['status']] = counts.get(job['status'], 0) + 1
+    finished = counts.get(JobQueue.STATUS_DONE, 0) + counts.get(JobQueue.STATUS_FAILED, 0)
+    
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'status': 'done' if finished == len(jobs) else 'processing',
+        'counts': counts,
+        'jobs': [
+            {
+                'job_id': job['job_id'],
+                'filename': job['filename'],
+                'status': job['status'],
+                'error': job['error'],
+                'receipt_id': (job['result'] or {}).get('receipt_id'),
+                'transaction_id': (job['result'] or {}).get('transaction_id'),
+                'status_url': url_for('upload_status', job_id=job['job_id'])
             }
+            for job in jobs
+        ]
+    })
+
+@app.route('/upload/<job_id>')
+def upload_status(job_id):
+    """Etat d'un ticket en cours de traitement"""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'error': 'Veuillez vous connecter'}), 401
+    
+    job = job_queue.get_job(job_id)
+    if not job or (job['client_id'] and job['client_id'] != session.get('client_id')):
+        return jsonify({'success': False, 'error': 'Traitement introuvable'}), 404
+    
+    result = job['result'] or {}
+    return jsonify({
+        'success': job['status'] != JobQueue.STATUS_FAILED,
+        'job_id': job_id,
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'error': job['error'],
+        'receipt_id': result.get('receipt_id'),
+        'result': result,
+        'stages': [
+            {
+                'stage': stage['stage'],
+                'status': stage['status'],
+                'duration_ms': stage['duration_ms'],
+                'detail': stage['detail']
+            }
+            for stage in job_queue.get_stages(job_id)
+        ]
+    })
+
+@app.route('/upload/<job_id>/events')
+def upload_events(job_id):
+    """Flux Server-Sent Events des étapes de traitement d'un ticket"""
+    if not session.get('logged_in'):
+        return jsonify({'success': False, 'error': 'Veuillez vous connecter'}), 401
+    
+    job = job_queue.get_job(job_id)
+    if not job or (job['client_id'] and job['client_id'] != session.get('client_id')):
+        return jsonify({'success': False, 'error': 'Traitement introuvable'}), 404
+    
+    def sse(event, data, event_id=None):
+        prefix = f"id: {event_id}\n" if event_id is not None else ""
+        return f"{prefix}event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+    
+    # Reprise après reconnexion automatique du navigateur
+    try:
+        resume_from = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        resume_from = 0
+    
+    def generate():
+        last_stage_id = resume_from
+        last_sent = time.monotonic()
+        deadline = time.monotonic() + app.config['SSE_MAX_DURATION']
+        
+        # Indiquer au navigateur le délai de reconnexion
+        yield f"retry: {int(app.config['SSE_POLL_INTERVAL'] * 1000)}\n\n"
+        
+        while time.monotonic() < deadline:
+            # Lire le statut avant les étapes : un job terminé a déjà enregistré toutes les siennes
+            current = job_queue.get_job(job_id)
             
-            # Get client ID if user is logged in
-            client_id = None
-            if session.get('logged_in') and session.get('client_id'):
-                client_id = session.get('client_id')
-                app.logger.info(f"Client connecté ID: {client_id} - {session.get('client_name', '')}")
-                combined_result["client_id"] = client_id
-            
-            # Generate receipt ID
-            current_date = datetime.now().strftime('%Y%m%d_%H%M%S')
-            ticket_uuid = str(uuid.uuid4())[:8]
-            receipt_id = f"receipt_{current_date}_{ticket_uuid}"
-            app.logger.info(f"ID de ticket généré: {receipt_id}")
-            
-            # Upload image to GCS with timeout
-            image_blob_name = f"receipts/images/{receipt_id}.jpg"
-            image_url = None
-            
-            try:
-                with ThreadPoolExecutor() as executor:
-                    future = executor.submit(storage_manager.upload_file, filepath, image_blob_name)
-                    image_url = future.result(timeout=30)  # 30 second timeout
-                    combined_result["image_url"] = image_url
-                    app.logger.info(f"Image sauvegardée dans GCP: {image_blob_name}")
-            except TimeoutError:
-                app.logger.error("GCS image upload timed out")
-                combined_result["image_url"] = f"/static/uploads/{filename}"
-            except Exception as e:
-                app.logger.error(f"Error uploading image to GCS: {str(e)}")
-                combined_result["image_url"] = f"/static/uploads/{filename}"
-            
-            combined_result["receipt_id"] = receipt_id
-            combined_result["processed_at"] = datetime.now().isoformat()
-            
-            # Save JSON data to GCS with timeout
-            json_blob_name = f"receipts/json/{receipt_id}.json"
-            json_data = json.dumps(combined_result, indent=2, default=str)
-            
-            try:
-                with ThreadPoolExecutor() as executor:
-                    future = executor.submit(storage_manager.upload_from_string, json_data, json_blob_name, "application/json")
-                    future.result(timeout=20)  # 20 second timeout
-                    app.logger.info(f"Données du ticket sauvegardées dans GCP Storage avec l'ID: {receipt_id}")
-            except TimeoutError:
-                app.logger.error("GCS JSON upload timed out")
-            except Exception as e:
-                app.logger.error(f"Error uploading JSON to GCS: {str(e)}")
-            
-            # Save JSON locally as fallback
-            json_dir = os.path.join(app.config['DATA_DIR'], 'json')
-            os.makedirs(json_dir, exist_ok=True)
-            local_json_path = os.path.join(json_dir, f"{receipt_id}.json")
-            with open(local_json_path, 'w') as f:
-                f.write(json_data)
-            app.logger.info(f"Données du ticket sauvegardées localement: {local_json_path}")
-            
-            # Integrate with loyalty database
-            try:
-                db_success, transaction_id, db_message = db_integrator.process_receipt_data(
-                    combined_result, 
-                    image_url or f"/static/uploads/{filename}",
-                    client_id
-                )
-                
-                if db_success:
-                    app.logger.info(f"Ticket intégré dans la base de données de fidélité. ID Transaction: {transaction_id}")
-                    combined_result["loyalty_transaction_id"] = transaction_id
-                    
-                    # Update JSON with transaction ID
-                    json_data = json.dumps(combined_result, indent=2, default=str)
-                    try:
-                        storage_manager.upload_from_string(json_data, json_blob_name, "application/json")
-                    except Exception as e:
-                        app.logger.error(f"Error updating JSON in GCS: {str(e)}")
-                    
-                    # Update local JSON
-                    with open(local_json_path, 'w') as f:
-                        f.write(json_data)
-                    
-                    if session.get('logged_in'):
-                        flash("Votre ticket a été associé à votre compte et vos points ont été mis à jour!", "success")
-                else:
-                    app.logger.error(f"Échec de l'intégration du ticket avec la base de données de fidélité: {db_message}")
-                    
-                    if session.get('logged_in'):
-                        flash(f"Erreur lors de l'association du ticket à votre compte: {db_message}", "danger")
-            except Exception as e:
-                app.logger.error(f"Exception during loyalty database integration: {str(e)}")
-                db_success = False
-                transaction_id = None
-            
-            # Try to remove local file
-            try:
-                if os.path.exists(filepath) and image_url and image_url.startswith("https://"):
-                    os.remove(filepath)
-                    app.logger.info(f"Fichier local supprimé: {filepath}")
-            except Exception as e:
-                app.logger.error(f"Error removing local file: {str(e)}")
+            for stage in job_queue.get_stages(job_id, last_stage_id):
+                last_stage_id = stage['stage_id']
+                last_sent = time.monotonic()
+                yield sse('stage', {
+                    'stage': stage['stage'],
+                    'status': stage['status'],
+                    'duration_ms': stage['duration_ms'],
+                    'detail': stage['detail']
+                }, stage['stage_id'])
             
-            app.logger.info(f"Traitement du ticket terminé avec succès")
+            if current['status'] == JobQueue.STATUS_DONE:
+                result = current['result'] or {}
+                yield sse('done', {'job_id': job_id, 'receipt_id': result.get('receipt_id'), 'result': result})
+                return
+            if current['status'] == JobQueue.STATUS_FAILED:
+                yield sse('failed', {'job_id': job_id, 'error': current['error']})
+                return
             
-            return jsonify({
-                'success': True, 
-                'receipt_id': receipt_id,
-                'db_integration': db_success,
-                'transaction_id': transaction_id if db_success else None,
-                'client_id': client_id,
-                'storage_type': "Google Cloud Storage"
-            })
+            # Commentaire SSE pour garder la connexion ouverte derrière les proxys
+            if time.monotonic() - last_sent > 15:
+                last_sent = time.monotonic()
+                yield ": keepalive\n\n"
             
-        except Exception as e:
-            app.logger.error(f"Erreur lors du traitement du ticket: {str(e)}")
-            app.logger.exception("Exception détaillée")
-                
-            # Ensure file is cleaned up
-            try:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-            except:
-                pass
-                
-            return jsonify({'success': False, 'error': str(e)}), 500
+            time.sleep(app.config['SSE_POLL_INTERVAL'])
+        
+        yield sse('timeout', {'job_id': job_id})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/history')
 def history():
@@ -1024,6 +1106,52 @@ def client_detail(client_id):
     
     return "Client not found", 404
 
+@app.route('/metrics')
+def metrics():
+    """Indicateurs de traitement : file d'attente, pools, cache des résultats et consommation Mistral"""
+    outcomes = job_queue.classification_outcomes(request.args.get('since'))
+    classified = sum(outcomes.values())
+    # Indicateurs publiés par les processus worker actifs (voir worker.start_stats_reporter)
+    workers = job_queue.worker_stats(app.config['WORKER_STATS_MAX_AGE'])
+    metrics_info = {
+        "timestamp": datetime.now().isoformat(),
+        "queue": job_queue.depth(),
+        "admission": {
+            "max_queued_jobs": app.config['MAX_QUEUED_JOBS'],
+            "rejected": dict(admission_rejections)
+        },
+        "pools": {worker_id: stats.get("pools", {}) for worker_id, stats in workers.items()},
+        "result_cache": result_cache.stats() if result_cache else {"enabled": False},
+        "llm": {
+            "mode": receipt_pipeline.llm_mode,
+            "connections": MistralLLMService.merge_connection_stats(
+                [stats["llm_connections"] for stats in workers.values() if "llm_connections" in stats]),
+            "prompt_cache": (mistral_processor.llm_service.prompt_cache.stats()
+                             if mistral_processor.llm_service.prompt_cache else {"enabled": False}),
+            "usage_by_mode": job_queue.llm_usage(request.args.get('since'))
+        },
+        "degradation": {
+            "policy": (DegradationPolicy.merge_stats([stats["degradation"] for stats in workers.values()
+                                                      if "degradation" in stats])
+                       if receipt_pipeline.degradation else {"enabled": False}),
+            "receipts_by_tier": job_queue.processing_tiers(request.args.get('since'))
+        },
+        "classification": {
+            "rules": (RuleEngine.merge_stats([stats["rules"] for stats in workers.values() if "rules" in stats])
+                      if receipt_pipeline.rule_engine else {"enabled": False}),
+            "llm_gate": (LLMGate.merge_stats([stats["llm_gate"] for stats in workers.values() if "llm_gate" in stats])
+                         if receipt_pipeline.llm_gate else {"enabled": False}),
+            "vendor_templates": (VendorTemplates.merge_stats([stats["vendor_templates"] for stats in workers.values()
+                                                              if "vendor_templates" in stats])
+                                 if receipt_pipeline.vendor_templates else {"enabled": False}),
+            "receipts_by_outcome": outcomes,
+            # Part des tickets classés sans aucun appel Mistral (QR code, règles, modèle d'enseigne ou LLMGate)
+            "llm_skip_rate": round(sum(outcomes.get(reason, 0) for reason in ("code", "rules", "template", "gate"))
+                                   / classified, 3) if classified else 0.0
+        }
+    }
+    return jsonify(metrics_info)
+
 @app.route('/health')
 def health_check():
     """Health check endpoint to verify the app is running correctly"""
@@ -1053,6 +1181,13 @@ def health_check():
             health_info["components"]["database"] = f"error: {str(e)}"
             health_info["status"] = "degraded"
         
+        # Check processing queue
+        try:
+            health_info["components"]["queue"] = job_queue.depth()
+        except Exception as e:
+            health_info["components"]["queue"] = f"error: {str(e)}"
+            health_info["status"] = "degraded"
+        
         # Check storage connection
         try:
             storage_status = storage_manager.get_storage_status()
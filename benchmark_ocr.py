@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Banc d'essai des préréglages de prétraitement OCR (fast, balanced, quality).
+
+Pour chaque préréglage et chaque image du jeu de test, mesure le temps de
+prétraitement et de reconnaissance Tesseract, et la précision caractère du
+texte obtenu par rapport à la transcription de référence <image>.txt placée
+à côté de l'image (optionnelle : sans elle, seuls les temps sont mesurés).
+
+Exemples :
+    python benchmark_ocr.py
+    python benchmark_ocr.py --images input_tickets --presets fast balanced --repeat 3
+    python benchmark_ocr.py --json resultats_benchmark.json
+    python benchmark_ocr.py --engines pytesseract tesserocr --repeat 5
+
+Avec --engines, compare plutôt les moteurs Tesseract (voir ocr_engines.py) sur
+les mêmes images prétraitées : seul le temps de reconnaissance est mesuré.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import cv2
+
+from advanced_receipt_ocr import SimplifiedReceiptProcessor, PREPROCESS_PRESETS
+from ocr_engines import OCR_ENGINES, create_engine
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def normalize_text(text):
+    """Texte comparable : espaces multiples réduits, lignes vides supprimées"""
+    lines = [re.sub(r'[ \t]+', ' ', line).strip() for line in (text or '').splitlines()]
+    return '\n'.join(line for line in lines if line)
+
+
+def levenshtein(a, b):
+    """Distance d'édition entre deux chaînes (insertions, suppressions, substitutions)"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)
+            ))
+        previous = current
+    return previous[-1]
+
+
+def char_accuracy(text, reference):
+    """Précision caractère : 1 - distance d'édition / longueur de la référence"""
+    text, reference = normalize_text(text), normalize_text(reference)
+    if not reference:
+        return None
+    return max(0.0, 1.0 - levenshtein(text, reference) / len(reference))
+
+
+def load_dataset(images_dir):
+    """
+    Liste les images du jeu de test et leurs transcriptions de référence
+
+    :param images_dir: Dossier des images
+    :return: Liste de tuples (nom, image décodée, texte de référence ou None)
+    """
+    dataset = []
+    for filename in sorted(os.listdir(images_dir)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        image = cv2.imread(os.path.join(images_dir, filename))
+        if image is None:
+            print(f"Image illisible ignorée: {filename}")
+            continue
+        reference_path = os.path.join(images_dir, f"{os.path.splitext(filename)[0]}.txt")
+        reference = None
+        if os.path.exists(reference_path):
+            with open(reference_path, 'r', encoding='utf-8') as f:
+                reference = f.read()
+        dataset.append((filename, image, reference))
+    return dataset
+
+
+def run_benchmark(processor, dataset, presets, repeat=1):
+    """
+    Mesure chaque préréglage sur le jeu de test
+
+    :param processor: Instance de SimplifiedReceiptProcessor
+    :param dataset: Liste renvoyée par load_dataset
+    :param presets: Noms des préréglages à comparer
+    :param repeat: Nombre de passes par image (la médiane des temps est retenue)
+    :return: Dictionnaire {préréglage: résultats agrégés et par image}
+    """
+    results = {}
+    for preset in presets:
+        per_image = []
+        for filename, image, reference in dataset:
+            preprocess_ms, ocr_ms = [], []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                preprocessed = processor.preprocess_image(image, preset)
+                preprocessed_at = time.perf_counter()
+                text = processor._clean_extracted_text(processor.recognize(preprocessed))
+                finished = time.perf_counter()
+                preprocess_ms.append((preprocessed_at - started) * 1000)
+                ocr_ms.append((finished - preprocessed_at) * 1000)
+            per_image.append({
+                "image": filename,
+                "preprocess_ms": round(statistics.median(preprocess_ms), 1),
+                "ocr_ms": round(statistics.median(ocr_ms), 1),
+                "total_ms": round(statistics.median(preprocess_ms) + statistics.median(ocr_ms), 1),
+                "chars": len(text),
+                "accuracy": char_accuracy(text, reference) if reference is not None else None
+            })
+            print(f"  [{preset}] {filename}: {per_image[-1]['total_ms']} ms"
+                  + (f", précision {per_image[-1]['accuracy']:.1%}" if per_image[-1]['accuracy'] is not None else ""))
+
+        accuracies = [r["accuracy"] for r in per_image if r["accuracy"] is not None]
+        results[preset] = {
+            "images": len(per_image),
+            "avg_preprocess_ms": round(statistics.mean(r["preprocess_ms"] for r in per_image), 1),
+            "avg_ocr_ms": round(statistics.mean(r["ocr_ms"] for r in per_image), 1),
+            "avg_total_ms": round(statistics.mean(r["total_ms"] for r in per_image), 1),
+            "avg_accuracy": round(statistics.mean(accuracies), 4) if accuracies else None,
+            "per_image": per_image
+        }
+    return results
+
+
+def run_engine_benchmark(processor, dataset, engines, repeat=1):
+    """
+    Compare les moteurs de reconnaissance sur les images prétraitées une seule fois
+
+    :param processor: Instance de SimplifiedReceiptProcessor (prétraitement et dossier tessdata)
+    :param dataset: Liste renvoyée par load_dataset
+    :param engines: Noms des moteurs à comparer ('tesserocr', 'pytesseract')
+    :param repeat: Nombre de passes par image (la médiane des temps est retenue)
+    :return: Dictionnaire {moteur: résultats agrégés et par image}
+    """
+    preprocessed = [(filename, processor.preprocess_image(image), reference)
+                    for filename, image, reference in dataset]
+    results = {}
+    for name in engines:
+        engine = create_engine(name, lang=processor.lang, tessdata_path=processor.engine.tessdata_path)
+        if engine.name != name:
+            print(f"Moteur {name} indisponible, ignoré")
+            continue
+        per_image = []
+        try:
+            # Premier appel hors mesure : chargement du modèle de langue par tesserocr
+            if preprocessed:
+                engine.recognize(preprocessed[0][1])
+            for filename, image, reference in preprocessed:
+                ocr_ms = []
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    text = engine.recognize(image)
+                    ocr_ms.append((time.perf_counter() - started) * 1000)
+                text = processor._clean_extracted_text(text)
+                per_image.append({
+                    "image": filename,
+                    "preprocess_ms": 0.0,
+                    "ocr_ms": round(statistics.median(ocr_ms), 1),
+                    "total_ms": round(statistics.median(ocr_ms), 1),
+                    "chars": len(text),
+                    "accuracy": char_accuracy(text, reference) if reference is not None else None
+                })
+                print(f"  [{name}] {filename}: {per_image[-1]['ocr_ms']} ms")
+        finally:
+            engine.close()
+
+        accuracies = [r["accuracy"] for r in per_image if r["accuracy"] is not None]
+        results[name] = {
+            "images": len(per_image),
+            "avg_preprocess_ms": 0.0,
+            "avg_ocr_ms": round(statistics.mean(r["ocr_ms"] for r in per_image), 1),
+            "avg_total_ms": round(statistics.mean(r["total_ms"] for r in per_image), 1),
+            "avg_accuracy": round(statistics.mean(accuracies), 4) if accuracies else None,
+            "per_image": per_image
+        }
+    return results
+
+
+def print_summary(results):
+    """Affiche le tableau comparatif des préréglages"""
+    print("\n" + "=" * 72)
+    print(f"{'Variante':<12}{'Images':>8}{'Prétrait. ms':>15}{'OCR ms':>12}{'Total ms':>12}{'Précision':>13}")
+    print("-" * 72)
+    for preset, summary in results.items():
+        accuracy = f"{summary['avg_accuracy']:.1%}" if summary['avg_accuracy'] is not None else "n/a"
+        print(f"{preset:<12}{summary['images']:>8}{summary['avg_preprocess_ms']:>15}"
+              f"{summary['avg_ocr_ms']:>12}{summary['avg_total_ms']:>12}{accuracy:>13}")
+    print("=" * 72)
+
+
+def main():
+    """Fonction principale"""
+    parser = argparse.ArgumentParser(description="Banc d'essai des préréglages de prétraitement OCR")
+    parser.add_argument('--images', default='input_tickets',
+                        help="Dossier des images de test (transcriptions de référence <image>.txt)")
+    parser.add_argument('--presets', nargs='+', default=list(PREPROCESS_PRESETS),
+                        choices=list(PREPROCESS_PRESETS), help="Préréglages à comparer")
+    parser.add_argument('--engines', nargs='+', choices=[e for e in OCR_ENGINES if e != 'auto'],
+                        help="Comparer ces moteurs Tesseract au lieu des préréglages")
+    parser.add_argument('--repeat', type=int, default=1, help="Nombre de passes par image")
+    parser.add_argument('--json', help="Fichier où écrire les résultats détaillés")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.images):
+        print(f"Erreur: le dossier d'images n'existe pas: {args.images}")
+        return 1
+    dataset = load_dataset(args.images)
+    if not dataset:
+        print(f"Aucune image trouvée dans {args.images}")
+        return 1
+    with_reference = sum(1 for _, _, reference in dataset if reference is not None)
+    print(f"{len(dataset)} image(s), dont {with_reference} avec transcription de référence")
+
+    processor = SimplifiedReceiptProcessor()
+    if args.engines:
+        results = run_engine_benchmark(processor, dataset, args.engines, max(1, args.repeat))
+    else:
+        results = run_benchmark(processor, dataset, args.presets, max(1, args.repeat))
+    print_summary(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Résultats détaillés écrits dans {args.json}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+import os
+import time
+
+
+class Deadline:
+    """
+    Budget de temps d'un traitement, partagé par toutes ses étapes.
+
+    Chaque étape prend au plus son propre délai maximal, dans la limite du temps
+    restant diminué de la réserve des étapes obligatoires qui la suivent : la durée
+    totale d'un ticket ne dépasse donc jamais le budget, quels que soient les délais.
+    """
+    def __init__(self, budget_seconds, started=None):
+        """
+        :param budget_seconds: Durée totale autorisée en secondes
+        :param started: Horodatage time.monotonic() de départ (maintenant par défaut)
+        """
+        self.budget_seconds = float(budget_seconds)
+        self.started = time.monotonic() if started is None else started
+        self.expires_at = self.started + self.budget_seconds
+
+    @classmethod
+    def from_env(cls):
+        """Budget par ticket lu dans la variable PIPELINE_DEADLINE (90 secondes par défaut)"""
+        return cls(float(os.getenv("PIPELINE_DEADLINE", "90")))
+
+    def elapsed(self):
+        """Temps écoulé depuis le départ, en secondes"""
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        """Temps restant en secondes (0 une fois le budget épuisé)"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        """True si le budget est épuisé"""
+        return self.remaining() <= 0
+
+    def timeout(self, cap=None, reserve=0.0):
+        """
+        Délai accordé à une étape
+
+        :param cap: Délai maximal propre à l'étape (optionnel)
+        :param reserve: Temps à garder pour les étapes suivantes
+        :return: Délai en secondes, éventuellement nul
+        """
+        available = max(0.0, self.remaining() - reserve)
+        return available if cap is None else min(cap, available)
+
+    def allows(self, seconds, reserve=0.0):
+        """
+        :param seconds: Durée minimale utile d'une étape optionnelle
+        :param reserve: Temps à garder pour les étapes suivantes
+        :return: True si l'étape peut encore être lancée
+        """
+        return self.remaining() - reserve >= seconds
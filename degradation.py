@@ -0,0 +1,120 @@
+import os
+import time
+import logging
+import threading
+
+# Niveaux de traitement, du plus complet au plus économe
+TIER_FULL = "full"                    # Nettoyage et classification Mistral
+TIER_NO_CLEAN = "no_clean"            # Classification Mistral du texte OCR brut
+TIER_LIGHT_MODEL = "light_model"      # Classification avec un modèle Mistral plus léger
+TIER_DETERMINISTIC = "deterministic"  # Extraction par expressions régulières, sans Mistral
+TIERS = (TIER_FULL, TIER_NO_CLEAN, TIER_LIGHT_MODEL, TIER_DETERMINISTIC)
+
+
+class DegradationPolicy:
+    """
+    Choisit le niveau de traitement d'un ticket selon la charge : nombre de jobs en
+    attente dans la file et latence récente des appels Mistral.
+
+    Chaque seuil de file franchi descend d'un niveau ; une latence Mistral élevée
+    descend au plus jusqu'au modèle léger, le dernier niveau (sans Mistral) n'étant
+    déclenché que par la profondeur de la file.
+    """
+    def __init__(self, backlog_fn=None, backlog_thresholds=None, latency_threshold=None, refresh_seconds=5.0):
+        """
+        :param backlog_fn: Fonction renvoyant le nombre de jobs en attente ou en cours
+        :param backlog_thresholds: Seuils de file des niveaux no_clean, light_model et deterministic
+                                   (variable DEGRADE_BACKLOG_THRESHOLDS, "50,150,300" par défaut)
+        :param latency_threshold: Latence Mistral p90 en secondes au-delà de laquelle le nettoyage
+                                  est sauté, le double menant au modèle léger (variable DEGRADE_LLM_LATENCY)
+        :param refresh_seconds: Durée pendant laquelle la profondeur de file lue est réutilisée
+        """
+        self.backlog_fn = backlog_fn
+        if backlog_thresholds is None:
+            backlog_thresholds = [int(v) for v in os.getenv("DEGRADE_BACKLOG_THRESHOLDS", "50,150,300").split(",") if v.strip()]
+        self.backlog_thresholds = sorted(backlog_thresholds)[:len(TIERS) - 1]
+        if latency_threshold is None:
+            latency_threshold = float(os.getenv("DEGRADE_LLM_LATENCY", "15"))
+        self.latency_threshold = latency_threshold
+        self.refresh_seconds = refresh_seconds
+        self.logger = logging.getLogger(__name__)
+
+        self._lock = threading.Lock()
+        self._backlog = 0
+        self._backlog_read_at = None
+        self._last_tier = TIER_FULL
+        self._counts = {tier: 0 for tier in TIERS}
+
+    def _current_backlog(self):
+        """Profondeur de la file, relue au plus toutes les refresh_seconds secondes"""
+        if self.backlog_fn is None:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            if self._backlog_read_at is not None and now - self._backlog_read_at < self.refresh_seconds:
+                return self._backlog
+        try:
+            backlog = self.backlog_fn()
+        except Exception as e:
+            self.logger.error(f"Impossible de lire la profondeur de la file: {str(e)}")
+            backlog = 0
+        with self._lock:
+            self._backlog, self._backlog_read_at = backlog, now
+        return backlog
+
+    def select_tier(self, llm_latency=None):
+        """
+        Niveau de traitement à appliquer au prochain ticket
+
+        :param llm_latency: Latence Mistral récente (p90, en secondes) ou None
+        :return: Nom du niveau (voir TIERS)
+        """
+        backlog = self._current_backlog()
+        level = sum(1 for threshold in self.backlog_thresholds if backlog >= threshold)
+        if llm_latency is not None and self.latency_threshold:
+            if llm_latency >= 2 * self.latency_threshold:
+                level = max(level, TIERS.index(TIER_LIGHT_MODEL))
+            elif llm_latency >= self.latency_threshold:
+                level = max(level, TIERS.index(TIER_NO_CLEAN))
+        tier = TIERS[level]
+
+        with self._lock:
+            if tier != self._last_tier:
+                self.logger.warning(f"Niveau de traitement {self._last_tier} -> {tier} "
+                                    f"(file: {backlog}, latence Mistral p90: {llm_latency})")
+            self._last_tier = tier
+            self._counts[tier] += 1
+        return tier
+
+    def stats(self):
+        """
+        :return: Dictionnaire (niveau courant, profondeur de file lue, seuils, tickets par niveau)
+        """
+        with self._lock:
+            return {
+                "tier": self._last_tier,
+                "backlog": self._backlog,
+                "backlog_thresholds": list(self.backlog_thresholds),
+                "latency_threshold": self.latency_threshold,
+                "receipts_by_tier": dict(self._counts)
+            }
+
+    @staticmethod
+    def merge_stats(reports):
+        """
+        Cumule les indicateurs stats() publiés par plusieurs processus worker
+
+        :param reports: Liste de dictionnaires renvoyés par stats()
+        :return: Dictionnaire au format de stats(), avec le niveau le plus dégradé des
+                 processus et le nombre de processus
+        """
+        tiers = [report["tier"] for report in reports if report.get("tier") in TIERS]
+        return {
+            "tier": max(tiers, key=TIERS.index) if tiers else TIER_FULL,
+            "backlog": max((report.get("backlog", 0) for report in reports), default=0),
+            "backlog_thresholds": reports[0].get("backlog_thresholds", []) if reports else [],
+            "latency_threshold": reports[0].get("latency_threshold") if reports else None,
+            "receipts_by_tier": {tier: sum(report.get("receipts_by_tier", {}).get(tier, 0) for report in reports)
+                                 for tier in TIERS},
+            "workers": len(reports)
+        }
@@ -0,0 +1,167 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Taille par défaut (threads, file d'attente) des pools partagés du processus
+POOL_DEFAULTS = {
+    "ocr": (4, 16),       # Veryfi et Tesseract
+    "llm": (8, 32),       # Appels Mistral
+    "storage": (8, 32),   # Envois GCS
+}
+
+
+class PoolSaturatedError(Exception):
+    """Levée quand un pool n'a plus de place pour une nouvelle tâche"""
+
+
+class BoundedExecutor:
+    """
+    ThreadPoolExecutor avec un nombre de threads et une file d'attente bornés.
+
+    Une tâche occupe une place du moment où elle est soumise jusqu'à sa fin
+    (y compris si l'appelant a cessé de l'attendre après un délai dépassé) :
+    le nombre de threads et de tâches en mémoire reste donc plafonné.
+    """
+    def __init__(self, name, max_workers, max_queue, submit_timeout=30.0):
+        """
+        :param name: Nom du pool (pour les logs et les métriques)
+        :param max_workers: Nombre de threads
+        :param max_queue: Nombre de tâches pouvant attendre un thread libre
+        :param submit_timeout: Attente maximale d'une place lors d'une soumission bloquante
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.submit_timeout = submit_timeout
+        self.logger = logging.getLogger(__name__)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-pool")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._peak_pending = 0
+
+    def submit(self, fn, *args, block=True, timeout=None, **kwargs):
+        """
+        Soumet une tâche au pool
+
+        :param fn: Fonction à exécuter
+        :param block: Attendre une place libre (sinon échec immédiat si le pool est plein)
+        :param timeout: Attente maximale d'une place (submit_timeout par défaut)
+        :return: Future de la tâche
+        :raises PoolSaturatedError: si aucune place ne s'est libérée
+        """
+        if block:
+            acquired = self._slots.acquire(timeout=self.submit_timeout if timeout is None else timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self._rejected += 1
+            self.logger.warning(f"Pool {self.name} saturé ({self.max_workers} threads, {self.max_queue} en attente)")
+            raise PoolSaturatedError(f"Pool {self.name} saturé")
+
+        with self._lock:
+            self._submitted += 1
+            self._pending += 1
+            self._peak_pending = max(self._peak_pending, self._pending)
+
+        def run():
+            with self._lock:
+                self._running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+        try:
+            future = self._executor.submit(run)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(lambda f: self._release(completed=not f.cancelled()))
+        return future
+
+    def _release(self, completed=False):
+        """Libère la place d'une tâche terminée, annulée ou non soumise"""
+        with self._lock:
+            self._pending -= 1
+            if completed:
+                self._completed += 1
+        self._slots.release()
+
+    def saturated(self):
+        """True si toutes les places (threads et file d'attente) sont occupées"""
+        with self._lock:
+            return self._pending >= self.max_workers + self.max_queue
+
+    def stats(self):
+        """
+        Indicateurs d'occupation du pool
+
+        :return: Dictionnaire (threads actifs, tâches en attente, rejets, ...)
+        """
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._pending - self._running,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "peak_pending": self._peak_pending,
+                "utilization": round(self._running / self.max_workers, 2) if self.max_workers else 0.0,
+                "saturated": self._pending >= self.max_workers + self.max_queue
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_executor(name):
+    """
+    Pool partagé du processus pour un type de tâche ('ocr', 'llm' ou 'storage')
+
+    Les tailles se règlent avec les variables <NOM>_POOL_SIZE et <NOM>_POOL_QUEUE
+    (ex: OCR_POOL_SIZE=2), l'attente d'une place avec POOL_SUBMIT_TIMEOUT.
+
+    :param name: Nom du pool
+    :return: Instance de BoundedExecutor
+    """
+    with _pools_lock:
+        if name not in _pools:
+            size, queue = POOL_DEFAULTS.get(name, (4, 16))
+            _pools[name] = BoundedExecutor(
+                name,
+                max_workers=int(os.getenv(f"{name.upper()}_POOL_SIZE", str(size))),
+                max_queue=int(os.getenv(f"{name.upper()}_POOL_QUEUE", str(queue))),
+                submit_timeout=float(os.getenv("POOL_SUBMIT_TIMEOUT", "30"))
+            )
+        return _pools[name]
+
+
+def pool_stats():
+    """
+    Indicateurs de tous les pools créés dans ce processus
+
+    :return: Dictionnaire {nom du pool: indicateurs}
+    """
+    with _pools_lock:
+        pools = dict(_pools)
+    return {name: pool.stats() for name, pool in pools.items()}
+
+
+def saturated_pools():
+    """
+    :return: Liste des noms des pools saturés dans ce processus
+    """
+    with _pools_lock:
+        pools = dict(_pools)
+    return [name for name, pool in pools.items() if pool.saturated()]
@@ -104,6 +104,36 @@ class GCPStorageManager:
             self.logger.error(f"Failed to upload file {source_file_path}: {str(e)}")
             raise
     
+    def upload_bytes(self, data, destination_blob_name, content_type="image/jpeg"):
+        """
+        Upload an in-memory file (e.g. the upload buffer) to the bucket without a local copy
+        :param data: File content as bytes
+        :param destination_blob_name: Name of the destination blob
+        :param content_type: Content type of the data
+        :return: URL for accessing the uploaded file
+        """
+        try:
+            blob = self.bucket.blob(destination_blob_name)
+            blob.upload_from_file(io.BytesIO(data), size=len(data), content_type=content_type)
+            self.logger.info(f"{len(data)} bytes uploaded to {destination_blob_name}")
+            
+            try:
+                # Generate a signed URL that works with uniform bucket-level access
+                url = blob.generate_signed_url(
+                    version="v4",
+                    expiration=timedelta(days=7),
+                    method="GET"
+                )
+                self.logger.info(f"Generated signed URL for {destination_blob_name}")
+                return url
+            except Exception as sign_error:
+                self.logger.warning(f"Could not generate signed URL: {str(sign_error)}. Using default URL.")
+                # Fallback to regular URL if signed URL fails
+                return f"https://storage.googleapis.com/{self.bucket_name}/{destination_blob_name}"
+        except Exception as e:
+            self.logger.error(f"Failed to upload data to {destination_blob_name}: {str(e)}")
+            raise
+    
     def upload_from_string(self, data, destination_blob_name, content_type="application/json"):
         """
         Upload data from a string to the bucket
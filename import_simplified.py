@@ -11,6 +11,7 @@ import sqlite3
 import uuid
 from datetime import datetime
 import random
+from result_cache import ResultCache
 
 # Configuration
 DB_PATH = "fidelity_db.sqlite"  # Chemin vers votre base de données
@@ -39,6 +40,9 @@ def import_ticket(json_path):
     image_path = os.path.join(IMAGES_DIR, image_name)
     if not os.path.exists(image_path):
         image_path = "pas_d_image.jpg"
+    else:
+        # Alimenter le cache des résultats avec ce ticket déjà traité
+        ResultCache().warm_from_receipt(image_path, data)
     
     # Connexion à la base de données
     conn = sqlite3.connect(DB_PATH)
@@ -0,0 +1,535 @@
+import os
+import json
+import uuid
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+
+
+class JobQueue:
+    """
+    File de traitement durable des tickets, stockée dans un fichier SQLite.
+
+    L'application Flask y dépose les uploads, et un ou plusieurs workers
+    (voir worker.py) les récupèrent. Plusieurs processus, éventuellement sur
+    d'autres machines partageant le même fichier, peuvent consommer la file :
+    la réservation d'un job se fait dans une transaction BEGIN IMMEDIATE.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    # Colonnes renvoyées pour le suivi (sans le contenu des images en mémoire)
+    STATUS_COLUMNS = (
+        "job_id, status, filepath, filename, client_id, attempts, worker_id, created_at, "
+        "started_at, heartbeat_at, finished_at, result, error, batch_id"
+    )
+
+    def __init__(self, db_path='job_queue.sqlite', journal_mode=None, max_attempts=3):
+        """
+        Initialise la file et crée les tables si nécessaire
+
+        :param db_path: Chemin vers le fichier SQLite de la file
+        :param journal_mode: Mode de journalisation SQLite ('WAL' par défaut ;
+                             utiliser 'DELETE' si le fichier est sur un partage réseau)
+        :param max_attempts: Nombre maximal de tentatives avant d'abandonner un job
+        """
+        self.db_path = str(db_path)
+        self.journal_mode = journal_mode or os.getenv("JOB_QUEUE_JOURNAL_MODE", "WAL")
+        self.max_attempts = max_attempts
+        self.logger = logging.getLogger(__name__)
+        self._create_tables()
+
+    def _connect(self):
+        """Ouvre une connexion en mode autocommit (transactions explicites)"""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _create_tables(self):
+        """Crée les tables de la file si elles n'existent pas"""
+        conn = self._connect()
+        try:
+            conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    filepath TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    client_id INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker_id TEXT,
+                    created_at TEXT NOT NULL,
+                    started_at TEXT,
+                    heartbeat_at TEXT,
+                    finished_at TEXT,
+                    result TEXT,
+                    error TEXT,
+                    batch_id TEXT,
+                    payload BLOB
+                )
+            """)
+            # Files créées avant l'ajout des lots et des uploads en mémoire
+            columns = [row['name'] for row in conn.execute("PRAGMA table_info(jobs)").fetchall()]
+            if 'batch_id' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN batch_id TEXT")
+            if 'payload' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN payload BLOB")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id, status)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS job_stages (
+                    stage_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    duration_ms INTEGER,
+                    detail TEXT,
+                    created_at TEXT NOT NULL,
+                    FOREIGN KEY (job_id) REFERENCES jobs(job_id)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_job_stages_job ON job_stages(job_id, stage_id)")
+            # Indicateurs publiés périodiquement par chaque processus worker (pools, compteurs)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS worker_stats (
+                    worker_id TEXT PRIMARY KEY,
+                    stats TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            """)
+        finally:
+            conn.close()
+
+    def enqueue(self, filepath, filename, client_id=None, batch_id=None, payload=None):
+        """
+        Ajoute un ticket à traiter dans la file
+
+        :param filepath: Chemin de l'image sauvegardée ('' si l'image est transmise dans payload)
+        :param filename: Nom du fichier dans le dossier d'upload
+        :param client_id: ID du client connecté (optionnel)
+        :param batch_id: ID du lot d'upload auquel appartient le ticket (optionnel)
+        :param payload: Contenu de l'image pour les uploads en mémoire (optionnel)
+        :return: ID du job créé
+        """
+        job_id = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute(
+                """INSERT INTO jobs (job_id, status, filepath, filename, client_id, created_at, batch_id, payload)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (job_id, self.STATUS_QUEUED, filepath, filename, client_id, datetime.now().isoformat(), batch_id,
+                 sqlite3.Binary(payload) if payload is not None else None)
+            )
+        finally:
+            conn.close()
+        self.logger.info(f"Job {job_id} ajouté à la file pour {filename}")
+        return job_id
+
+    def claim(self, worker_id):
+        """
+        Réserve le plus ancien job en attente pour un worker
+
+        :param worker_id: Identifiant du worker (hôte/pid)
+        :return: Dictionnaire du job réservé ou None si la file est vide
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1",
+                (self.STATUS_QUEUED,)
+            ).fetchone()
+            if not row:
+                conn.execute("COMMIT")
+                return None
+
+            now = datetime.now().isoformat()
+            conn.execute(
+                """UPDATE jobs SET status = ?, worker_id = ?, started_at = ?, heartbeat_at = ?,
+                   attempts = attempts + 1 WHERE job_id = ?""",
+                (self.STATUS_RUNNING, worker_id, now, now, row['job_id'])
+            )
+            conn.execute("COMMIT")
+
+            job = dict(row)
+            job.update(status=self.STATUS_RUNNING, worker_id=worker_id, started_at=now,
+                       attempts=row['attempts'] + 1)
+            return job
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def claim_batch(self, worker_id, limit=50):
+        """
+        Réserve le plus ancien job en attente et, s'il fait partie d'un lot,
+        les autres jobs en attente du même lot
+
+        :param worker_id: Identifiant du worker (hôte/pid)
+        :param limit: Nombre maximal de jobs réservés
+        :return: Liste des jobs réservés (vide si la file est vide)
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            first = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1",
+                (self.STATUS_QUEUED,)
+            ).fetchone()
+            if not first:
+                conn.execute("COMMIT")
+                return []
+
+            rows = [first]
+            if first['batch_id'] and limit > 1:
+                rows += conn.execute(
+                    """SELECT * FROM jobs WHERE status = ? AND batch_id = ? AND job_id != ?
+                       ORDER BY created_at LIMIT ?""",
+                    (self.STATUS_QUEUED, first['batch_id'], first['job_id'], limit - 1)
+                ).fetchall()
+
+            now = datetime.now().isoformat()
+            conn.executemany(
+                """UPDATE jobs SET status = ?, worker_id = ?, started_at = ?, heartbeat_at = ?,
+                   attempts = attempts + 1 WHERE job_id = ?""",
+                [(self.STATUS_RUNNING, worker_id, now, now, row['job_id']) for row in rows]
+            )
+            conn.execute("COMMIT")
+
+            jobs = []
+            for row in rows:
+                job = dict(row)
+                job.update(status=self.STATUS_RUNNING, worker_id=worker_id, started_at=now,
+                           attempts=row['attempts'] + 1)
+                jobs.append(job)
+            return jobs
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def record_stage(self, job_id, stage, status, duration_ms=None, detail=None):
+        """
+        Enregistre la fin d'une étape de traitement et rafraîchit le heartbeat du job
+
+        :param job_id: ID du job
+        :param stage: Nom de l'étape (voir ReceiptPipeline.STAGES)
+        :param status: Statut de l'étape ('done', 'failed', 'skipped', 'timeout')
+        :param duration_ms: Durée de l'étape en millisecondes
+        :param detail: Informations complémentaires (dict)
+        """
+        now = datetime.now().isoformat()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO job_stages (job_id, stage, status, duration_ms, detail, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, stage, status, duration_ms, json.dumps(detail or {}, default=str), now)
+            )
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?", (now, job_id))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def heartbeat(self, job_ids):
+        """
+        Rafraîchit le heartbeat de jobs réservés (jobs d'un lot en attente dans le pool)
+
+        :param job_ids: Liste d'IDs de jobs
+        """
+        conn = self._connect()
+        try:
+            conn.executemany(
+                "UPDATE jobs SET heartbeat_at = ? WHERE job_id = ? AND status = ?",
+                [(datetime.now().isoformat(), job_id, self.STATUS_RUNNING) for job_id in job_ids]
+            )
+        finally:
+            conn.close()
+
+    def complete(self, job_id, result):
+        """
+        Marque un job comme terminé
+
+        :param job_id: ID du job
+        :param result: Résultat du pipeline (dict)
+        """
+        conn = self._connect()
+        try:
+            # L'image a été envoyée dans GCS : son contenu n'est plus utile dans la file
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = NULL, payload = NULL WHERE job_id = ?",
+                (self.STATUS_DONE, datetime.now().isoformat(), json.dumps(result, default=str), job_id)
+            )
+        finally:
+            conn.close()
+
+    def fail(self, job_id, error, retry=True):
+        """
+        Marque un job en échec, ou le remet en file s'il reste des tentatives
+
+        :param job_id: ID du job
+        :param error: Message d'erreur
+        :param retry: Autoriser une nouvelle tentative
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT attempts FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row and retry and row['attempts'] < self.max_attempts:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker_id = NULL, error = ? WHERE job_id = ?",
+                    (self.STATUS_QUEUED, error, job_id)
+                )
+            else:
+                # Échec définitif : le contenu de l'image ne sera plus relu
+                conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ?, error = ?, payload = NULL WHERE job_id = ?",
+                    (self.STATUS_FAILED, datetime.now().isoformat(), error, job_id)
+                )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def requeue_stale(self, lease_seconds=600):
+        """
+        Remet en file les jobs dont le worker ne donne plus signe de vie
+
+        :param lease_seconds: Délai sans heartbeat au-delà duquel un job est considéré abandonné
+        :return: Nombre de jobs remis en file ou abandonnés
+        """
+        limit = (datetime.now() - timedelta(seconds=lease_seconds)).isoformat()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            failed = conn.execute(
+                """UPDATE jobs SET status = ?, finished_at = ?, error = 'Worker lease expired', payload = NULL
+                   WHERE status = ? AND heartbeat_at < ? AND attempts >= ?""",
+                (self.STATUS_FAILED, datetime.now().isoformat(), self.STATUS_RUNNING, limit, self.max_attempts)
+            ).rowcount
+            requeued = conn.execute(
+                "UPDATE jobs SET status = ?, worker_id = NULL WHERE status = ? AND heartbeat_at < ?",
+                (self.STATUS_QUEUED, self.STATUS_RUNNING, limit)
+            ).rowcount
+            conn.execute("COMMIT")
+            changed = failed + requeued
+        finally:
+            conn.close()
+        if changed:
+            self.logger.warning(f"{changed} job(s) abandonné(s) remis en file ou marqués en échec")
+        return changed
+
+    def get_job(self, job_id):
+        """
+        Récupère l'état d'un job
+
+        :param job_id: ID du job
+        :return: Dictionnaire du job (avec le résultat décodé) ou None
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT {self.STATUS_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def get_batch(self, batch_id):
+        """
+        Récupère l'état des jobs d'un lot
+
+        :param batch_id: ID du lot
+        :return: Liste des jobs du lot (avec le résultat décodé), dans l'ordre d'envoi
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT {self.STATUS_COLUMNS} FROM jobs WHERE batch_id = ? ORDER BY created_at, rowid", (batch_id,)
+            ).fetchall()
+        finally:
+            conn.close()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job['result'] = json.loads(job['result']) if job['result'] else None
+            jobs.append(job)
+        return jobs
+
+    def get_stages(self, job_id, after_stage_id=0):
+        """
+        Liste les étapes enregistrées pour un job
+
+        :param job_id: ID du job
+        :param after_stage_id: Ne renvoyer que les étapes postérieures à cet ID
+        :return: Liste de dictionnaires d'étapes
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT * FROM job_stages WHERE job_id = ? AND stage_id > ? ORDER BY stage_id",
+                (job_id, after_stage_id)
+            ).fetchall()
+        finally:
+            conn.close()
+        stages = []
+        for row in rows:
+            stage = dict(row)
+            stage['detail'] = json.loads(stage['detail']) if stage['detail'] else {}
+            stages.append(stage)
+        return stages
+
+    def report_worker_stats(self, worker_id, stats):
+        """
+        Publie les indicateurs d'un processus worker (remplace sa publication précédente)
+
+        :param worker_id: Identifiant du processus (hôte:pid)
+        :param stats: Indicateurs du processus (dict)
+        """
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO worker_stats (worker_id, stats, updated_at) VALUES (?, ?, ?)",
+                (worker_id, json.dumps(stats, default=str), datetime.now().isoformat())
+            )
+        finally:
+            conn.close()
+
+    def worker_stats(self, max_age_seconds=30):
+        """
+        Derniers indicateurs publiés par les processus worker encore actifs
+
+        :param max_age_seconds: Âge au-delà duquel une publication est ignorée (worker arrêté)
+        :return: Dictionnaire {worker_id: indicateurs}
+        """
+        limit = (datetime.now() - timedelta(seconds=max_age_seconds)).isoformat()
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT worker_id, stats FROM worker_stats WHERE updated_at >= ? ORDER BY worker_id", (limit,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return {row['worker_id']: json.loads(row['stats']) for row in rows}
+
+    def depth(self):
+        """
+        Compte les jobs par statut
+
+        :return: Dictionnaire {statut: nombre}
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        finally:
+            conn.close()
+        counts = {self.STATUS_QUEUED: 0, self.STATUS_RUNNING: 0, self.STATUS_DONE: 0, self.STATUS_FAILED: 0}
+        counts.update({row['status']: row['n'] for row in rows})
+        return counts
+
+    def backlog(self):
+        """
+        Nombre de jobs en attente ou en cours (contrôle d'admission des uploads)
+
+        :return: Nombre de jobs
+        """
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)",
+                (self.STATUS_QUEUED, self.STATUS_RUNNING)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+
+    def llm_usage(self, since=None):
+        """
+        Consommation Mistral par mode (two_call / single_call), calculée à partir
+        des détails d'étapes enregistrés par les workers
+
+        :param since: Date ISO à partir de laquelle compter (optionnelle)
+        :return: Dictionnaire {mode: {receipts, calls, jetons et latence moyens}}
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                """SELECT json_extract(detail, '$.llm_mode') AS mode,
+                          COUNT(DISTINCT job_id) AS receipts,
+                          SUM(COALESCE(json_extract(detail, '$.calls'), 0)) AS calls,
+                          SUM(COALESCE(json_extract(detail, '$.prompt_tokens'), 0)) AS prompt_tokens,
+                          SUM(COALESCE(json_extract(detail, '$.completion_tokens'), 0)) AS completion_tokens,
+                          SUM(COALESCE(json_extract(detail, '$.latency_ms'), 0)) AS latency_ms
+                   FROM job_stages
+                   WHERE stage IN ('mistral_clean', 'mistral_classify') AND status = 'done'
+                     AND json_extract(detail, '$.llm_mode') IS NOT NULL AND created_at >= ?
+                   GROUP BY mode""",
+                (since or '',)
+            ).fetchall()
+        finally:
+            conn.close()
+        usage = {}
+        for row in rows:
+            receipts = row['receipts'] or 1
+            usage[row['mode']] = {
+                "receipts": row['receipts'],
+                "calls": row['calls'],
+                "prompt_tokens": row['prompt_tokens'],
+                "completion_tokens": row['completion_tokens'],
+                "avg_prompt_tokens": round(row['prompt_tokens'] / receipts, 1),
+                "avg_completion_tokens": round(row['completion_tokens'] / receipts, 1),
+                "avg_latency_ms": round(row['latency_ms'] / receipts, 1)
+            }
+        return usage
+
+    def processing_tiers(self, since=None):
+        """
+        Nombre de tickets traités à chaque niveau (complet ou dégradé, voir degradation.py)
+
+        :param since: Date ISO à partir de laquelle compter (optionnelle)
+        :return: Dictionnaire {niveau: nombre de tickets}
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                """SELECT json_extract(detail, '$.processing_tier') AS tier, COUNT(DISTINCT job_id) AS receipts
+                   FROM job_stages
+                   WHERE stage = 'mistral_classify' AND json_extract(detail, '$.processing_tier') IS NOT NULL
+                     AND created_at >= ?
+                   GROUP BY tier""",
+                (since or '',)
+            ).fetchall()
+        finally:
+            conn.close()
+        return {row['tier']: row['receipts'] for row in rows}
+
+    def classification_outcomes(self, since=None):
+        """
+        Nombre de tickets par issue de l'étape mistral_classify : statut de l'appel Mistral
+        ('done', 'timeout', ...) ou raison pour laquelle il a été sauté ('rules', 'degraded', ...)
+
+        :param since: Date ISO à partir de laquelle compter (optionnelle)
+        :return: Dictionnaire {issue: nombre de tickets}
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                """SELECT CASE WHEN status = 'skipped'
+                               THEN COALESCE(json_extract(detail, '$.reason'), 'skipped')
+                               ELSE status END AS outcome,
+                          COUNT(DISTINCT job_id) AS receipts
+                   FROM job_stages
+                   WHERE stage = 'mistral_classify' AND created_at >= ?
+                   GROUP BY outcome""",
+                (since or '',)
+            ).fetchall()
+        finally:
+            conn.close()
+        return {row['outcome']: row['receipts'] for row in rows}
@@ -1,10 +1,109 @@
 import os
+import asyncio
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import re
+import time
 import logging
-from typing import Dict, Any, Optional
+import threading
+from typing import Dict, Any, List, Optional
 from dotenv import load_dotenv
+from deadline import Deadline
+from result_cache import PromptCache
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+
+class LLMUsageTracker:
+    """
+    Cumulative token counts and latency of LLM calls, grouped by pipeline mode
+    ("two_call" or "single_call") so both modes can be compared.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._modes = {}
+
+    def record(self, mode: str, usage: Dict[str, Any], calls: int = 1):
+        """
+        Add one receipt processed in the given mode.
+
+        Args:
+            mode: Pipeline mode name.
+            usage: Dict with prompt_tokens, completion_tokens and latency_ms.
+            calls: Number of API calls made for this receipt.
+        """
+        with self._lock:
+            stats = self._modes.setdefault(mode, {
+                "receipts": 0, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms": 0
+            })
+            stats["receipts"] += 1
+            stats["calls"] += calls
+            for key in ("prompt_tokens", "completion_tokens", "latency_ms"):
+                stats[key] += usage.get(key, 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return totals and per-receipt averages for each mode."""
+        with self._lock:
+            modes = {mode: dict(stats) for mode, stats in self._modes.items()}
+        for stats in modes.values():
+            receipts = stats["receipts"] or 1
+            stats["avg_prompt_tokens"] = round(stats["prompt_tokens"] / receipts, 1)
+            stats["avg_completion_tokens"] = round(stats["completion_tokens"] / receipts, 1)
+            stats["avg_latency_ms"] = round(stats["latency_ms"] / receipts, 1)
+        return modes
+
+
+class TokenRateLimiter:
+    """
+    Token bucket limiting the tokens sent to the API per minute.
+    
+    A request reserves an estimate of its prompt tokens before it is sent; the tokens
+    actually used (prompt and completion) are charged once the response arrives, so
+    the bucket may go negative and hold back the following requests. The bucket is
+    kept across event loops, so successive generate_many() runs share the same budget;
+    only its lock is bound to the running loop.
+    """
+    def __init__(self, tokens_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self._available = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._loop = None
+        self._lock = None
+
+    def _loop_lock(self) -> asyncio.Lock:
+        """Return the lock of the running event loop, created on its first use."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(self.tokens_per_minute,
+                              self._available + (now - self._updated) * self.tokens_per_minute / 60)
+        self._updated = now
+
+    async def acquire(self, tokens: int):
+        """Wait until the bucket holds the given tokens, then take them."""
+        # A request larger than the bucket waits for a full bucket instead of forever
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._loop_lock():
+            self._refill()
+            while self._available < tokens:
+                await asyncio.sleep((tokens - self._available) * 60 / self.tokens_per_minute)
+                self._refill()
+            self._available -= tokens
+
+    def charge(self, tokens: int):
+        """Take (or give back, if negative) tokens without waiting."""
+        self._refill()
+        self._available -= tokens
 
 
 class MistralLLMService:
@@ -29,17 +128,194 @@ class MistralLLMService:
         
         # Request timeout in seconds
         self.timeout = 30
+        # Minimum time left on a deadline worth starting another attempt
+        self.min_attempt_seconds = 2
+        
+        # Keep-alive session shared by the worker threads: connections to the API are
+        # reused instead of paying a TCP and TLS handshake on every call. One connection
+        # per LLM pool thread by default, so no call waits for another to release one
+        self.pool_size = int(os.getenv("MISTRAL_POOL_SIZE", os.getenv("LLM_POOL_SIZE", "8")))
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+        self.session.headers.update(self._headers())
+        
+        # Async client for the bulk paths: requests in flight per event loop and tokens
+        # per minute (0 for no limit) across all the loops of the service
+        self.async_concurrency = int(os.getenv("MISTRAL_ASYNC_CONCURRENCY", "16"))
+        self.tokens_per_minute = int(os.getenv("MISTRAL_TOKENS_PER_MINUTE", "0"))
+        self._rate_limiter = TokenRateLimiter(self.tokens_per_minute) if self.tokens_per_minute > 0 else None
+        
+        # Persistent cache of the responses to identical prompts (PROMPT_CACHE_ENABLED=false to disable)
+        self.prompt_cache = None
+        if os.getenv("PROMPT_CACHE_ENABLED", "true").lower() == "true":
+            try:
+                self.prompt_cache = PromptCache()
+            except Exception as e:
+                self.logger.error(f"Prompt cache unavailable: {str(e)}")
+        self.async_available = AIOHTTP_AVAILABLE
+        self._async_loop = None
+        self._async_session = None
+        self._async_semaphore = None
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
 
-    def generate(self, prompt: str, max_tokens: int = 3000, temperature: float = 0.3) -> Optional[str]:
+    def _payload(self, prompt: str, max_tokens: int, temperature: float, model: Optional[str]) -> Dict[str, Any]:
+        """Build the chat completion request body."""
+        return {
+            "model": model or self.model,
+            "messages": [{
+                "role": "user",
+                "content": prompt
+            }],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "response_format": {"type": "text"}
+        }
+
+    def _read_response(self, response_data: Dict[str, Any], usage: Dict[str, Any]) -> str:
+        """Extract the generated text of a response, adding its token counts to usage."""
+        self.logger.debug(f"API response structure: {json.dumps(response_data, indent=2)}")
+        
+        # Token usage reported by the API
+        api_usage = response_data.get("usage") or {}
+        usage["prompt_tokens"] += api_usage.get("prompt_tokens", 0)
+        usage["completion_tokens"] += api_usage.get("completion_tokens", 0)
+        
+        # Extract content from response
+        content = response_data.get("choices", [{}])[0].get("message", {}).get("content", "")
+        
+        # Clean content (remove whitespace, tabs, etc.)
+        content = content.strip()
+        
+        if not content:
+            self.logger.warning("Empty content returned from API, using mock response")
+            content = '{"error": "Empty response", "status": "error"}'
+        
+        return content
+
+    def connection_stats(self) -> Dict[str, Any]:
+        """
+        Return connection reuse statistics of the API session.
+        
+        Returns:
+            A dict with the pool size, the HTTP requests sent, the connections opened
+            and the share of requests that reused an open connection.
+        """
+        pool = self._adapter.poolmanager.connection_from_url(self.api_endpoint)
+        sent, opened = pool.num_requests, pool.num_connections
+        return {
+            "pool_size": self.pool_size,
+            "requests": sent,
+            "connections_opened": opened,
+            "reused": max(0, sent - opened),
+            "reuse_ratio": round(max(0, sent - opened) / sent, 3) if sent else 0.0
+        }
+
+    @staticmethod
+    def merge_connection_stats(reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Sum the connection_stats() reports published by several worker processes.
+        
+        Args:
+            reports: connection_stats() dicts, one per process
+        
+        Returns:
+            A dict in the connection_stats() format with the number of processes.
+        """
+        sent = sum(report.get("requests", 0) for report in reports)
+        reused = sum(report.get("reused", 0) for report in reports)
+        return {
+            "pool_size": max((report.get("pool_size", 0) for report in reports), default=0),
+            "requests": sent,
+            "connections_opened": sum(report.get("connections_opened", 0) for report in reports),
+            "reused": reused,
+            "reuse_ratio": round(reused / sent, 3) if sent else 0.0,
+            "workers": len(reports)
+        }
+
+    def close(self):
+        """Close the pooled connections of the API session."""
+        self.session.close()
+
+    def _cached_result(self, prompt: str, max_tokens: int, temperature: float, model: Optional[str],
+                       use_cache: bool) -> Optional[Dict[str, Any]]:
+        """Return a generate_with_usage() result for a cached response, or None on a miss."""
+        if self.prompt_cache is None or not use_cache or not self.api_key or not isinstance(prompt, str):
+            return None
+        content = self.prompt_cache.get_response(model or self.model, temperature, max_tokens, prompt)
+        if content is None:
+            return None
+        self.logger.info("Mistral response found in the prompt cache")
+        return {"content": content, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms": 0, "cached": True}
+
+    def _store_result(self, prompt: str, max_tokens: int, temperature: float, model: Optional[str],
+                      use_cache: bool, result: Dict[str, Any]):
+        """Cache a successful response; error responses are never cached."""
+        if self.prompt_cache is None or not use_cache or not self.api_key or not result["content"]:
+            return
+        try:
+            error = json.loads(result["content"]).get("status") == "error"
+        except (ValueError, AttributeError):
+            error = False
+        if not error:
+            self.prompt_cache.put_response(model or self.model, temperature, max_tokens, prompt, result["content"])
+
+    def generate(self, prompt: str, max_tokens: int = 3000, temperature: float = 0.3,
+                 deadline: Optional[Deadline] = None, model: Optional[str] = None,
+                 use_cache: bool = True) -> Optional[str]:
         """
         Generate text using the Mistral AI API.
         
         Args:
             prompt: The text prompt to send to the API.
+            deadline: Optional time budget; each attempt is capped by the time left
+                and no retry starts once it runs out.
+            model: Optional model overriding the service default for this call.
+            use_cache: False to bypass the prompt cache and always call the API.
             
         Returns:
             The generated text response.
         """
+        return self.generate_with_usage(prompt, max_tokens=max_tokens, temperature=temperature,
+                                        deadline=deadline, model=model, use_cache=use_cache)["content"]
+
+    def generate_with_usage(self, prompt: str, max_tokens: int = 3000, temperature: float = 0.3,
+                            deadline: Optional[Deadline] = None, model: Optional[str] = None,
+                            use_cache: bool = True) -> Dict[str, Any]:
+        """
+        Generate text using the Mistral AI API and report token usage and latency.
+        
+        Args:
+            prompt: The text prompt to send to the API.
+            deadline: Optional time budget shared with the rest of the pipeline.
+            model: Optional model overriding the service default for this call.
+            use_cache: False to bypass the prompt cache and always call the API.
+            
+        Returns:
+            A dict with the generated "content", "prompt_tokens" and "completion_tokens"
+            as reported by the API, and "latency_ms" including retries. A response
+            served from the prompt cache has "cached": True and no tokens.
+        """
+        cached = self._cached_result(prompt, max_tokens, temperature, model, use_cache)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
+        result = {"content": None, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms": 0}
+        result["content"] = self._generate(prompt, max_tokens, temperature, result, deadline, model)
+        result["latency_ms"] = int((time.monotonic() - started) * 1000)
+        self._store_result(prompt, max_tokens, temperature, model, use_cache, result)
+        return result
+
+    def _generate(self, prompt: str, max_tokens: int, temperature: float, usage: Dict[str, Any],
+                  deadline: Optional[Deadline] = None, model: Optional[str] = None) -> Optional[str]:
+        """Send the request with retries, adding the token counts of each response to usage."""
         if not self.api_key:
             mock_response = '{"error": "API key not configured", "status": "error"}'
             self.logger.warning("Using mock response due to missing API key")
@@ -55,33 +331,22 @@ class MistralLLMService:
         retries = 0
         
         while retries <= max_retries:
+            # Stop retrying once the caller's time budget is spent
+            timeout = self.timeout
+            if deadline is not None:
+                if not deadline.allows(self.min_attempt_seconds):
+                    self.logger.error(f"Deadline exceeded before Mistral API attempt {retries + 1}")
+                    return '{"error": "Deadline exceeded", "status": "error"}'
+                timeout = min(self.timeout, deadline.remaining())
+            
             try:
                 self.logger.info(f"Sending request to Mistral API (attempt {retries + 1}/{max_retries + 1})")
                 
-                # Prepare the payload
-                payload = {
-                    "model": self.model,
-                    "messages": [{
-                        "role": "user",
-                        "content": prompt
-                    }],
-                    "temperature": temperature,
-                    "max_tokens": max_tokens,
-                    "response_format": {"type": "text"}
-                }
-                
-                headers = {
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {self.api_key}"
-                }
-                
-                # Make the API call with timeout
-                response = requests.post(
+                # Make the API call with timeout, on a pooled keep-alive connection
+                response = self.session.post(
                     self.api_endpoint,
-                    headers=headers,
-                    json=payload,
-                    timeout=self.timeout
+                    json=self._payload(prompt, max_tokens, temperature, model),
+                    timeout=timeout
                 )
                 
                 # Check response status
@@ -98,20 +363,7 @@ class MistralLLMService:
                 
                 # Parse response
                 try:
-                    response_data = response.json()
-                    self.logger.debug(f"API response structure: {json.dumps(response_data, indent=2)}")
-                    
-                    # Extract content from response
-                    content = response_data.get("choices", [{}])[0].get("message", {}).get("content", "")
-                    
-                    # Clean content (remove whitespace, tabs, etc.)
-                    content = content.strip()
-                    
-                    if not content:
-                        self.logger.warning("Empty content returned from API, using mock response")
-                        content = '{"error": "Empty response", "status": "error"}'
-                    
-                    return content
+                    return self._read_response(response.json(), usage)
                     
                 except (json.JSONDecodeError, KeyError, IndexError) as e:
                     self.logger.error(f"Error parsing API response: {str(e)}")
@@ -125,11 +377,11 @@ class MistralLLMService:
                     retries += 1
             
             except requests.exceptions.Timeout:
-                self.logger.error(f"API request timed out after {self.timeout} seconds")
+                self.logger.error(f"API request timed out after {timeout:.1f} seconds")
                 
                 # If we've hit the retry limit, return error
                 if retries >= max_retries:
-                    return f'{{"error": "Request timed out after {self.timeout} seconds", "status": "error"}}'
+                    return f'{{"error": "Request timed out after {timeout:.1f} seconds", "status": "error"}}'
                 
                 # Otherwise retry
                 retries += 1
@@ -148,6 +400,174 @@ class MistralLLMService:
                 self.logger.error(f"Unexpected error: {str(e)}")
                 return f'{{"error": "Unexpected error: {str(e)}", "status": "error"}}'
             
+    def _async_state(self):
+        """Return the aiohttp session, semaphore and rate limiter of the running event loop."""
+        if not AIOHTTP_AVAILABLE:
+            raise RuntimeError("aiohttp is required for the async Mistral client (pip install aiohttp)")
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            # Sessions and semaphores are bound to the loop they were created in; the session
+            # of another loop can only be closed from that loop (see run_async() and aclose())
+            if self._async_session is not None and not self._async_session.closed:
+                raise RuntimeError("The aiohttp session of a previous event loop is still open; "
+                                   "await aclose() before leaving that loop")
+            self._async_loop = loop
+            self._async_session = aiohttp.ClientSession(
+                headers=self._headers(),
+                connector=aiohttp.TCPConnector(limit=self.async_concurrency)
+            )
+            self._async_semaphore = asyncio.Semaphore(self.async_concurrency)
+        return self._async_session, self._async_semaphore, self._rate_limiter
+
+    async def aclose(self):
+        """Close the aiohttp session of the running event loop."""
+        if self._async_session is not None and self._async_loop is asyncio.get_running_loop():
+            await self._async_session.close()
+        self._async_loop = self._async_session = self._async_semaphore = None
+
+    async def agenerate(self, prompt: str, max_tokens: int = 3000, temperature: float = 0.3,
+                        deadline: Optional[Deadline] = None, model: Optional[str] = None,
+                        use_cache: bool = True) -> Optional[str]:
+        """
+        Async counterpart of generate(), for the bulk paths.
+        
+        At most MISTRAL_ASYNC_CONCURRENCY requests are in flight per event loop and,
+        when MISTRAL_TOKENS_PER_MINUTE is set, requests wait for token budget.
+        
+        Returns:
+            The generated text response.
+        """
+        result = await self.agenerate_with_usage(prompt, max_tokens=max_tokens, temperature=temperature,
+                                                 deadline=deadline, model=model, use_cache=use_cache)
+        return result["content"]
+
+    async def agenerate_with_usage(self, prompt: str, max_tokens: int = 3000, temperature: float = 0.3,
+                                   deadline: Optional[Deadline] = None, model: Optional[str] = None,
+                                   use_cache: bool = True) -> Dict[str, Any]:
+        """Async counterpart of generate_with_usage(); latency includes the wait for a slot."""
+        cached = self._cached_result(prompt, max_tokens, temperature, model, use_cache)
+        if cached is not None:
+            return cached
+        started = time.monotonic()
+        result = {"content": None, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms": 0}
+        result["content"] = await self._agenerate(prompt, max_tokens, temperature, result, deadline, model)
+        result["latency_ms"] = int((time.monotonic() - started) * 1000)
+        self._store_result(prompt, max_tokens, temperature, model, use_cache, result)
+        return result
+
+    async def agenerate_many(self, prompts: List[str], max_tokens: int = 3000, temperature: float = 0.3,
+                             model: Optional[str] = None, use_cache: bool = True) -> List[Dict[str, Any]]:
+        """
+        Send prompts concurrently, within the concurrency and token-rate limits.
+        
+        Returns:
+            One agenerate_with_usage() result per prompt, in the order of the prompts.
+        """
+        return await asyncio.gather(*(
+            self.agenerate_with_usage(prompt, max_tokens=max_tokens, temperature=temperature, model=model,
+                                      use_cache=use_cache)
+            for prompt in prompts
+        ))
+
+    def run_async(self, coroutine):
+        """
+        Run a coroutine using the async client from synchronous code, then close its session.
+        
+        Must not be called from a thread that already runs an event loop.
+        """
+        async def run():
+            try:
+                return await coroutine
+            finally:
+                await self.aclose()
+        return asyncio.run(run())
+
+    def generate_many(self, prompts: List[str], max_tokens: int = 3000, temperature: float = 0.3,
+                      model: Optional[str] = None, use_cache: bool = True) -> List[Dict[str, Any]]:
+        """Blocking wrapper of agenerate_many() for scripts and batch jobs."""
+        return self.run_async(self.agenerate_many(prompts, max_tokens=max_tokens, temperature=temperature,
+                                                  model=model, use_cache=use_cache))
+
+    async def _agenerate(self, prompt: str, max_tokens: int, temperature: float, usage: Dict[str, Any],
+                         deadline: Optional[Deadline] = None, model: Optional[str] = None) -> Optional[str]:
+        """Async counterpart of _generate(), with the same retries and error responses."""
+        if not self.api_key:
+            self.logger.warning("Using mock response due to missing API key")
+            return '{"error": "API key not configured", "status": "error"}'
+            
+        if not prompt or not isinstance(prompt, str):
+            self.logger.error(f"Invalid prompt: {type(prompt)}")
+            return '{"error": "Invalid prompt", "status": "error"}'
+        
+        session, semaphore, rate_limiter = self._async_state()
+        max_retries = 2
+        retries = 0
+        
+        async with semaphore:
+            # About four characters per token, reserved once for all the attempts; the real
+            # count is charged after the response, and the reservation given back on failure
+            estimate = len(prompt) // 4 + 1
+            reserved = 0
+            if rate_limiter is not None:
+                await rate_limiter.acquire(estimate)
+                reserved = estimate
+            
+            try:
+                while retries <= max_retries:
+                    timeout = self.timeout
+                    if deadline is not None:
+                        if not deadline.allows(self.min_attempt_seconds):
+                            self.logger.error(f"Deadline exceeded before Mistral API attempt {retries + 1}")
+                            return '{"error": "Deadline exceeded", "status": "error"}'
+                        timeout = min(self.timeout, deadline.remaining())
+                    
+                    try:
+                        self.logger.info(f"Sending async request to Mistral API (attempt {retries + 1}/{max_retries + 1})")
+                        async with session.post(self.api_endpoint,
+                                                json=self._payload(prompt, max_tokens, temperature, model),
+                                                timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                            if response.status != 200:
+                                self.logger.error(f"API request failed with status code {response.status}: "
+                                                  f"{await response.text()}")
+                                if retries >= max_retries:
+                                    return f'{{"error": "Request failed with status code {response.status}", "status": "error"}}'
+                                retries += 1
+                                continue
+                            
+                            try:
+                                tokens_before = usage["prompt_tokens"] + usage["completion_tokens"]
+                                content = self._read_response(await response.json(content_type=None), usage)
+                                if rate_limiter is not None:
+                                    rate_limiter.charge(usage["prompt_tokens"] + usage["completion_tokens"]
+                                                        - tokens_before - estimate)
+                                    reserved = 0
+                                return content
+                            
+                            except (json.JSONDecodeError, KeyError, IndexError) as e:
+                                self.logger.error(f"Error parsing API response: {str(e)}")
+                                if retries >= max_retries:
+                                    return f'{{"error": "Error parsing response: {str(e)}", "status": "error"}}'
+                                retries += 1
+                    
+                    except asyncio.TimeoutError:
+                        self.logger.error(f"API request timed out after {timeout:.1f} seconds")
+                        if retries >= max_retries:
+                            return f'{{"error": "Request timed out after {timeout:.1f} seconds", "status": "error"}}'
+                        retries += 1
+                    
+                    except aiohttp.ClientError as e:
+                        self.logger.error(f"API request error: {str(e)}")
+                        if retries >= max_retries:
+                            return f'{{"error": "Request error: {str(e)}", "status": "error"}}'
+                        retries += 1
+                    
+                    except Exception as e:
+                        self.logger.error(f"Unexpected error: {str(e)}")
+                        return f'{{"error": "Unexpected error: {str(e)}", "status": "error"}}'
+            finally:
+                if reserved:
+                    rate_limiter.charge(-reserved)
+            
     def _generate_mock_response(self, prompt: str) -> str:
         """Generate mock responses for testing when API is unavailable"""
         print("USING MOCK RESPONSE - NO ACTUAL API CALL MADE")
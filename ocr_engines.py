@@ -0,0 +1,278 @@
+import os
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pytesseract
+
+try:
+    from tesserocr import PyTessBaseAPI, OEM, RIL, iterate_level
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    TESSEROCR_AVAILABLE = False
+
+# Caractères reconnus sur un ticket de caisse
+TESSERACT_WHITELIST = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz,.€/:-"
+TESSERACT_DPI = 300
+
+# Moteurs disponibles (variable OCR_ENGINE) ; 'auto' choisit tesserocr s'il est installé
+OCR_ENGINES = ("auto", "tesserocr", "pytesseract")
+
+
+def group_lines(words: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Regroupe les mots reconnus par ligne du ticket
+
+    :param words: Mots dans l'ordre de lecture (text, conf, left, top, width, height, line)
+    :return: Lignes compactes {"text", "conf", "bbox": [x, y, largeur, hauteur],
+             "words": [[texte, confiance, x, y, largeur, hauteur], ...]}
+    """
+    grouped = {}
+    for word in words:
+        grouped.setdefault(word["line"], []).append(word)
+    lines = []
+    for line_words in grouped.values():
+        left = min(w["left"] for w in line_words)
+        top = min(w["top"] for w in line_words)
+        right = max(w["left"] + w["width"] for w in line_words)
+        bottom = max(w["top"] + w["height"] for w in line_words)
+        lines.append({
+            "text": " ".join(w["text"] for w in line_words),
+            "conf": round(sum(w["conf"] for w in line_words) / len(line_words), 1),
+            "bbox": [left, top, right - left, bottom - top],
+            "words": [[w["text"], round(w["conf"], 1), w["left"], w["top"], w["width"], w["height"]]
+                      for w in line_words]
+        })
+    return lines
+
+
+def lines_to_text(lines: List[Dict[str, Any]]) -> str:
+    """Texte du ticket, une ligne par ligne reconnue"""
+    return "\n".join(line["text"] for line in lines)
+
+
+def merge_tile_lines(tiles: List[Tuple[int, int, int, List[Dict[str, Any]]]]) -> List[Dict[str, Any]]:
+    """
+    Fusionne les lignes reconnues sur des bandes horizontales qui se chevauchent
+
+    Chaque bande ne garde que les lignes dont le centre tombe dans sa zone propre
+    (limites au milieu des chevauchements) ; une ligne identique à la précédente et
+    à la même hauteur, lue deux fois de part et d'autre d'une limite, est écartée.
+
+    :param tiles: Bandes de haut en bas (décalage vertical, début et fin de la zone propre, lignes)
+                  en pixels de l'image entière
+    :return: Lignes dans les coordonnées de l'image entière
+    """
+    merged = []
+    for offset, keep_top, keep_bottom, lines in tiles:
+        for line in lines:
+            x, y, w, h = line["bbox"]
+            center = offset + y + h / 2
+            if not keep_top <= center < keep_bottom:
+                continue
+            if merged and merged[-1]["text"] == line["text"] and \
+                    abs(merged[-1]["bbox"][1] - (offset + y)) < max(h, merged[-1]["bbox"][3]):
+                continue
+            merged.append(dict(line, bbox=[x, offset + y, w, h],
+                               words=[[t, c, wx, offset + wy, ww, wh] for t, c, wx, wy, ww, wh in line["words"]]))
+    return merged
+
+
+def mean_confidence(lines: List[Dict[str, Any]]) -> float:
+    """Confiance moyenne des mots (0 sans mot reconnu)"""
+    confidences = [word[1] for line in lines for word in line["words"]]
+    return sum(confidences) / len(confidences) if confidences else 0.0
+
+
+class OCREngine:
+    """
+    Interface des moteurs de reconnaissance Tesseract.
+
+    recognize() reçoit une image déjà prétraitée (niveaux de gris, uint8) et un
+    mode de segmentation de page (PSM), et renvoie le texte brut.
+    """
+    name = "base"
+
+    def __init__(self, lang: str = 'fra', tessdata_path: Optional[str] = None):
+        """
+        :param lang: Langue Tesseract
+        :param tessdata_path: Dossier des fichiers .traineddata
+        """
+        self.lang = lang
+        self.tessdata_path = tessdata_path
+        self.logger = logging.getLogger(__name__)
+
+    def recognize(self, image: np.ndarray, psm: int = 4) -> str:
+        """
+        Reconnaissance d'une image prétraitée
+
+        :param image: Image en niveaux de gris
+        :param psm: Mode de segmentation de page Tesseract
+        :return: Texte brut
+        """
+        raise NotImplementedError
+
+    def recognize_layout(self, image: np.ndarray, psm: int = 4) -> List[Dict[str, Any]]:
+        """
+        Reconnaissance d'une image prétraitée, ligne par ligne avec les boîtes des mots
+
+        :param image: Image en niveaux de gris
+        :param psm: Mode de segmentation de page Tesseract
+        :return: Lignes au format de group_lines()
+        """
+        raise NotImplementedError
+
+    def recognize_with_confidence(self, image: np.ndarray, psm: int = 4) -> Tuple[str, float]:
+        """
+        Reconnaissance d'une image prétraitée avec la confiance moyenne des mots
+
+        :param image: Image en niveaux de gris
+        :param psm: Mode de segmentation de page Tesseract
+        :return: Tuple (texte une ligne par ligne du ticket, confiance moyenne entre 0 et 100, 0 sans mot reconnu)
+        """
+        lines = self.recognize_layout(image, psm)
+        return lines_to_text(lines), mean_confidence(lines)
+
+    def close(self):
+        """Libère les ressources du moteur"""
+
+
+class PytesseractEngine(OCREngine):
+    """
+    Moteur pytesseract : un processus tesseract par appel, qui recharge le modèle
+    de langue et relit l'image depuis un fichier temporaire. Toujours disponible.
+    """
+    name = "pytesseract"
+
+    def _config(self, psm: int) -> str:
+        """Options de la ligne de commande tesseract"""
+        if self.tessdata_path:
+            # S'assurer que la variable d'environnement est définie avant chaque appel
+            os.environ['TESSDATA_PREFIX'] = self.tessdata_path
+        return f'--oem 3 --psm {psm} -c tessedit_char_whitelist={TESSERACT_WHITELIST} --dpi {TESSERACT_DPI}'
+
+    def recognize(self, image: np.ndarray, psm: int = 4) -> str:
+        return pytesseract.image_to_string(image, lang=self.lang, config=self._config(psm))
+
+    def recognize_layout(self, image: np.ndarray, psm: int = 4) -> List[Dict[str, Any]]:
+        # Un seul passage image_to_data : mots avec leur boîte, leur confiance et leur ligne
+        data = pytesseract.image_to_data(image, lang=self.lang, config=self._config(psm),
+                                         output_type=pytesseract.Output.DICT)
+        words = []
+        for i, word in enumerate(data["text"]):
+            conf = float(data["conf"][i])
+            if not word.strip() or conf < 0:
+                continue
+            words.append({
+                "text": word.strip(), "conf": conf,
+                "left": data["left"][i], "top": data["top"][i],
+                "width": data["width"][i], "height": data["height"][i],
+                "line": (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            })
+        return group_lines(words)
+
+
+class TesserocrEngine(OCREngine):
+    """
+    Moteur tesserocr : l'API Tesseract reste initialisée en mémoire avec son modèle
+    de langue, et l'image lui est passée directement sans fichier temporaire.
+
+    L'API n'étant pas utilisable par plusieurs threads à la fois, chaque thread
+    (ou processus du pool OCR) garde sa propre instance, créée à son premier appel.
+    """
+    name = "tesserocr"
+
+    def __init__(self, lang: str = 'fra', tessdata_path: Optional[str] = None):
+        if not TESSEROCR_AVAILABLE:
+            raise ImportError("tesserocr n'est pas installé")
+        super().__init__(lang, tessdata_path)
+        self._local = threading.local()
+        self._apis = []
+        self._lock = threading.Lock()
+
+    def _api(self):
+        """API Tesseract du thread courant"""
+        api = getattr(self._local, "api", None)
+        if api is None:
+            kwargs = {"lang": self.lang, "oem": OEM.DEFAULT}
+            if self.tessdata_path:
+                kwargs["path"] = self.tessdata_path
+            api = PyTessBaseAPI(**kwargs)
+            api.SetVariable("tessedit_char_whitelist", TESSERACT_WHITELIST)
+            api.SetVariable("user_defined_dpi", str(TESSERACT_DPI))
+            self._local.api = api
+            with self._lock:
+                self._apis.append(api)
+            self.logger.info(f"API Tesseract initialisée pour le thread {threading.current_thread().name}")
+        return api
+
+    def _set_image(self, api, image: np.ndarray, psm: int):
+        """Passe les pixels de l'image à l'API, sans fichier intermédiaire"""
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        api.SetPageSegMode(psm)
+        api.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+
+    def recognize(self, image: np.ndarray, psm: int = 4) -> str:
+        api = self._api()
+        self._set_image(api, image, psm)
+        try:
+            return api.GetUTF8Text()
+        finally:
+            api.Clear()
+
+    def recognize_layout(self, image: np.ndarray, psm: int = 4) -> List[Dict[str, Any]]:
+        api = self._api()
+        self._set_image(api, image, psm)
+        try:
+            api.Recognize()
+            words = []
+            line = -1
+            # Parcours des mots déjà reconnus, sans second passage
+            for result in iterate_level(api.GetIterator(), RIL.WORD):
+                if result.IsAtBeginningOf(RIL.TEXTLINE):
+                    line += 1
+                text = result.GetUTF8Text(RIL.WORD)
+                box = result.BoundingBox(RIL.WORD)
+                if not text or not text.strip() or box is None:
+                    continue
+                left, top, right, bottom = box
+                words.append({
+                    "text": text.strip(), "conf": float(result.Confidence(RIL.WORD)),
+                    "left": left, "top": top, "width": right - left, "height": bottom - top,
+                    "line": line
+                })
+            return group_lines(words)
+        finally:
+            api.Clear()
+
+    def close(self):
+        with self._lock:
+            apis, self._apis = self._apis, []
+        for api in apis:
+            api.End()
+
+
+def create_engine(name: Optional[str] = None, lang: str = 'fra', tessdata_path: Optional[str] = None) -> OCREngine:
+    """
+    Crée le moteur OCR demandé
+
+    :param name: 'auto', 'tesserocr' ou 'pytesseract' (variable OCR_ENGINE, 'auto' par défaut)
+    :param lang: Langue Tesseract
+    :param tessdata_path: Dossier des fichiers .traineddata
+    :return: Instance de OCREngine (pytesseract si tesserocr est indisponible)
+    """
+    logger = logging.getLogger(__name__)
+    name = (name or os.getenv("OCR_ENGINE", "auto")).lower()
+    if name not in OCR_ENGINES:
+        logger.warning(f"Moteur OCR inconnu '{name}', utilisation du mode auto")
+        name = "auto"
+
+    if name in ("auto", "tesserocr"):
+        if TESSEROCR_AVAILABLE:
+            return TesserocrEngine(lang, tessdata_path)
+        if name == "tesserocr":
+            logger.warning("tesserocr n'est pas installé, utilisation de pytesseract")
+    return PytesseractEngine(lang, tessdata_path)
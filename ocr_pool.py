@@ -0,0 +1,225 @@
+import os
+import time
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+# Processeur OCR propre à chaque processus du pool, créé une seule fois au démarrage
+_processor = None
+
+
+def _init_worker(lang, preset, tile_workers):
+    """
+    Initialise le processeur Tesseract du processus (appelé une fois par processus)
+
+    Seuls le moteur OCR et le prétraitement sont créés : les appels Mistral restent
+    dans le processus appelant.
+    """
+    global _processor
+    from advanced_receipt_ocr import SimplifiedReceiptProcessor
+    _processor = SimplifiedReceiptProcessor(lang=lang, preset=preset, tile_workers=tile_workers, llm=False)
+
+
+def _ping(hold):
+    """
+    Tâche vide servant à démarrer les processus à l'avance
+
+    :param hold: Durée d'occupation du processus, pour que chaque tâche en démarre un nouveau
+    """
+    time.sleep(hold)
+    return os.getpid()
+
+
+def _attach(name):
+    """
+    Ouvre un bloc de mémoire partagée créé par le processus parent
+
+    Les processus du pool partagent le resource tracker du parent : le bloc y est
+    déjà enregistré, et c'est le parent qui le supprime une fois la tâche terminée.
+    """
+    return shared_memory.SharedMemory(name=name)
+
+
+def _ocr_task(source, preset=None):
+    """
+    Prétraitement et reconnaissance d'une image dans un processus du pool
+
+    :param source: Chemin de l'image ou descripteur d'un bloc de mémoire partagée
+    :param preset: Préréglage de prétraitement (celui du processeur par défaut)
+    :return: Tuple (texte extrait, PSM retenu et sa confiance)
+    """
+    meta = {}
+    if not isinstance(source, dict):
+        return _processor.extract_text(source, preset, meta=meta), meta
+
+    shm = _attach(source["shm"])
+    try:
+        if source["kind"] == "array":
+            image = np.ndarray(source["shape"], dtype=np.dtype(source["dtype"]), buffer=shm.buf)
+        else:
+            image = shm.buf[:source["size"]]
+        text = _processor.extract_text(image, preset, meta=meta)
+        # Libérer la vue sur le bloc avant de le fermer
+        del image
+        return text, meta
+    finally:
+        shm.close()
+
+
+class OCRProcessPool:
+    """
+    Pool de processus Tesseract persistants, un par cœur par défaut.
+
+    Chaque processus garde son propre processeur OCR ; le prétraitement et la
+    reconnaissance s'y exécutent en parallèle, hors du GIL du processus appelant.
+    Les images reçues en mémoire (octets ou tableau décodé) sont transmises par
+    mémoire partagée plutôt que sérialisées ou écrites dans un fichier temporaire.
+    """
+    def __init__(self, processes: Optional[int] = None, lang: str = 'fra', preset: Optional[str] = None):
+        """
+        :param processes: Nombre de processus (nombre de cœurs par défaut)
+        :param lang: Langue Tesseract
+        :param preset: Préréglage de prétraitement (variable OCR_PREPROCESS_PRESET par défaut)
+        """
+        self.processes = processes or os.cpu_count() or 1
+        # Les processus se partagent les cœurs : pas un thread par cœur pour les bandes de chacun
+        self.tile_workers = int(os.getenv("OCR_TILE_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // self.processes)
+        self.logger = logging.getLogger(__name__)
+        # 'spawn' : pas de copie des threads et connexions du processus parent (Flask, workers)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(lang, preset, self.tile_workers)
+        )
+
+    def warm(self) -> List[int]:
+        """
+        Démarre tous les processus et charge Tesseract avant le premier ticket
+
+        :return: PID des processus démarrés
+        """
+        futures = [self._executor.submit(_ping, 0.2) for _ in range(self.processes)]
+        pids = sorted({future.result() for future in futures})
+        self.logger.info(f"Pool OCR démarré: {len(pids)} processus")
+        return pids
+
+    def _share(self, source: Union[str, bytes, np.ndarray]) -> Tuple[Any, Optional[shared_memory.SharedMemory]]:
+        """
+        Prépare une image pour un processus du pool
+
+        :param source: Chemin, octets du fichier ou image décodée
+        :return: Tuple (argument de la tâche, bloc de mémoire partagée à libérer ou None)
+        """
+        if isinstance(source, np.ndarray):
+            shm = shared_memory.SharedMemory(create=True, size=max(1, source.nbytes))
+            np.ndarray(source.shape, dtype=source.dtype, buffer=shm.buf)[...] = source
+            return {"shm": shm.name, "kind": "array", "shape": source.shape, "dtype": source.dtype.str}, shm
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            size = memoryview(source).nbytes
+            shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+            shm.buf[:size] = source
+            return {"shm": shm.name, "kind": "bytes", "size": size}, shm
+        # Chemin : le processus lit lui-même le fichier
+        return source, None
+
+    @staticmethod
+    def _release(shm):
+        """Supprime un bloc de mémoire partagée une fois la tâche terminée"""
+        shm.close()
+        shm.unlink()
+
+    def submit(self, source: Union[str, bytes, np.ndarray], preset: Optional[str] = None):
+        """
+        Soumet une image au pool
+
+        :param source: Chemin, octets du fichier ou image décodée
+        :param preset: Préréglage de prétraitement (optionnel)
+        :return: Future du tuple (texte extrait, PSM retenu et sa confiance)
+        """
+        task, shm = self._share(source)
+        try:
+            future = self._executor.submit(_ocr_task, task, preset)
+        except Exception:
+            if shm is not None:
+                self._release(shm)
+            raise
+        if shm is not None:
+            future.add_done_callback(lambda f: self._release(shm))
+        return future
+
+    def extract_text(self, source: Union[str, bytes, np.ndarray], preset: Optional[str] = None,
+                     timeout: Optional[float] = None, meta: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Extraction du texte d'une image dans un processus du pool
+
+        :param source: Chemin, octets du fichier ou image décodée
+        :param preset: Préréglage de prétraitement (optionnel)
+        :param timeout: Attente maximale en secondes
+        :param meta: Dictionnaire à compléter avec le PSM retenu et sa confiance (optionnel)
+        :return: Texte extrait
+        """
+        text, task_meta = self.submit(source, preset).result(timeout=timeout)
+        if meta is not None:
+            meta.update(task_meta)
+        return text
+
+    def extract_batch(self, sources: List[Union[str, bytes, np.ndarray]], preset: Optional[str] = None) -> List[str]:
+        """
+        Extraction du texte d'un lot d'images réparties sur tous les processus
+
+        Le nombre d'images en cours est limité à deux par processus pour borner la
+        mémoire partagée allouée.
+
+        :param sources: Chemins, octets ou images décodées
+        :param preset: Préréglage de prétraitement (optionnel)
+        :return: Textes extraits, dans l'ordre des images ("" en cas d'échec)
+        """
+        results = [""] * len(sources)
+        in_flight = deque()
+
+        def collect(index, future):
+            try:
+                results[index] = future.result()[0]
+            except Exception as e:
+                self.logger.error(f"Échec de l'OCR de l'image {index}: {str(e)}")
+
+        for index, source in enumerate(sources):
+            if len(in_flight) >= 2 * self.processes:
+                collect(*in_flight.popleft())
+            in_flight.append((index, self.submit(source, preset)))
+        wait([future for _, future in in_flight])
+        for index, future in in_flight:
+            collect(index, future)
+        return results
+
+    def shutdown(self, wait: bool = True):
+        """Arrête les processus du pool"""
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+
+def pool_from_env() -> Optional[OCRProcessPool]:
+    """
+    Pool OCR configuré par la variable OCR_PROCESS_POOL : nombre de processus,
+    'auto' pour un processus par cœur, 0 ou absente pour désactiver le pool
+
+    :return: Pool démarré ou None
+    """
+    setting = os.getenv("OCR_PROCESS_POOL", "0").strip().lower()
+    if setting in ("", "0", "false"):
+        return None
+    processes = None if setting == "auto" else int(setting)
+    pool = OCRProcessPool(processes=processes)
+    pool.warm()
+    return pool
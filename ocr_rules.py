@@ -0,0 +1,298 @@
+import os
+import re
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+from advanced_receipt_ocr import parse_line_items
+from vendor_registry import generic_vendor
+
+# Champs de regles_ocr (champ_cible) et clés correspondantes des données structurées
+RULE_FIELDS = {
+    "montant_total": "total",
+    "date": "date",
+    "magasin": "vendor",
+    "numero_facture": "invoice_number",
+}
+# Champs à extraire avec une confiance suffisante pour se passer de Mistral ; l'enseigne
+# doit en plus être confirmée par le registre des magasins ou un modèle d'enseigne
+REQUIRED_FIELDS = ("montant_total", "date")
+# Formats de date reconnus, jour avant mois (tickets français)
+DATE_FORMATS = ("%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d-%m-%y", "%d.%m.%Y", "%d.%m.%y", "%Y-%m-%d")
+# Écart toléré entre la somme des articles et le total
+ITEMS_SUM_TOLERANCE = 0.02
+# Confiance d'une valeur selon la façon dont la règle l'a trouvée
+LABELLED_CONFIDENCE = 0.95    # précédée de son libellé dans le motif (TOTAL, FACTURE N°...)
+DATE_CONFIDENCE = 0.9         # date valide, reconnaissable sans libellé
+POSITIONAL_CONFIDENCE = 0.6   # lue à une position (première ligne, nombre seul)
+GENERIC_VENDOR_CONFIDENCE = 0.2  # enseigne faite de mots d'en-tête communs (BIENVENUE, TICKET...)
+# Facteur appliqué quand la confiance OCR est inconnue (texte Veryfi)
+UNKNOWN_OCR_FACTOR = 0.85
+
+
+class RuleEngine:
+    """
+    Extraction déterministe des champs d'un ticket avec les expressions régulières
+    de la table regles_ocr.
+
+    Les règles actives sont chargées et compilées une seule fois. Pour chaque champ,
+    la règle la plus prioritaire qui trouve une valeur valide l'emporte. La confiance
+    d'un champ dépend de la façon dont il a été lu (avec son libellé ou à une simple
+    position) et de la confiance OCR du texte. Quand le total, la date et des lignes
+    d'articles dont la somme correspond au total sont extraits avec une confiance
+    suffisante et que l'enseigne est confirmée par le registre des magasins ou un
+    modèle d'enseigne, le ticket est complet et la classification Mistral peut être sautée.
+    """
+    def __init__(self, db_path, min_confidence=None, min_ocr_confidence=None):
+        """
+        :param db_path: Chemin de la base SQLite contenant regles_ocr
+        :param min_confidence: Confiance minimale (0-1) de chaque champ requis
+                               (variable RULES_MIN_CONFIDENCE, 0.8 par défaut)
+        :param min_ocr_confidence: Confiance Tesseract moyenne (0-100) en dessous de laquelle la
+                                   confiance des champs est réduite d'autant
+                                   (variable RULES_MIN_OCR_CONFIDENCE, 80 par défaut)
+        """
+        self.db_path = str(db_path)
+        if min_confidence is None:
+            min_confidence = float(os.getenv("RULES_MIN_CONFIDENCE", "0.8"))
+        self.min_confidence = min_confidence
+        if min_ocr_confidence is None:
+            min_ocr_confidence = float(os.getenv("RULES_MIN_OCR_CONFIDENCE", "80"))
+        self.min_ocr_confidence = min_ocr_confidence
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._rules = None
+        self._stats = {"receipts": 0, "complete": 0}
+
+    def rules(self):
+        """
+        Règles actives compilées, par priorité décroissante (chargées au premier appel)
+
+        :return: Liste de dictionnaires (regle_id, nom, champ, priorite, regex)
+        """
+        with self._lock:
+            if self._rules is None:
+                self._rules = self._load()
+            return self._rules
+
+    def reload(self):
+        """Relit les règles après une modification de regles_ocr"""
+        with self._lock:
+            self._rules = self._load()
+
+    def _load(self):
+        """Lit et compile les règles actives ; une règle invalide est ignorée"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                rows = conn.execute("""
+                    SELECT regle_id, nom, pattern, champ_cible, priorite
+                    FROM regles_ocr
+                    WHERE est_active = 1
+                    ORDER BY priorite DESC, regle_id
+                """).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            self.logger.error(f"Impossible de charger les règles OCR: {str(e)}")
+            return []
+
+        rules = []
+        for regle_id, nom, pattern, champ, priorite in rows:
+            try:
+                regex = re.compile(pattern, re.IGNORECASE)
+            except re.error as e:
+                self.logger.warning(f"Règle OCR {regle_id} ({nom}) ignorée, expression invalide: {str(e)}")
+                continue
+            rules.append({"regle_id": regle_id, "nom": nom, "champ": champ,
+                          "priorite": priorite or 0, "regex": regex})
+        self.logger.info(f"{len(rules)} règle(s) OCR chargée(s)")
+        return rules
+
+    def _normalize(self, champ, raw):
+        """
+        Valeur typée d'un champ extrait
+
+        :return: Valeur normalisée, ou None si la valeur n'est pas plausible
+        """
+        raw = raw.strip()
+        if champ == "montant_total":
+            try:
+                value = float(raw.replace(" ", "").replace(",", "."))
+            except ValueError:
+                return None
+            return value if 0 < value < 100000 else None
+        if champ == "date":
+            for fmt in DATE_FORMATS:
+                try:
+                    parsed = datetime.strptime(raw, fmt)
+                except ValueError:
+                    continue
+                if 2000 <= parsed.year <= datetime.now().year + 1:
+                    return parsed.strftime("%Y-%m-%d")
+            return None
+        if champ == "magasin":
+            raw = " ".join(raw.split())
+            return raw if len(re.findall(r'[A-Za-zÀ-ÿ]', raw)) >= 3 and len(raw) <= 60 else None
+        return raw or None
+
+    def _quality(self, champ, match, value):
+        """
+        Confiance d'une valeur selon la façon dont la règle l'a trouvée
+
+        Le motif est libellé quand il contient des lettres en dehors de la valeur
+        capturée (TOTAL, FACTURE N°) ; sinon la valeur n'est lue qu'à une position,
+        comme la première ligne du ticket, souvent un en-tête générique.
+        """
+        if match.re.groups and match.group(1) is not None:
+            context = match.string[match.start():match.start(1)] + match.string[match.end(1):match.end()]
+        else:
+            context = ""
+        if champ == "magasin" and generic_vendor(value):
+            return GENERIC_VENDOR_CONFIDENCE
+        if re.search(r'[A-Za-zÀ-ÿ]{2,}', context):
+            return LABELLED_CONFIDENCE
+        return DATE_CONFIDENCE if champ == "date" else POSITIONAL_CONFIDENCE
+
+    def _ocr_factor(self, ocr_confidence):
+        """Facteur appliqué à la confiance des champs selon la confiance OCR moyenne (None si inconnue)"""
+        if ocr_confidence is None:
+            return UNKNOWN_OCR_FACTOR
+        return min(1.0, ocr_confidence / self.min_ocr_confidence) if self.min_ocr_confidence > 0 else 1.0
+
+    def _match(self, rule, text, ocr_factor=1.0):
+        """
+        Applique une règle au texte
+
+        :param ocr_factor: Facteur de confiance du texte OCR (voir _ocr_factor)
+        :return: Tuple (valeur brute, valeur normalisée, confiance) ou None
+        """
+        values = []
+        for match in rule["regex"].finditer(text):
+            raw = match.group(1) if rule["regex"].groups else match.group(0)
+            value = self._normalize(rule["champ"], raw or "")
+            if value is not None:
+                values.append((raw.strip(), value, self._quality(rule["champ"], match, value)))
+        if not values:
+            return None
+        # Dernière occurrence : le total final suit les sous-totaux
+        raw, value, quality = values[-1]
+        confidence = quality * ocr_factor
+        if len({v for _, v, _ in values}) > 1:
+            # Valeurs contradictoires pour un même champ
+            confidence *= 0.8
+        return raw, value, round(min(confidence, 0.99), 2)
+
+    def extract(self, text, ocr_confidence=None, vendor=None):
+        """
+        Extraction des champs d'un texte OCR
+
+        :param text: Texte OCR (une ligne par ligne du ticket)
+        :param ocr_confidence: Confiance Tesseract moyenne (0-100), None si inconnue (texte Veryfi)
+        :param vendor: Enseigne confirmée par le registre des magasins ou un modèle d'enseigne
+                       (None sinon : le ticket ne peut pas être complet)
+        :return: Dictionnaire (fields, vendor, line_items, items_sum, complete, reason, extractions)
+        """
+        fields = {}
+        ocr_factor = self._ocr_factor(ocr_confidence)
+        for rule in self.rules():
+            if rule["champ"] in fields:
+                continue
+            found = self._match(rule, text or "", ocr_factor)
+            if found:
+                raw, value, confidence = found
+                fields[rule["champ"]] = {"value": value, "raw": raw, "confidence": confidence,
+                                         "regle_id": rule["regle_id"]}
+
+        # Articles lus ligne par ligne, la première ligne étant l'en-tête du ticket
+        line_items = parse_line_items((text or "").splitlines()[1:])
+        items_sum = round(sum(item["quantity"] * item["price"] for item in line_items), 2)
+
+        reason = None
+        missing = [champ for champ in REQUIRED_FIELDS
+                   if fields.get(champ, {}).get("confidence", 0) < self.min_confidence]
+        if not self._rules:
+            reason = "no_rules"
+        elif missing:
+            reason = "missing_" + "_".join(missing)
+        elif not vendor:
+            reason = "vendor_unconfirmed"
+        elif not line_items:
+            reason = "no_line_items"
+        elif abs(items_sum - fields["montant_total"]["value"]) > ITEMS_SUM_TOLERANCE:
+            reason = "items_sum_mismatch"
+
+        with self._lock:
+            self._stats["receipts"] += 1
+            if reason is None:
+                self._stats["complete"] += 1
+
+        return {
+            "fields": fields,
+            "vendor": vendor,
+            "line_items": line_items,
+            "items_sum": items_sum,
+            "complete": reason is None,
+            "reason": reason or "complete",
+            # Lignes destinées à extractions_ocr (valeur brute lue sur le ticket)
+            "extractions": [
+                {"champ": champ, "valeur": field["raw"], "confiance": field["confidence"],
+                 "regle_id": field["regle_id"]}
+                for champ, field in fields.items()
+            ]
+        }
+
+    def structured_data(self, result):
+        """
+        Données structurées au format de la classification Mistral
+
+        :param result: Résultat de extract()
+        :return: Dictionnaire (vendor, date, total, line_items, ...)
+        """
+        data = {
+            "vendor": "Unknown",
+            "date": "Unknown",
+            "total": 0.0,
+            "line_items": result["line_items"],
+            "category": "Uncategorized",
+            "payment_method": "Unknown"
+        }
+        for champ, field in result["fields"].items():
+            if champ in RULE_FIELDS:
+                data[RULE_FIELDS[champ]] = field["value"]
+        if result.get("vendor"):
+            # Enseigne confirmée, préférée à celle lue par les règles
+            data["vendor"] = result["vendor"]
+        return data
+
+    def stats(self):
+        """
+        :return: Dictionnaire (tickets analysés, tickets complets, part extraite sans Mistral)
+        """
+        with self._lock:
+            receipts, complete = self._stats["receipts"], self._stats["complete"]
+        return {
+            "rules": len(self._rules or []),
+            "receipts": receipts,
+            "complete": complete,
+            "complete_ratio": round(complete / receipts, 3) if receipts else 0.0
+        }
+
+    @staticmethod
+    def merge_stats(reports):
+        """
+        Cumule les indicateurs stats() publiés par plusieurs processus worker
+
+        :param reports: Liste de dictionnaires renvoyés par stats()
+        :return: Dictionnaire au format de stats(), avec le nombre de processus
+        """
+        receipts = sum(report.get("receipts", 0) for report in reports)
+        complete = sum(report.get("complete", 0) for report in reports)
+        return {
+            "rules": max((report.get("rules", 0) for report in reports), default=0),
+            "receipts": receipts,
+            "complete": complete,
+            "complete_ratio": round(complete / receipts, 3) if receipts else 0.0,
+            "workers": len(reports)
+        }
@@ -0,0 +1,167 @@
+import re
+import json
+import logging
+import unicodedata
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Union
+from urllib.parse import urlparse, parse_qsl
+
+import numpy as np
+import cv2
+
+from ocr_rules import DATE_FORMATS
+
+logger = logging.getLogger(__name__)
+
+# Taille maximale (plus grand côté) de l'image analysée ; un QR code de ticket reste lisible
+DETECTION_MAX_SIDE = 2000
+
+# Noms de clés reconnus dans un contenu structuré (JSON, URL ou clé=valeur), sans accents
+PAYLOAD_KEYS = {
+    "invoice_number": ("ref", "reference", "invoice", "invoice_number", "numero", "numero_facture",
+                       "num", "ticket", "ticket_id", "transaction", "transaction_id", "id"),
+    "total": ("total", "total_ttc", "ttc", "montant", "montant_ttc", "amount", "mt"),
+    "date": ("date", "date_transaction", "datetime", "dt"),
+    "vendor": ("vendor", "magasin", "enseigne", "store", "merchant", "marchand"),
+    "siret": ("siret",),
+    "tva_number": ("tva", "tva_number", "tva_intra", "vat"),
+}
+# Formats de date d'un contenu structuré, en plus de ceux des tickets imprimés
+PAYLOAD_DATE_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y%m%d", "%d%m%Y") + DATE_FORMATS
+
+
+def _normalize_key(key: str) -> str:
+    key = unicodedata.normalize("NFKD", str(key)).encode("ascii", "ignore").decode().lower()
+    return re.sub(r'[^a-z0-9]+', '_', key).strip('_')
+
+
+def _normalize_date(value: str) -> Optional[str]:
+    """Date ISO (AAAA-MM-JJ) d'une valeur de date, ou None"""
+    value = str(value).strip()
+    for fmt in PAYLOAD_DATE_FORMATS:
+        try:
+            parsed = datetime.strptime(value[:19], fmt)
+        except ValueError:
+            continue
+        if 2000 <= parsed.year <= datetime.now().year + 1:
+            return parsed.strftime("%Y-%m-%d")
+    return None
+
+
+def _normalize_total(value: Any) -> Optional[float]:
+    try:
+        total = float(str(value).replace(" ", "").replace("€", "").replace(",", "."))
+    except ValueError:
+        return None
+    return round(total, 2) if 0 < total < 100000 else None
+
+
+def _pairs(data: str) -> Optional[Dict[str, str]]:
+    """Couples clé/valeur d'un contenu JSON, d'une URL ou d'un texte clé=valeur"""
+    data = data.strip()
+    if data.startswith("{"):
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            return None
+        return {key: value for key, value in payload.items() if not isinstance(value, (dict, list))} \
+            if isinstance(payload, dict) else None
+    parsed = urlparse(data)
+    if parsed.scheme in ("http", "https") and parsed.query:
+        return dict(parse_qsl(parsed.query))
+    fields = [part.split("=", 1) if "=" in part else part.split(":", 1)
+              for part in re.split(r'[;|&\n]', data) if "=" in part or ":" in part]
+    return {key.strip(): value.strip() for key, value in fields} if len(fields) >= 2 else None
+
+
+def parse_payload(data: str, code_type: str = "QRCODE") -> Optional[Dict[str, Any]]:
+    """
+    Champs d'un ticket encodés dans un QR code ou un code-barres
+
+    :param data: Contenu décodé
+    :param code_type: Type de code ('QRCODE', 'CODE_128', 'EAN_13', ...)
+    :return: Dictionnaire (format, invoice_number, total, date, vendor, siret, tva_number) ou None
+             si le contenu n'est pas un format connu
+    """
+    pairs = _pairs(data)
+    if pairs:
+        keys = {_normalize_key(key): value for key, value in pairs.items()}
+        fields = {}
+        for field, aliases in PAYLOAD_KEYS.items():
+            value = next((keys[alias] for alias in aliases if keys.get(alias) not in (None, "")), None)
+            if value is not None:
+                fields[field] = str(value).strip()
+        if "total" in fields:
+            fields["total"] = _normalize_total(fields["total"])
+        if "date" in fields:
+            fields["date"] = _normalize_date(fields["date"])
+        fields = {field: value for field, value in fields.items() if value is not None}
+        if "invoice_number" not in fields:
+            return None
+        fields["format"] = "json" if data.lstrip().startswith("{") else ("url" if "://" in data else "key_value")
+        return fields
+
+    # Code-barres linéaire imprimé sous le ticket : référence de la transaction seule
+    reference = data.strip()
+    if code_type != "QRCODE" and re.fullmatch(r'[0-9A-Za-z\-/]{6,40}', reference):
+        return {"format": "barcode", "invoice_number": reference}
+    return None
+
+
+def decode_codes(image: np.ndarray) -> List[Dict[str, str]]:
+    """
+    Lit les QR codes et codes-barres d'une photo de ticket
+
+    :param image: Image BGR ou niveaux de gris
+    :return: Liste de {"type", "data"} (vide si aucun code n'est lisible)
+    """
+    height, width = image.shape[:2]
+    scale = min(1.0, DETECTION_MAX_SIDE / max(height, width))
+    if scale < 1.0:
+        image = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+    codes = []
+    try:
+        found, decoded, _, _ = cv2.QRCodeDetector().detectAndDecodeMulti(image)
+        if found:
+            codes.extend({"type": "QRCODE", "data": data} for data in decoded if data)
+    except cv2.error as e:
+        logger.warning(f"Lecture des QR codes impossible: {str(e)}")
+
+    # Détecteur de codes-barres disponible à partir d'OpenCV 4.8
+    if hasattr(cv2, "barcode"):
+        try:
+            found, decoded, types, _ = cv2.barcode.BarcodeDetector().detectAndDecodeWithType(image)
+            if found:
+                codes.extend({"type": code_type, "data": data} for data, code_type in zip(decoded, types) if data)
+        except cv2.error as e:
+            logger.warning(f"Lecture des codes-barres impossible: {str(e)}")
+    return codes
+
+
+def read_receipt_codes(source: Union[str, bytes, np.ndarray]) -> Optional[Dict[str, Any]]:
+    """
+    Données structurées lues dans les codes d'un ticket
+
+    Un QR code structuré est préféré à un code-barres qui ne porte que la référence.
+
+    :param source: Chemin de l'image, octets du fichier ou image décodée
+    :return: Résultat de parse_payload() complété du type de code, ou None
+    """
+    if isinstance(source, np.ndarray):
+        image = source
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        image = cv2.imdecode(np.frombuffer(source, np.uint8), cv2.IMREAD_COLOR)
+    else:
+        image = cv2.imread(str(source))
+    if image is None:
+        return None
+
+    payloads = []
+    for code in decode_codes(image):
+        payload = parse_payload(code["data"], code["type"])
+        if payload:
+            payloads.append(dict(payload, code_type=code["type"]))
+    if not payloads:
+        return None
+    return max(payloads, key=lambda payload: len(payload))
@@ -0,0 +1,1236 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import mimetypes
+import statistics
+import threading
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait, FIRST_COMPLETED
+
+from executors import get_executor, PoolSaturatedError
+from deadline import Deadline
+from degradation import TIER_FULL, TIER_LIGHT_MODEL, TIER_DETERMINISTIC
+from receipt_validator import DECISION_SKIP, DECISION_CLASSIFY_ONLY, check_arithmetic, extract_tax_amounts
+from vendor_registry import receipt_identifiers, PLACEHOLDERS
+from receipt_codes import read_receipt_codes
+
+# Montant total reconnaissable dans un texte OCR (ex: "TOTAL TTC: 25,68")
+TOTAL_PATTERN = re.compile(r'total[^\n\d]{0,20}\d+[.,]\d{2}', re.IGNORECASE)
+
+
+class LatencyTracker:
+    """
+    Fenêtre glissante des latences observées pour un service (ex: Veryfi)
+    """
+    def __init__(self, window=100):
+        """
+        :param window: Nombre de mesures conservées
+        """
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        """Ajoute une mesure en secondes"""
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct, default=None):
+        """
+        Renvoie le percentile demandé des mesures récentes
+
+        :param pct: Percentile entre 0 et 100
+        :param default: Valeur renvoyée tant qu'il n'y a pas assez de mesures
+        :return: Latence en secondes
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < 5:
+            return default
+        if pct == 50:
+            return statistics.median(samples)
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class ReceiptPipeline:
+    """
+    Chaîne de traitement complète d'un ticket : OCR (Veryfi puis Tesseract),
+    nettoyage et classification Mistral, stockage GCS et intégration fidélité.
+
+    Utilisée par les workers de la file de traitement (voir worker.py) afin que
+    la requête HTTP d'upload n'ait plus à attendre la fin du traitement.
+    """
+    # Ordre des étapes publiées pendant le traitement
+    STAGES = [
+        "saved", "codes", "veryfi", "tesseract", "mistral_clean", "mistral_classify",
+        "gcs_image", "gcs_json", "loyalty_db"
+    ]
+
+    # Modes OCR : Veryfi puis Tesseract en secours, ou course entre les deux
+    OCR_MODES = ("sequential", "hedged")
+
+    # Modes Mistral : nettoyage puis classification, ou les deux en un seul appel
+    LLM_MODES = ("two_call", "single_call")
+
+    # Délai maximal de chaque étape en secondes, dans la limite du budget du ticket (voir deadline.py)
+    STAGE_TIMEOUTS = {
+        "codes": 5, "veryfi": 30, "tesseract": 20, "mistral_clean": 20, "mistral_classify": 20,
+        "mistral_single_call": 40, "gcs_image": 30, "gcs_json": 20
+    }
+    # Temps gardé en réserve pour chaque étape obligatoire restant à exécuter
+    STAGE_RESERVES = {"mistral_classify": 8, "gcs_image": 3, "gcs_json": 2}
+    # Temps minimal pour lancer le nettoyage Mistral, étape optionnelle
+    OPTIONAL_STAGE_MIN = 5
+
+    def __init__(self, veryfi_processor, ocr_processor, storage_manager, db_integrator, data_dir,
+                 ocr_mode=None, hedge_delay=None, min_text_length=None, require_total=None,
+                 result_cache=None, llm_mode=None, upload_dir=None, degradation=None, light_model=None,
+                 tesseract_pool=None, rule_engine=None, llm_gate=None, vendor_templates=None, read_codes=None):
+        """
+        :param veryfi_processor: Instance de ReceiptProcessor (Veryfi)
+        :param ocr_processor: Instance de SimplifiedReceiptProcessor (Tesseract + Mistral)
+        :param storage_manager: Gestionnaire de stockage GCP
+        :param db_integrator: Intégrateur de la base de fidélité
+        :param data_dir: Dossier local des données (copie JSON de secours)
+        :param ocr_mode: 'sequential' (défaut) ou 'hedged' (variable OCR_MODE)
+        :param hedge_delay: Délai en secondes avant de lancer Tesseract en mode 'hedged',
+                            ou 'p50' pour la médiane des latences Veryfi récentes (variable OCR_HEDGE_DELAY)
+        :param min_text_length: Longueur minimale d'un texte OCR acceptable (variable OCR_MIN_TEXT_LENGTH)
+        :param require_total: Exiger un montant total dans le texte OCR (variable OCR_REQUIRE_TOTAL)
+        :param result_cache: Instance de ResultCache (optionnelle) pour réutiliser les résultats
+                             d'une image déjà traitée
+        :param llm_mode: 'two_call' (défaut) ou 'single_call' pour nettoyer et classer en un seul
+                         appel Mistral (variable LLM_PIPELINE_MODE)
+        :param upload_dir: Dossier où écrire une image reçue en mémoire si l'envoi GCS échoue
+        :param degradation: Instance de DegradationPolicy (optionnelle) choisissant le niveau de
+                            traitement selon la charge
+        :param light_model: Modèle Mistral du niveau light_model (variable LLM_LIGHT_MODEL)
+        :param tesseract_pool: Instance de OCRProcessPool (optionnelle) exécutant le prétraitement
+                               et Tesseract dans des processus dédiés
+        :param rule_engine: Instance de RuleEngine (optionnelle) : un ticket dont les règles de
+                            regles_ocr extraient tous les champs et dont l'enseigne est confirmée
+                            est classé sans Mistral
+        :param llm_gate: Instance de LLMGate (optionnelle) : un ticket lu avec une bonne confiance
+                         et dont les montants concordent est extrait sans Mistral ou sans nettoyage
+        :param vendor_templates: Instance de VendorTemplates (optionnelle) : un ticket d'une enseigne
+                                 connue est extrait avec son modèle, et chaque ticket classé par
+                                 Mistral complète le modèle de son enseigne
+        :param read_codes: Lire les QR codes et codes-barres avant l'OCR (variable RECEIPT_CODES_ENABLED) :
+                           un contenu structuré complet évite Veryfi, Tesseract et Mistral
+        """
+        self.veryfi_processor = veryfi_processor
+        self.ocr_processor = ocr_processor
+        self.storage_manager = storage_manager
+        self.db_integrator = db_integrator
+        self.data_dir = data_dir
+        self.result_cache = result_cache
+        self.tesseract_pool = tesseract_pool
+        self.rule_engine = rule_engine
+        self.llm_gate = llm_gate
+        self.vendor_templates = vendor_templates
+        if read_codes is None:
+            read_codes = os.getenv("RECEIPT_CODES_ENABLED", "true").lower() == "true"
+        self.read_codes = read_codes
+        self.upload_dir = upload_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+        self.logger = logging.getLogger(__name__)
+
+        self.ocr_mode = (ocr_mode or os.getenv("OCR_MODE", "sequential")).lower()
+        if self.ocr_mode not in self.OCR_MODES:
+            self.logger.warning(f"Mode OCR inconnu '{self.ocr_mode}', utilisation du mode séquentiel")
+            self.ocr_mode = "sequential"
+        self.hedge_delay = str(hedge_delay if hedge_delay is not None else os.getenv("OCR_HEDGE_DELAY", "p50"))
+        self.min_text_length = int(min_text_length if min_text_length is not None else os.getenv("OCR_MIN_TEXT_LENGTH", "20"))
+        if require_total is None:
+            require_total = os.getenv("OCR_REQUIRE_TOTAL", "false").lower() == "true"
+        self.require_total = require_total
+
+        self.llm_mode = (llm_mode or os.getenv("LLM_PIPELINE_MODE", "two_call")).lower()
+        if self.llm_mode not in self.LLM_MODES:
+            self.logger.warning(f"Mode LLM inconnu '{self.llm_mode}', utilisation du mode two_call")
+            self.llm_mode = "two_call"
+
+        self.degradation = degradation
+        self.light_model = light_model or os.getenv("LLM_LIGHT_MODEL", "mistral-small-latest")
+
+        self.veryfi_latency = LatencyTracker()
+        # Durée des étapes Mistral d'un ticket, signal de charge de la politique de dégradation
+        self.llm_latency = LatencyTracker()
+        # Pools bornés partagés par tous les tickets du processus (voir executors.py) :
+        # un appel abandonné après son délai garde sa place jusqu'à sa fin
+        self.ocr_pool = get_executor("ocr")
+        self.llm_pool = get_executor("llm")
+        self.storage_pool = get_executor("storage")
+
+    def _stage_timeout(self, deadline, stage, *later):
+        """
+        Délai accordé à une étape
+
+        :param deadline: Budget de temps du ticket
+        :param stage: Nom de l'étape (clé de STAGE_TIMEOUTS)
+        :param later: Etapes obligatoires restant à exécuter ensuite
+        :return: Délai en secondes
+        """
+        reserve = sum(self.STAGE_RESERVES.get(name, 0) for name in later)
+        return deadline.timeout(self.STAGE_TIMEOUTS[stage], reserve=reserve)
+
+    def _submit(self, pool, deadline, fn, *args):
+        """Soumet une tâche à un pool partagé sans attendre une place au-delà du budget"""
+        return pool.submit(fn, *args, timeout=deadline.timeout(pool.submit_timeout))
+
+    def _failure_detail(self, error):
+        """Détail publié avec une étape en échec : pool saturé ou erreur de l'appel"""
+        if isinstance(error, PoolSaturatedError):
+            return {"reason": "saturated", "error": str(error)}
+        return {"error": str(error)}
+
+    def _report(self, on_stage, stage, status, started=None, detail=None):
+        """
+        Publie une transition d'étape auprès de l'appelant
+
+        :param on_stage: Callback (stage, status, duration_ms, detail) ou None
+        :param stage: Nom de l'étape
+        :param status: 'done', 'failed', 'skipped', 'timeout', 'discarded' ou 'cached'
+        :param started: Horodatage time.monotonic() du début de l'étape
+        :param detail: Informations complémentaires (dict)
+        """
+        if on_stage is None:
+            return
+        duration_ms = int((time.monotonic() - started) * 1000) if started is not None else None
+        try:
+            on_stage(stage, status, duration_ms, detail or {})
+        except Exception as e:
+            self.logger.error(f"Erreur lors de la publication de l'étape {stage}: {str(e)}")
+
+    def _veryfi(self, source, filename=None):
+        """Appel Veryfi chronométré (chemin ou octets de l'image), sans lever d'exception"""
+        started = time.monotonic()
+        try:
+            if isinstance(source, bytes):
+                result = self.veryfi_processor.process_image_bytes(source, filename or "receipt.jpg")
+            else:
+                result = self.veryfi_processor.process_image(source)
+            if result.get('ocr_text'):
+                self.veryfi_latency.record(time.monotonic() - started)
+            return result
+        except Exception as e:
+            self.logger.error(f"Erreur Veryfi: {str(e)}")
+            return {"ocr_text": "", "error": str(e)}
+
+    def _tesseract(self, source, meta=None):
+        """Extraction Tesseract (chemin ou octets de l'image) sans lever d'exception, PSM retenu dans meta"""
+        try:
+            if self.tesseract_pool is not None:
+                return self.tesseract_pool.extract_text(source, meta=meta)
+            return self.ocr_processor.extract_text(source, meta=meta)
+        except Exception as e:
+            self.logger.error(f"Erreur Tesseract: {str(e)}")
+            return ""
+
+    def _clean(self, text, usage=None, deadline=None):
+        """Nettoyage Mistral, renvoie le texte d'origine en cas d'erreur"""
+        try:
+            return self.ocr_processor.clean_text_with_mistral(text, usage=usage, deadline=deadline)
+        except Exception as e:
+            self.logger.error(f"Erreur nettoyage Mistral: {str(e)}")
+            return text
+
+    def _classify(self, text, usage=None, deadline=None, model=None):
+        """Classification Mistral, renvoie des données par défaut en cas d'erreur"""
+        try:
+            return self.ocr_processor.classify_data_with_mistral(text, usage=usage, deadline=deadline, model=model)
+        except Exception as e:
+            self.logger.error(f"Erreur classification Mistral: {str(e)}")
+            return {
+                "vendor": "Unknown",
+                "date": datetime.now().strftime("%Y-%m-%d"),
+                "total": 0,
+                "line_items": []
+            }
+
+    def _clean_and_classify(self, text, usage=None, deadline=None):
+        """Nettoyage et classification en un appel, avec des données par défaut en cas d'erreur"""
+        try:
+            return self.ocr_processor.clean_and_classify_with_mistral(text, usage=usage, deadline=deadline)
+        except Exception as e:
+            self.logger.error(f"Erreur nettoyage/classification Mistral: {str(e)}")
+            return text, {
+                "vendor": "Unknown",
+                "date": datetime.now().strftime("%Y-%m-%d"),
+                "total": 0,
+                "line_items": []
+            }
+
+    def is_acceptable_ocr(self, text):
+        """
+        Règle de qualité d'un texte OCR en mode 'hedged'
+
+        :param text: Texte OCR
+        :return: True si le texte peut être utilisé sans attendre l'autre moteur
+        """
+        if not text or text.startswith("Error:"):
+            return False
+        if len(text.strip()) < self.min_text_length:
+            return False
+        if self.require_total and not TOTAL_PATTERN.search(text):
+            return False
+        return True
+
+    def _hedge_delay_seconds(self):
+        """Délai avant de lancer Tesseract en mode 'hedged'"""
+        if self.hedge_delay.lower() == "p50":
+            # Sans historique suffisant, lancer les deux moteurs en même temps
+            return self.veryfi_latency.percentile(50, default=0.0)
+        try:
+            return max(0.0, float(self.hedge_delay))
+        except ValueError:
+            return 0.0
+
+    def _ocr_detail(self, ocr_meta):
+        """Informations Tesseract publiées avec l'étape (sans les lignes reconnues, trop volumineuses)"""
+        return {key: value for key, value in (ocr_meta or {}).items() if key != "lines"}
+
+    def _run_ocr_sequential(self, source, on_stage, deadline, filename=None, ocr_meta=None):
+        """
+        Veryfi, puis Tesseract seulement si Veryfi ne renvoie rien
+
+        :param ocr_meta: Dictionnaire complété avec le PSM Tesseract retenu et sa confiance (optionnel)
+        :return: Tuple (veryfi_result, raw_ocr_text, ocr_source)
+        """
+        # Step 1: Veryfi OCR with timeout
+        started = time.monotonic()
+        timeout = self._stage_timeout(deadline, "veryfi", "mistral_classify", "gcs_image", "gcs_json")
+        try:
+            future = self._submit(self.ocr_pool, deadline, self._veryfi, source, filename)
+            veryfi_result = future.result(timeout=timeout)
+            raw_ocr_text = veryfi_result.get('ocr_text', '')
+            self.logger.info(f"Texte OCR extrait avec Veryfi: {len(raw_ocr_text)} caractères")
+            self._report(on_stage, "veryfi", "done" if raw_ocr_text else "failed", started,
+                         {"chars": len(raw_ocr_text)})
+        except TimeoutError:
+            future.cancel()
+            self.logger.error(f"Veryfi processing timed out after {timeout:.1f} seconds")
+            veryfi_result = {"ocr_text": "", "error": "Timeout during processing"}
+            raw_ocr_text = ""
+            self._report(on_stage, "veryfi", "timeout", started)
+        except Exception as e:
+            self.logger.error(f"Exception during Veryfi processing: {str(e)}")
+            veryfi_result = {"ocr_text": "", "error": str(e)}
+            raw_ocr_text = ""
+            self._report(on_stage, "veryfi", "failed", started, self._failure_detail(e))
+
+        if raw_ocr_text:
+            self._report(on_stage, "tesseract", "skipped")
+            return veryfi_result, raw_ocr_text, "veryfi"
+
+        # Fallback to Tesseract if Veryfi fails
+        self.logger.info("Pas de texte retourné par Veryfi, recours à Tesseract")
+        return veryfi_result, self._run_tesseract(source, on_stage, deadline, ocr_meta), "tesseract"
+
+    def _run_tesseract(self, source, on_stage, deadline, ocr_meta=None):
+        """
+        OCR Tesseract seul, après un échec de Veryfi
+
+        :return: Texte OCR, ou message d'erreur préfixé par 'Error:'
+        """
+        started = time.monotonic()
+        try:
+            future = self._submit(self.ocr_pool, deadline, self._tesseract, source, ocr_meta)
+            raw_ocr_text = future.result(
+                timeout=self._stage_timeout(deadline, "tesseract", "mistral_classify", "gcs_image", "gcs_json"))
+            self.logger.info(f"Texte OCR extrait avec Tesseract: {len(raw_ocr_text)} caractères")
+            self._report(on_stage, "tesseract", "done", started, dict(self._ocr_detail(ocr_meta), chars=len(raw_ocr_text)))
+        except TimeoutError:
+            future.cancel()
+            self.logger.error("Tesseract extraction timed out")
+            raw_ocr_text = "Error: OCR timeout"
+            self._report(on_stage, "tesseract", "timeout", started)
+        except Exception as e:
+            self.logger.error(f"Exception during Tesseract extraction: {str(e)}")
+            raw_ocr_text = f"Error: {str(e)}"
+            self._report(on_stage, "tesseract", "failed", started, self._failure_detail(e))
+        return raw_ocr_text
+
+    def _run_ocr_hedged(self, source, on_stage, deadline, filename=None, ocr_meta=None):
+        """
+        Course entre Veryfi et Tesseract : Tesseract démarre après le délai de couverture
+        (ou immédiatement) et le premier texte acceptable l'emporte. Le perdant est
+        annulé s'il n'a pas démarré, sinon son résultat est ignoré.
+
+        :param ocr_meta: Dictionnaire complété avec le PSM Tesseract retenu et sa confiance (optionnel)
+        :return: Tuple (veryfi_result, raw_ocr_text, ocr_source)
+        """
+        later = ("mistral_classify", "gcs_image", "gcs_json")
+        veryfi_started = time.monotonic()
+        try:
+            veryfi_future = self._submit(self.ocr_pool, deadline, self._veryfi, source, filename)
+        except PoolSaturatedError as e:
+            self._report(on_stage, "veryfi", "failed", veryfi_started, self._failure_detail(e))
+            veryfi_result = {"ocr_text": "", "error": str(e)}
+            return veryfi_result, self._run_tesseract(source, on_stage, deadline, ocr_meta), "tesseract"
+        timeouts = {veryfi_future: time.monotonic() + self._stage_timeout(deadline, "veryfi", *later)}
+        names = {veryfi_future: "veryfi"}
+        results = {}
+
+        delay = min(self._hedge_delay_seconds(), self._stage_timeout(deadline, "veryfi", *later))
+        done, _ = wait([veryfi_future], timeout=delay)
+        if veryfi_future in done:
+            veryfi_result = veryfi_future.result()
+            if self.is_acceptable_ocr(veryfi_result.get('ocr_text', '')):
+                self._report(on_stage, "veryfi", "done", veryfi_started, {"chars": len(veryfi_result['ocr_text'])})
+                self._report(on_stage, "tesseract", "skipped")
+                return veryfi_result, veryfi_result['ocr_text'], "veryfi"
+
+        self.logger.info(f"Lancement de Tesseract en parallèle de Veryfi (délai de couverture {delay:.2f}s)")
+        tesseract_started = time.monotonic()
+        starts = {veryfi_future: veryfi_started}
+        try:
+            tesseract_future = self._submit(self.ocr_pool, deadline, self._tesseract, source, ocr_meta)
+        except PoolSaturatedError as e:
+            # Pas de place pour Tesseract : Veryfi continue seul jusqu'à son délai
+            tesseract_future = None
+            self._report(on_stage, "tesseract", "failed", tesseract_started, self._failure_detail(e))
+        else:
+            timeouts[tesseract_future] = time.monotonic() + self._stage_timeout(deadline, "tesseract", *later)
+            names[tesseract_future] = "tesseract"
+            starts[tesseract_future] = tesseract_started
+
+        winner = None
+        pending = set(timeouts)
+        while pending and winner is None:
+            remaining = max(0.0, max(timeouts[f] for f in pending) - time.monotonic())
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                value = future.result()
+                text = value.get('ocr_text', '') if names[future] == "veryfi" else value
+                results[future] = value
+                if winner is None and self.is_acceptable_ocr(text):
+                    winner = future
+            # Abandonner les moteurs qui ont dépassé leur délai
+            for future in list(pending):
+                if time.monotonic() >= timeouts[future]:
+                    pending.discard(future)
+
+        # Publier le sort de chaque moteur
+        for future, name in names.items():
+            if future is winner:
+                continue
+            if future in results:
+                text = results[future].get('ocr_text', '') if name == "veryfi" else results[future]
+                status = "discarded" if self.is_acceptable_ocr(text) else "failed"
+                self._report(on_stage, name, status, starts[future])
+            else:
+                future.cancel()
+                self._report(on_stage, name, "discarded" if winner is not None else "timeout", starts[future])
+
+        veryfi_result = results.get(veryfi_future) or {"ocr_text": "", "error": "Discarded by hedged OCR"}
+        if winner is not None:
+            name = names[winner]
+            raw_ocr_text = veryfi_result['ocr_text'] if name == "veryfi" else results[winner]
+            self.logger.info(f"Course OCR remportée par {name}: {len(raw_ocr_text)} caractères")
+            detail = self._ocr_detail(ocr_meta) if name == "tesseract" else {}
+            self._report(on_stage, name, "done", starts[winner], dict(detail, chars=len(raw_ocr_text), hedged=True))
+            return veryfi_result, raw_ocr_text, name
+
+        # Aucun texte acceptable : garder le plus long des textes obtenus
+        candidates = [(veryfi_result.get('ocr_text', ''), "veryfi")]
+        if tesseract_future in results:
+            candidates.append((results[tesseract_future], "tesseract"))
+        raw_ocr_text, name = max(candidates, key=lambda c: len(c[0] or ''))
+        if not results:
+            raw_ocr_text = "Error: OCR timeout"
+        self.logger.warning(f"Aucun texte OCR acceptable, utilisation du résultat {name}")
+        return veryfi_result, raw_ocr_text, name
+
+    def _summary(self, structured_data):
+        """Résumé des données classées publié dès la fin de la classification"""
+        return {
+            "vendor": structured_data.get("vendor"),
+            "total": structured_data.get("total"),
+            "date": structured_data.get("date"),
+        }
+
+    def _run_llm_clean(self, raw_ocr_text, on_stage, deadline):
+        """
+        Nettoyage Mistral du texte OCR
+
+        :return: Tuple (cleaned_text, completed)
+        """
+        started = time.monotonic()
+        usage = {}
+        try:
+            future = self._submit(self.llm_pool, deadline, self._clean, raw_ocr_text, usage, deadline)
+            cleaned_text = future.result(
+                timeout=self._stage_timeout(deadline, "mistral_clean", "mistral_classify", "gcs_image", "gcs_json"))
+            self.logger.info("Nettoyage du texte avec Mistral terminé")
+            self._report(on_stage, "mistral_clean", "done", started, dict(usage, llm_mode="two_call"))
+            return cleaned_text, True
+        except TimeoutError:
+            future.cancel()
+            self.logger.error("Mistral text cleaning timed out")
+            self._report(on_stage, "mistral_clean", "timeout", started)
+        except Exception as e:
+            self.logger.error(f"Exception during Mistral text cleaning: {str(e)}")
+            self._report(on_stage, "mistral_clean", "failed", started, self._failure_detail(e))
+        return raw_ocr_text, False
+
+    def _run_llm_two_call(self, raw_ocr_text, on_stage, deadline, tier=TIER_FULL, skip_clean=False):
+        """
+        Nettoyage Mistral puis classification du texte nettoyé (deux appels). Le nettoyage
+        est sauté en mode dégradé, quand le texte OCR est déjà fiable ou quand le budget
+        restant ne permet plus de le faire avant la classification.
+
+        :param tier: Niveau de traitement ('full', 'no_clean' ou 'light_model')
+        :param skip_clean: Sauter le nettoyage, jugé inutile par le filtre LLMGate
+        :return: Tuple (cleaned_text, structured_data, completed) où completed est False
+                 si une étape a été sautée, a échoué ou a dépassé son délai
+        """
+        llm_mode = "two_call" if tier == TIER_FULL else tier
+
+        # Step 2: Clean text with Mistral
+        reserve = sum(self.STAGE_RESERVES[s] for s in ("mistral_classify", "gcs_image", "gcs_json"))
+        if tier != TIER_FULL:
+            cleaned_text, completed = raw_ocr_text, False
+            self._report(on_stage, "mistral_clean", "skipped", detail={"reason": "degraded", "processing_tier": tier})
+        elif skip_clean:
+            # Sauté volontairement : le résultat reste complet
+            cleaned_text, completed = raw_ocr_text, True
+            llm_mode = "classify_only"
+            self._report(on_stage, "mistral_clean", "skipped", detail={"reason": "gate"})
+        elif deadline.allows(self.OPTIONAL_STAGE_MIN, reserve=reserve):
+            cleaned_text, completed = self._run_llm_clean(raw_ocr_text, on_stage, deadline)
+        else:
+            self.logger.warning(f"Nettoyage Mistral sauté, budget restant {deadline.remaining():.1f}s")
+            cleaned_text, completed = raw_ocr_text, False
+            self._report(on_stage, "mistral_clean", "skipped", detail={"reason": "deadline"})
+
+        # Step 3: Classify with Mistral
+        started = time.monotonic()
+        usage = {}
+        model = self.light_model if tier == TIER_LIGHT_MODEL else None
+        try:
+            future = self._submit(self.llm_pool, deadline, self._classify, cleaned_text, usage, deadline, model)
+            structured_data = future.result(
+                timeout=self._stage_timeout(deadline, "mistral_classify", "gcs_image", "gcs_json"))
+            self.logger.info("Classification des données avec Mistral terminée")
+            self._report(on_stage, "mistral_classify", "done", started,
+                         dict(usage, llm_mode=llm_mode, processing_tier=tier, **self._summary(structured_data)))
+        except TimeoutError:
+            future.cancel()
+            self.logger.error("Mistral classification timed out")
+            structured_data = {
+                "vendor": "Unknown (timeout)",
+                "date": datetime.now().strftime("%Y-%m-%d"),
+                "total": 0,
+                "line_items": []
+            }
+            self._report(on_stage, "mistral_classify", "timeout", started)
+            completed = False
+        except Exception as e:
+            self.logger.error(f"Exception during Mistral classification: {str(e)}")
+            structured_data = {
+                "vendor": "Unknown (error)",
+                "date": datetime.now().strftime("%Y-%m-%d"),
+                "total": 0,
+                "line_items": []
+            }
+            self._report(on_stage, "mistral_classify", "failed", started, self._failure_detail(e))
+            completed = False
+        return cleaned_text, structured_data, completed
+
+    def _run_llm_single_call(self, raw_ocr_text, on_stage, deadline):
+        """
+        Nettoyage et classification en un seul appel Mistral
+
+        :return: Tuple (cleaned_text, structured_data, completed)
+        """
+        started = time.monotonic()
+        usage = {}
+        try:
+            future = self._submit(self.llm_pool, deadline, self._clean_and_classify, raw_ocr_text, usage, deadline)
+            cleaned_text, structured_data = future.result(
+                timeout=self._stage_timeout(deadline, "mistral_single_call", "gcs_image", "gcs_json"))
+            self.logger.info("Nettoyage et classification avec Mistral terminés (un seul appel)")
+            self._report(on_stage, "mistral_clean", "done", started, {"llm_mode": "single_call"})
+            self._report(on_stage, "mistral_classify", "done", started,
+                         dict(usage, llm_mode="single_call", processing_tier=TIER_FULL,
+                              **self._summary(structured_data)))
+            return cleaned_text, structured_data, True
+        except TimeoutError:
+            future.cancel()
+            self.logger.error("Mistral cleaning/classification timed out")
+            status, detail = "timeout", {}
+            vendor = "Unknown (timeout)"
+        except Exception as e:
+            self.logger.error(f"Exception during Mistral cleaning/classification: {str(e)}")
+            status, detail = "failed", self._failure_detail(e)
+            vendor = "Unknown (error)"
+        self._report(on_stage, "mistral_clean", status, started, detail)
+        self._report(on_stage, "mistral_classify", status, started, detail)
+        structured_data = {
+            "vendor": vendor,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "total": 0,
+            "line_items": []
+        }
+        return raw_ocr_text, structured_data, False
+
+    def _run_deterministic(self, raw_ocr_text, on_stage):
+        """
+        Extraction des données sans Mistral (niveau 'deterministic')
+
+        :return: Tuple (cleaned_text, structured_data, completed)
+        """
+        started = time.monotonic()
+        detail = {"reason": "degraded", "processing_tier": TIER_DETERMINISTIC}
+        self._report(on_stage, "mistral_clean", "skipped", detail=detail)
+        try:
+            structured_data = self.ocr_processor.parse_receipt_text(raw_ocr_text)
+        except Exception as e:
+            self.logger.error(f"Erreur d'extraction déterministe: {str(e)}")
+            structured_data = {
+                "vendor": "Unknown",
+                "date": datetime.now().strftime("%Y-%m-%d"),
+                "total": 0,
+                "line_items": []
+            }
+        self._report(on_stage, "mistral_classify", "skipped", started, dict(detail, **self._summary(structured_data)))
+        return raw_ocr_text, structured_data, False
+
+    def _run_rules(self, raw_ocr_text, on_stage, rules_result):
+        """
+        Données extraites par les règles de regles_ocr, sans appel Mistral
+
+        :return: Tuple (cleaned_text, structured_data, completed)
+        """
+        started = time.monotonic()
+        structured_data = self.rule_engine.structured_data(rules_result)
+        detail = {"reason": "rules", "items_sum": rules_result["items_sum"], "processing_tier": TIER_FULL}
+        self._report(on_stage, "mistral_clean", "skipped", detail=detail)
+        self._report(on_stage, "mistral_classify", "skipped", started, dict(detail, **self._summary(structured_data)))
+        self.logger.info("Ticket extrait par les règles OCR, classification Mistral sautée")
+        return raw_ocr_text, structured_data, True
+
+    def _run_codes(self, source, on_stage, deadline):
+        """
+        Lecture des QR codes et codes-barres du ticket
+
+        :return: Contenu reconnu (voir receipt_codes.parse_payload) ou None
+        """
+        started = time.monotonic()
+        try:
+            future = self._submit(self.ocr_pool, deadline, read_receipt_codes, source)
+            payload = future.result(
+                timeout=self._stage_timeout(deadline, "codes", "mistral_classify", "gcs_image", "gcs_json"))
+        except TimeoutError:
+            future.cancel()
+            self.logger.warning("Lecture des codes du ticket trop longue, abandonnée")
+            self._report(on_stage, "codes", "timeout", started)
+            return None
+        except Exception as e:
+            self.logger.error(f"Erreur de lecture des codes du ticket: {str(e)}")
+            self._report(on_stage, "codes", "failed", started, self._failure_detail(e))
+            return None
+        detail = {"found": payload is not None}
+        if payload:
+            detail.update(format=payload["format"], code_type=payload["code_type"])
+            self.logger.info(f"Code {payload['code_type']} lu sur le ticket ({payload['format']})")
+        self._report(on_stage, "codes", "done", started, detail)
+        return payload
+
+    def _code_structured_data(self, payload):
+        """
+        Données d'un ticket dont le code porte la référence, le total, la date et l'enseigne
+        (ou un SIRET / numéro de TVA d'un magasin connu)
+
+        :return: Données structurées, ou None si le code ne suffit pas
+        """
+        if not payload or not all(payload.get(field) for field in ("invoice_number", "total", "date")):
+            return None
+        vendor = payload.get("vendor")
+        registry = getattr(self.db_integrator, "vendor_registry", None)
+        if not vendor and registry is not None:
+            store = registry.resolve(receipt_identifiers(payload))
+            vendor = store["nom"] if store else None
+        if not vendor:
+            return None
+        return {
+            "vendor": vendor,
+            "date": payload["date"],
+            "total": payload["total"],
+            "line_items": [],
+            "category": "Uncategorized",
+            "payment_method": "Unknown",
+            "invoice_number": payload["invoice_number"],
+            "siret": payload.get("siret", ""),
+            "tva_number": payload.get("tva_number", "")
+        }
+
+    def _run_template(self, raw_ocr_text, on_stage, template_result):
+        """
+        Données extraites avec le modèle de l'enseigne, sans appel Mistral
+
+        :return: Tuple (cleaned_text, structured_data, completed)
+        """
+        started = time.monotonic()
+        structured_data = template_result["data"]
+        detail = {"reason": "template", "template": template_result["key"], "score": template_result["score"],
+                  "processing_tier": TIER_FULL}
+        self._report(on_stage, "mistral_clean", "skipped", detail=detail)
+        self._report(on_stage, "mistral_classify", "skipped", started, dict(detail, **self._summary(structured_data)))
+        self.logger.info(f"Ticket extrait avec le modèle {template_result['key']}, classification Mistral sautée")
+        return raw_ocr_text, structured_data, True
+
+    def _run_gate_skip(self, raw_ocr_text, on_stage, gate_result):
+        """
+        Données extraites localement d'un texte OCR fiable et cohérent, sans appel Mistral
+
+        :return: Tuple (cleaned_text, structured_data, completed)
+        """
+        started = time.monotonic()
+        structured_data = gate_result["data"]
+        detail = {"reason": "gate", "items_sum": gate_result["arithmetic"]["items_sum"],
+                  "processing_tier": TIER_FULL}
+        self._report(on_stage, "mistral_clean", "skipped", detail=detail)
+        self._report(on_stage, "mistral_classify", "skipped", started, dict(detail, **self._summary(structured_data)))
+        self.logger.info("Texte OCR fiable et montants cohérents, appels Mistral sautés")
+        return raw_ocr_text, structured_data, True
+
+    def _identified_vendor(self, raw_ocr_text, template_result):
+        """
+        Enseigne d'un ticket identifiée de façon fiable : magasin du registre (SIRET ou
+        TVA) ou modèle d'enseigne reconnu. L'enseigne lue par les règles de regles_ocr
+        n'en fait pas partie : elle n'est souvent que la première ligne du ticket.
+
+        :return: Tuple (enseigne ou None, source : 'registry', 'template' ou None)
+        """
+        registry = getattr(self.db_integrator, "vendor_registry", None)
+        if registry is not None:
+            store = registry.resolve(receipt_identifiers({}, raw_ocr_text))
+            if store and store.get("nom") not in (None,) + PLACEHOLDERS:
+                return store["nom"], "registry"
+        if template_result and template_result.get("identity", 0) >= self.vendor_templates.min_score:
+            return template_result["data"]["vendor"], "template"
+        return None, None
+
+    def _gate_summary(self, gate_result, structured_data, raw_ocr_text):
+        """
+        Décision du filtre LLMGate et cohérence des montants finalement retenus
+
+        :return: Dictionnaire enregistré avec le ticket (decision, reason, needs_correction, ...)
+        """
+        subtotal, tax = extract_tax_amounts(raw_ocr_text)
+        final = check_arithmetic(structured_data.get("line_items"), structured_data.get("total"), subtotal, tax)
+        return {
+            "decision": gate_result["decision"],
+            "reason": gate_result["reason"],
+            "vendor_source": gate_result.get("vendor_source"),
+            "ocr_confidence": gate_result["ocr_confidence"],
+            "items_sum": final["items_sum"],
+            "difference": final["difference"],
+            "tva_rate": final["tva_rate"],
+            "needs_correction": not final["consistent"]
+        }
+
+    def process(self, filepath, filename, client_id=None, on_stage=None, image_bytes=None, deadline=None):
+        """
+        Traite un ticket sauvegardé localement ou reçu en mémoire
+
+        :param filepath: Chemin local de l'image (None si image_bytes est fourni)
+        :param filename: Nom du fichier envoyé
+        :param client_id: ID du client connecté (optionnel)
+        :param on_stage: Callback appelé à chaque fin d'étape
+        :param image_bytes: Contenu de l'image pour un upload en mémoire (sans fichier local)
+        :param deadline: Budget de temps du ticket (variable PIPELINE_DEADLINE par défaut)
+        :return: Dictionnaire résumant le résultat (receipt_id, transaction_id, ...)
+        """
+        deadline = deadline or Deadline.from_env()
+        combined_result = self.analyze(filepath, filename, on_stage, image_bytes, deadline)
+        return self.store_and_integrate(combined_result, filepath, filename, client_id, on_stage, image_bytes,
+                                        deadline)
+
+    def process_batch(self, items, max_workers=None):
+        """
+        Traite un lot de tickets : OCR, Mistral et stockage GCS en parallèle dans un pool
+        borné (les processeurs et leurs connexions sont partagés), puis intégration fidélité
+        de tout le lot dans une seule transaction
+
+        :param items: Liste de dictionnaires (filepath, filename, client_id, on_stage, image_bytes)
+        :param max_workers: Taille du pool (variable BATCH_CONCURRENCY, 4 par défaut)
+        :return: Liste, dans l'ordre des items, des résultats ou des exceptions levées
+        """
+        max_workers = max_workers or int(os.getenv("BATCH_CONCURRENCY", "4"))
+        self.logger.info(f"Traitement d'un lot de {len(items)} ticket(s) avec {max_workers} worker(s)")
+
+        def prepare(item):
+            # Le budget de chaque ticket démarre quand un thread du pool le prend en charge
+            deadline = Deadline.from_env()
+            combined_result = self.analyze(item['filepath'], item['filename'], item.get('on_stage'),
+                                           item.get('image_bytes'), deadline)
+            stored = self.store(combined_result, item['filepath'], item['filename'],
+                                item.get('client_id'), item.get('on_stage'), item.get('image_bytes'), deadline)
+            return combined_result, stored
+
+        prepared = [None] * len(items)
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="receipt-batch") as executor:
+            futures = {executor.submit(prepare, item): index for index, item in enumerate(items)}
+            for future, index in futures.items():
+                try:
+                    prepared[index] = future.result()
+                except Exception as e:
+                    self.logger.error(f"Échec du traitement de {items[index]['filename']}: {str(e)}")
+                    prepared[index] = e
+
+        # Intégration fidélité groupée
+        ready = [i for i, value in enumerate(prepared) if not isinstance(value, Exception)]
+        started = time.monotonic()
+        try:
+            outcomes = self.db_integrator.process_receipts_batch([
+                (prepared[i][0], prepared[i][1]["image_path"], items[i].get('client_id')) for i in ready
+            ])
+        except Exception as e:
+            self.logger.error(f"Exception during loyalty database batch integration: {str(e)}")
+            outcomes = [(False, None, str(e))] * len(ready)
+
+        results = list(prepared)
+        for i, db_outcome in zip(ready, outcomes):
+            combined_result, stored = prepared[i]
+            results[i] = self.finalize(combined_result, stored, items[i]['filepath'], items[i].get('client_id'),
+                                       db_outcome, started, items[i].get('on_stage'))
+        return results
+
+    def analyze(self, filepath, filename, on_stage=None, image_bytes=None, deadline=None):
+        """
+        OCR et extraction des données d'un ticket (ou résultat en cache pour une image connue)
+
+        :param filepath: Chemin local de l'image (None si image_bytes est fourni)
+        :param filename: Nom du fichier envoyé
+        :param on_stage: Callback appelé à chaque fin d'étape
+        :param image_bytes: Contenu de l'image pour un upload en mémoire
+        :param deadline: Budget de temps du ticket, partagé avec store()
+        :return: Données combinées du ticket
+        """
+        deadline = deadline or Deadline.from_env()
+        source = image_bytes if image_bytes is not None else filepath
+        self.logger.info(f"Début du traitement du ticket: {filename}")
+
+        # Une image déjà traitée passe directement au stockage et à l'intégration
+        image_hash = None
+        if self.result_cache is not None:
+            started = time.monotonic()
+            try:
+                image_hash = (self.result_cache.hash_bytes(image_bytes) if image_bytes is not None
+                              else self.result_cache.hash_file(filepath))
+                cached = self.result_cache.get_result(image_hash)
+            except OSError as e:
+                self.logger.error(f"Impossible de calculer l'empreinte de {filepath}: {str(e)}")
+                cached = None
+            if cached:
+                self.logger.info(f"Résultat trouvé dans le cache pour {filename} ({image_hash[:12]})")
+                structured_data = cached.get("structured_data") or {}
+                for stage in ("veryfi", "tesseract", "mistral_clean"):
+                    self._report(on_stage, stage, "cached", started)
+                self._report(on_stage, "mistral_classify", "cached", started,
+                             dict(self._summary(structured_data), processing_tier=TIER_FULL))
+                combined_result = self.combine_results(
+                    structured_data, {}, cached.get("ocr_text", ""), cached.get("cleaned_text", "")
+                )
+                combined_result["ocr_source"] = cached.get("ocr_source") or "cache"
+                if structured_data.get("invoice_number"):
+                    combined_result["invoice_number"] = structured_data["invoice_number"]
+                combined_result["image_sha256"] = image_hash
+                combined_result["from_cache"] = True
+                combined_result["processing_tier"] = TIER_FULL
+                return combined_result
+
+        # Step 0: QR code ou code-barres ; un contenu structuré complet évite l'OCR et Mistral
+        code_payload = self._run_codes(source, on_stage, deadline) if self.read_codes else None
+        code_data = self._code_structured_data(code_payload)
+        if code_data is not None:
+            detail = {"reason": "code", "processing_tier": TIER_FULL}
+            for stage in ("veryfi", "tesseract", "mistral_clean"):
+                self._report(on_stage, stage, "skipped", detail=detail)
+            self._report(on_stage, "mistral_classify", "skipped", detail=dict(detail, **self._summary(code_data)))
+            if image_hash:
+                self.result_cache.put_result(image_hash, "", "", code_data, "code")
+            combined_result = self.combine_results(code_data, {}, "", "")
+            combined_result["ocr_source"] = "code"
+            combined_result["processing_tier"] = TIER_FULL
+            combined_result["extraction_method"] = "code"
+            combined_result["invoice_number"] = code_data["invoice_number"]
+            combined_result["receipt_code"] = {key: code_payload[key] for key in ("format", "code_type")}
+            self._fill_known_store(combined_result)
+            if image_hash:
+                combined_result["image_sha256"] = image_hash
+            return combined_result
+
+        # Niveau de traitement selon la charge (file d'attente, latence Mistral)
+        tier = TIER_FULL
+        if self.degradation is not None:
+            tier = self.degradation.select_tier(self.llm_latency.percentile(90))
+
+        # Seuls les résultats complets sont mis en cache (pas de délai dépassé ni d'erreur)
+        cacheable = True
+
+        # Step 1: OCR (Veryfi, Tesseract en secours ou en parallèle)
+        ocr_meta = {}
+        if self.ocr_mode == "hedged":
+            veryfi_result, raw_ocr_text, ocr_source = self._run_ocr_hedged(source, on_stage, deadline, filename,
+                                                                           ocr_meta)
+        else:
+            veryfi_result, raw_ocr_text, ocr_source = self._run_ocr_sequential(source, on_stage, deadline, filename,
+                                                                               ocr_meta)
+        if not raw_ocr_text or raw_ocr_text.startswith("Error:"):
+            cacheable = False
+
+        # Texte Veryfi sans confiance par mot : confiance inconnue, jamais suffisante pour sauter Mistral
+        ocr_confidence = ocr_meta.get("confidence") if ocr_source == "tesseract" else None
+
+        # Modèle de mise en page de l'enseigne, appris sur ses tickets déjà classés
+        template_result = None
+        if self.vendor_templates is not None and raw_ocr_text and not raw_ocr_text.startswith("Error:"):
+            try:
+                template_result = self.vendor_templates.extract(raw_ocr_text)
+            except Exception as e:
+                self.logger.error(f"Erreur d'extraction par modèle d'enseigne: {str(e)}")
+
+        # Extraction par les règles de regles_ocr : un ticket complet n'a pas besoin de Mistral,
+        # à condition que son enseigne soit confirmée par le registre ou un modèle d'enseigne
+        rules_result = None
+        if self.rule_engine is not None and raw_ocr_text and not raw_ocr_text.startswith("Error:"):
+            try:
+                confirmed_vendor, _ = self._identified_vendor(raw_ocr_text, template_result)
+                rules_result = self.rule_engine.extract(raw_ocr_text, ocr_confidence, confirmed_vendor)
+            except Exception as e:
+                self.logger.error(f"Erreur d'extraction par règles: {str(e)}")
+        template_complete = bool(template_result and template_result["complete"])
+
+        # Confiance OCR et cohérence des montants : Mistral n'est appelé que si nécessaire
+        gate_result = None
+        if (self.llm_gate is not None and not (rules_result and rules_result["complete"]) and not template_complete
+                and tier != TIER_DETERMINISTIC and raw_ocr_text and not raw_ocr_text.startswith("Error:")):
+            try:
+                vendor, vendor_source = self._identified_vendor(raw_ocr_text, template_result)
+                gate_result = self.llm_gate.evaluate(raw_ocr_text, ocr_confidence, vendor)
+                gate_result["vendor_source"] = vendor_source
+            except Exception as e:
+                self.logger.error(f"Erreur de vérification des montants: {str(e)}")
+
+        # Steps 2-3: Mistral (nettoyage puis classification, ou un seul appel), allégé en mode dégradé.
+        # Seul le niveau complet est mis en cache : un ticket dégradé sera retraité s'il est renvoyé
+        llm_started = time.monotonic()
+        extraction_method = "llm"
+        if rules_result and rules_result["complete"]:
+            cleaned_text, structured_data, llm_ok = self._run_rules(raw_ocr_text, on_stage, rules_result)
+            extraction_method = "rules"
+            # Extraction complète malgré la charge : rien à retraiter
+            tier = TIER_FULL
+        elif template_complete:
+            cleaned_text, structured_data, llm_ok = self._run_template(raw_ocr_text, on_stage, template_result)
+            extraction_method = "template"
+            tier = TIER_FULL
+        elif tier == TIER_DETERMINISTIC:
+            cleaned_text, structured_data, llm_ok = self._run_deterministic(raw_ocr_text, on_stage)
+            extraction_method = "deterministic"
+        elif gate_result and gate_result["decision"] == DECISION_SKIP:
+            cleaned_text, structured_data, llm_ok = self._run_gate_skip(raw_ocr_text, on_stage, gate_result)
+            extraction_method = "gate"
+            tier = TIER_FULL
+        elif gate_result and gate_result["decision"] == DECISION_CLASSIFY_ONLY:
+            cleaned_text, structured_data, llm_ok = self._run_llm_two_call(raw_ocr_text, on_stage, deadline, tier,
+                                                                           skip_clean=True)
+        elif tier == TIER_FULL and self.llm_mode == "single_call":
+            cleaned_text, structured_data, llm_ok = self._run_llm_single_call(raw_ocr_text, on_stage, deadline)
+        else:
+            cleaned_text, structured_data, llm_ok = self._run_llm_two_call(raw_ocr_text, on_stage, deadline, tier)
+        if extraction_method == "llm":
+            self.llm_latency.record(time.monotonic() - llm_started)
+            if self.vendor_templates is not None and llm_ok:
+                # Ticket classé par Mistral : il complète le modèle de son enseigne
+                try:
+                    self.vendor_templates.learn(raw_ocr_text, structured_data)
+                except Exception as e:
+                    self.logger.error(f"Erreur d'apprentissage du modèle d'enseigne: {str(e)}")
+        cacheable = cacheable and llm_ok and "error" not in structured_data
+
+        # Une classification vide (réponse Mistral illisible) n'est pas mise en cache
+        if str(structured_data.get("vendor", "")).startswith("Unknown") and not structured_data.get("total"):
+            cacheable = False
+        if image_hash and cacheable:
+            self.result_cache.put_result(image_hash, raw_ocr_text, cleaned_text, structured_data, ocr_source)
+
+        combined_result = self.combine_results(structured_data, veryfi_result, raw_ocr_text, cleaned_text)
+        combined_result["ocr_source"] = ocr_source
+        if ocr_source == "tesseract" and ocr_meta:
+            # Moteur, stratégie et PSM retenus avec leur confiance moyenne, et lignes avec les boîtes des mots
+            combined_result["tesseract"] = self._ocr_detail(ocr_meta)
+            combined_result["ocr_lines"] = ocr_meta.get("lines", [])
+        combined_result["llm_mode"] = self.llm_mode
+        combined_result["processing_tier"] = tier
+        combined_result["extraction_method"] = extraction_method
+        if rules_result is not None:
+            # Champs lus par les règles, enregistrés dans extractions_ocr lors de l'intégration
+            combined_result["rule_extractions"] = rules_result["extractions"]
+            combined_result["rules_status"] = rules_result["reason"]
+        if structured_data.get("invoice_number"):
+            combined_result["invoice_number"] = structured_data["invoice_number"]
+        if code_payload:
+            # Référence lue dans le code, plus fiable que celle du texte OCR (détection exacte des doublons)
+            combined_result["invoice_number"] = code_payload["invoice_number"]
+            combined_result["receipt_code"] = {key: code_payload[key] for key in ("format", "code_type")}
+        self._fill_known_store(combined_result)
+        if template_result is not None:
+            combined_result["vendor_template"] = {key: template_result[key]
+                                                  for key in ("key", "receipts", "score", "complete")}
+        if gate_result is not None:
+            combined_result["llm_gate"] = self._gate_summary(gate_result, structured_data, raw_ocr_text)
+            combined_result["needs_correction"] = combined_result["llm_gate"]["needs_correction"]
+        if image_hash:
+            combined_result["image_sha256"] = image_hash
+        return combined_result
+
+    def _fill_known_store(self, combined_result):
+        """
+        Complète l'adresse, le téléphone et l'email d'un ticket dont le SIRET ou le
+        numéro de TVA désigne un magasin déjà enregistré
+        """
+        registry = getattr(self.db_integrator, "vendor_registry", None)
+        if registry is None:
+            return
+        try:
+            store = registry.resolve(receipt_identifiers(combined_result, combined_result.get("ocr_text")))
+        except Exception as e:
+            self.logger.error(f"Erreur de recherche du magasin dans le registre: {str(e)}")
+            return
+        if store is None:
+            return
+        combined_result["store_id"] = store["magasin_id"]
+        for key, column in (("store_address", "adresse"), ("store_phone", "telephone"), ("store_email", "email")):
+            if not combined_result.get(key) and store.get(column) not in (None,) + PLACEHOLDERS:
+                combined_result[key] = store[column]
+
+    def combine_results(self, structured_data, veryfi_result, raw_ocr_text, cleaned_text):
+        """
+        Fusionne les données Mistral et Veryfi en un seul dictionnaire de ticket
+
+        :param structured_data: Données classées par Mistral
+        :param veryfi_result: Réponse Veryfi (éventuellement vide)
+        :param raw_ocr_text: Texte OCR brut
+        :param cleaned_text: Texte nettoyé
+        :return: Données combinées du ticket
+        """
+        return {
+            "vendor": structured_data.get("vendor", veryfi_result.get("vendor_name", "Unknown")),
+            "date": structured_data.get("date", veryfi_result.get("date", "")),
+            "total": structured_data.get("total", veryfi_result.get("total", 0)),
+            "line_items": structured_data.get("line_items", veryfi_result.get("line_items", [])),
+            "category": structured_data.get("category", veryfi_result.get("category", "Uncategorized")),
+            "payment_method": structured_data.get("payment_method", veryfi_result.get("payment_type", "Unknown")),
+            "store_address": structured_data.get("store_address", veryfi_result.get("vendor_address", "")),
+            "store_phone": structured_data.get("store_phone", veryfi_result.get("vendor_phone", "")),
+            "store_email": structured_data.get("store_email", veryfi_result.get("vendor_email", "")),
+            "store_website": structured_data.get("store_website", veryfi_result.get("vendor_website", "")),
+            "tax": structured_data.get("tax", veryfi_result.get("tax", 0)),
+            "subtotal": structured_data.get("subtotal", veryfi_result.get("subtotal", 0)),
+            "siret": structured_data.get("siret", ""),
+            "tva_number": structured_data.get("tva_number", ""),
+            "capital": structured_data.get("capital", ""),
+            "naf_code": structured_data.get("naf_code", ""),
+            "cashier": structured_data.get("cashier", ""),
+            "client_type": structured_data.get("client_type", ""),
+            "ocr_text": raw_ocr_text,
+            "cleaned_text": cleaned_text,
+            "veryfi_data": veryfi_result,
+            "storage_type": "Google Cloud Storage"
+        }
+
+    def store_and_integrate(self, combined_result, filepath, filename, client_id=None, on_stage=None,
+                            image_bytes=None, deadline=None):
+        """
+        Sauvegarde l'image et le JSON dans GCS puis intègre le ticket dans la base de fidélité
+
+        :param combined_result: Données combinées du ticket
+        :param filepath: Chemin local de l'image (None pour un upload en mémoire)
+        :param filename: Nom du fichier envoyé
+        :param client_id: ID du client connecté (optionnel)
+        :param on_stage: Callback appelé à chaque fin d'étape
+        :param image_bytes: Contenu de l'image pour un upload en mémoire
+        :param deadline: Budget de temps restant du ticket
+        :return: Dictionnaire résumant le résultat
+        """
+        stored = self.store(combined_result, filepath, filename, client_id, on_stage, image_bytes, deadline)
+
+        # Integrate with loyalty database
+        started = time.monotonic()
+        try:
+            db_outcome = self.db_integrator.process_receipt_data(
+                combined_result,
+                stored["image_path"],
+                client_id
+            )
+        except Exception as e:
+            self.logger.error(f"Exception during loyalty database integration: {str(e)}")
+            db_outcome = (False, None, str(e))
+        return self.finalize(combined_result, stored, filepath, client_id, db_outcome, started, on_stage)
+
+    def store(self, combined_result, filepath, filename, client_id=None, on_stage=None, image_bytes=None,
+              deadline=None):
+        """
+        Sauvegarde l'image et le JSON du ticket dans GCS, avec une copie JSON locale
+
+        :param combined_result: Données combinées du ticket (complétées par receipt_id et image_url)
+        :param filepath: Chemin local de l'image (None pour un upload en mémoire)
+        :param filename: Nom du fichier envoyé
+        :param client_id: ID du client connecté (optionnel)
+        :param on_stage: Callback appelé à chaque fin d'étape
+        :param image_bytes: Contenu de l'image, envoyé directement à GCS sans fichier local
+        :param deadline: Budget de temps restant du ticket
+        :return: Dictionnaire (receipt_id, image_url, image_path, json_blob_name, local_json_path)
+        """
+        deadline = deadline or Deadline.from_env()
+        if client_id:
+            self.logger.info(f"Client connecté ID: {client_id}")
+            combined_result["client_id"] = client_id
+
+        # Generate receipt ID
+        current_date = datetime.now().strftime('%Y%m%d_%H%M%S')
+        ticket_uuid = str(uuid.uuid4())[:8]
+        receipt_id = f"receipt_{current_date}_{ticket_uuid}"
+        self.logger.info(f"ID de ticket généré: {receipt_id}")
+
+        # Upload image to GCS with timeout
+        image_blob_name = f"receipts/images/{receipt_id}.jpg"
+        image_url = None
+
+        started = time.monotonic()
+        try:
+            if image_bytes is not None:
+                content_type = mimetypes.guess_type(filename)[0] or "image/jpeg"
+                future = self._submit(self.storage_pool, deadline, self.storage_manager.upload_bytes,
+                                      image_bytes, image_blob_name, content_type)
+            else:
+                future = self._submit(self.storage_pool, deadline, self.storage_manager.upload_file,
+                                      filepath, image_blob_name)
+            image_url = future.result(timeout=self._stage_timeout(deadline, "gcs_image", "gcs_json"))
+            combined_result["image_url"] = image_url
+            self.logger.info(f"Image sauvegardée dans GCP: {image_blob_name}")
+            self._report(on_stage, "gcs_image", "done", started)
+        except TimeoutError:
+            future.cancel()
+            self.logger.error("GCS image upload timed out")
+            combined_result["image_url"] = f"/static/uploads/{filename}"
+            self._report(on_stage, "gcs_image", "timeout", started)
+        except Exception as e:
+            self.logger.error(f"Error uploading image to GCS: {str(e)}")
+            combined_result["image_url"] = f"/static/uploads/{filename}"
+            self._report(on_stage, "gcs_image", "failed", started, self._failure_detail(e))
+
+        if image_url is None and image_bytes is not None:
+            # Sans copie dans GCS, conserver l'image reçue en mémoire dans le dossier d'upload
+            os.makedirs(self.upload_dir, exist_ok=True)
+            with open(os.path.join(self.upload_dir, filename), 'wb') as f:
+                f.write(image_bytes)
+
+        combined_result["receipt_id"] = receipt_id
+        combined_result["processed_at"] = datetime.now().isoformat()
+
+        # Save JSON data to GCS with timeout
+        json_blob_name = f"receipts/json/{receipt_id}.json"
+        json_data = json.dumps(combined_result, indent=2, default=str)
+
+        started = time.monotonic()
+        try:
+            future = self._submit(self.storage_pool, deadline, self.storage_manager.upload_from_string,
+                                  json_data, json_blob_name, "application/json")
+            future.result(timeout=self._stage_timeout(deadline, "gcs_json"))
+            self.logger.info(f"Données du ticket sauvegardées dans GCP Storage avec l'ID: {receipt_id}")
+            self._report(on_stage, "gcs_json", "done", started, {"receipt_id": receipt_id})
+        except TimeoutError:
+            future.cancel()
+            self.logger.error("GCS JSON upload timed out")
+            self._report(on_stage, "gcs_json", "timeout", started)
+        except Exception as e:
+            self.logger.error(f"Error uploading JSON to GCS: {str(e)}")
+            self._report(on_stage, "gcs_json", "failed", started, self._failure_detail(e))
+
+        # Save JSON locally as fallback
+        json_dir = os.path.join(self.data_dir, 'json')
+        os.makedirs(json_dir, exist_ok=True)
+        local_json_path = os.path.join(json_dir, f"{receipt_id}.json")
+        with open(local_json_path, 'w') as f:
+            f.write(json_data)
+        self.logger.info(f"Données du ticket sauvegardées localement: {local_json_path}")
+
+        return {
+            "receipt_id": receipt_id,
+            "image_url": image_url,
+            "image_path": image_url or f"/static/uploads/{filename}",
+            "json_blob_name": json_blob_name,
+            "local_json_path": local_json_path
+        }
+
+    def finalize(self, combined_result, stored, filepath, client_id, db_outcome, started=None, on_stage=None):
+        """
+        Publie le résultat de l'intégration fidélité, met à jour le JSON et nettoie le fichier local
+
+        :param combined_result: Données combinées du ticket
+        :param stored: Dictionnaire renvoyé par store()
+        :param filepath: Chemin local de l'image
+        :param client_id: ID du client connecté (optionnel)
+        :param db_outcome: Tuple (success, transaction_id, message) de l'intégration
+        :param started: Horodatage time.monotonic() du début de l'intégration
+        :param on_stage: Callback appelé à chaque fin d'étape
+        :return: Dictionnaire résumant le résultat
+        """
+        db_success, transaction_id, db_message = db_outcome
+        try:
+            if db_success:
+                self.logger.info(f"Ticket intégré dans la base de données de fidélité. ID Transaction: {transaction_id}")
+                combined_result["loyalty_transaction_id"] = transaction_id
+
+                # Update JSON with transaction ID
+                json_data = json.dumps(combined_result, indent=2, default=str)
+                try:
+                    self.storage_manager.upload_from_string(json_data, stored["json_blob_name"], "application/json")
+                except Exception as e:
+                    self.logger.error(f"Error updating JSON in GCS: {str(e)}")
+
+                # Update local JSON
+                with open(stored["local_json_path"], 'w') as f:
+                    f.write(json_data)
+                self._report(on_stage, "loyalty_db", "done", started, {"transaction_id": transaction_id})
+            else:
+                self.logger.error(f"Échec de l'intégration du ticket avec la base de données de fidélité: {db_message}")
+                self._report(on_stage, "loyalty_db", "failed", started, {"error": db_message})
+        except Exception as e:
+            self.logger.error(f"Exception during loyalty database integration: {str(e)}")
+            db_success = False
+            transaction_id = None
+            db_message = str(e)
+            self._report(on_stage, "loyalty_db", "failed", started, {"error": str(e)})
+
+        # Try to remove local file
+        image_url = stored["image_url"]
+        try:
+            if filepath and os.path.exists(filepath) and image_url and image_url.startswith("https://"):
+                os.remove(filepath)
+                self.logger.info(f"Fichier local supprimé: {filepath}")
+        except Exception as e:
+            self.logger.error(f"Error removing local file: {str(e)}")
+
+        self.logger.info(f"Traitement du ticket terminé avec succès")
+
+        return {
+            'success': True,
+            'receipt_id': stored["receipt_id"],
+            'db_integration': db_success,
+            'db_message': db_message,
+            'transaction_id': transaction_id if db_success else None,
+            'client_id': client_id,
+            'storage_type': "Google Cloud Storage"
+        }
@@ -0,0 +1,138 @@
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# Taille maximale (plus grand côté) de l'image réduite utilisée pour chercher le ticket
+DETECTION_MAX_SIDE = 800
+# Part minimale de la photo occupée par un contour pour être retenu comme ticket
+MIN_AREA_RATIO = 0.10
+# Au-delà, le ticket remplit déjà la photo (scan, photo recadrée) : rien à découper
+MAX_AREA_RATIO = 0.95
+# Rapport grand côté / petit côté d'un ticket de caisse (du ticket court au très long)
+MIN_ASPECT_RATIO = 1.2
+MAX_ASPECT_RATIO = 20.0
+
+
+def order_corners(points: np.ndarray) -> np.ndarray:
+    """
+    Ordonne quatre coins : haut gauche, haut droit, bas droit, bas gauche
+
+    :param points: Tableau (4, 2) de coordonnées
+    :return: Tableau (4, 2) float32 ordonné
+    """
+    points = points.astype(np.float32)
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    return np.array([
+        points[np.argmin(sums)],
+        points[np.argmin(diffs)],
+        points[np.argmax(sums)],
+        points[np.argmax(diffs)]
+    ], dtype=np.float32)
+
+
+def _candidate_masks(gray: np.ndarray):
+    """Masques binaires dans lesquels chercher le contour du ticket : bords, puis papier clair"""
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    edges = cv2.Canny(blurred, 50, 150)
+    # Refermer les bords interrompus (plis, ombres)
+    yield cv2.dilate(edges, np.ones((5, 5), np.uint8), iterations=1)
+    # Papier blanc sur fond plus sombre
+    _, paper = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    yield cv2.morphologyEx(paper, cv2.MORPH_CLOSE, np.ones((9, 9), np.uint8))
+
+
+def find_receipt_corners(image: np.ndarray, min_area_ratio: float = MIN_AREA_RATIO) -> Optional[np.ndarray]:
+    """
+    Cherche les quatre coins du ticket dans une photo
+
+    Seul un contour convexe à quatre sommets aux proportions d'un ticket est
+    retenu : un contour quelconque (souvent un bloc de texte) couperait l'en-tête
+    ou le total, la photo est alors gardée entière.
+
+    :param image: Image BGR
+    :param min_area_ratio: Part minimale de la photo occupée par le ticket
+    :return: Tableau (4, 2) des coins dans l'image d'origine, ou None si rien n'est trouvé
+    """
+    height, width = image.shape[:2]
+    scale = min(1.0, DETECTION_MAX_SIDE / max(height, width))
+    small = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA) \
+        if scale < 1.0 else image
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    min_area = min_area_ratio * gray.shape[0] * gray.shape[1]
+
+    for mask in _candidate_masks(gray):
+        contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        contours = [c for c in contours if cv2.contourArea(c) >= min_area]
+        if not contours:
+            continue
+        contours.sort(key=cv2.contourArea, reverse=True)
+        for contour in contours[:5]:
+            approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+            if len(approx) == 4 and cv2.isContourConvex(approx) and _paper_like(approx.reshape(4, 2)):
+                return approx.reshape(4, 2).astype(np.float32) / scale
+    return None
+
+
+def _paper_like(corners: np.ndarray) -> bool:
+    """Quadrilatère aux proportions d'un ticket (côtés opposés comparables, allongé sans être une bande)"""
+    tl, tr, br, bl = order_corners(corners)
+    widths = np.linalg.norm(tr - tl), np.linalg.norm(br - bl)
+    heights = np.linalg.norm(bl - tl), np.linalg.norm(br - tr)
+    if min(widths + heights) <= 0:
+        return False
+    # Perspective modérée : un côté ne fait pas plus du double de son opposé
+    if max(widths) > 2 * min(widths) or max(heights) > 2 * min(heights):
+        return False
+    # Grand côté sur petit côté : un ticket photographié de travers reste accepté
+    aspect = max(max(heights), max(widths)) / min(max(heights), max(widths))
+    return MIN_ASPECT_RATIO <= aspect <= MAX_ASPECT_RATIO
+
+
+def warp_receipt(image: np.ndarray, corners: np.ndarray) -> np.ndarray:
+    """
+    Redresse le ticket délimité par quatre coins (correction de perspective et d'inclinaison)
+
+    :param image: Image BGR
+    :param corners: Tableau (4, 2) des coins
+    :return: Image du ticket seul, vue de face
+    """
+    tl, tr, br, bl = order_corners(corners)
+    width = int(max(np.linalg.norm(br - bl), np.linalg.norm(tr - tl)))
+    height = int(max(np.linalg.norm(tr - br), np.linalg.norm(tl - bl)))
+    target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(np.array([tl, tr, br, bl], dtype=np.float32), target)
+    return cv2.warpPerspective(image, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+
+
+def crop_receipt(image: np.ndarray, min_area_ratio: float = MIN_AREA_RATIO,
+                 max_area_ratio: float = MAX_AREA_RATIO) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """
+    Recadre une photo sur le ticket avant le prétraitement OCR
+
+    :param image: Image BGR
+    :param min_area_ratio: Part minimale de la photo occupée par le ticket
+    :param max_area_ratio: Part au-delà de laquelle la photo est gardée entière
+    :return: Tuple (image recadrée ou image d'origine, informations sur la détection)
+    """
+    try:
+        corners = find_receipt_corners(image, min_area_ratio)
+    except cv2.error as e:
+        logger.warning(f"Détection du ticket impossible: {str(e)}")
+        corners = None
+    if corners is None:
+        return image, {"detected": False}
+
+    area_ratio = float(cv2.contourArea(order_corners(corners))) / (image.shape[0] * image.shape[1])
+    if area_ratio >= max_area_ratio:
+        return image, {"detected": True, "cropped": False, "area_ratio": round(area_ratio, 3)}
+
+    warped = warp_receipt(image, corners)
+    if min(warped.shape[:2]) < 32:
+        return image, {"detected": False}
+    return warped, {"detected": True, "cropped": True, "area_ratio": round(area_ratio, 3)}
@@ -1,12 +1,17 @@
 import os
 import json
 import time
+import base64
+import tempfile
 import pandas as pd
 from datetime import datetime
 import veryfi  # Using the Veryfi client library
 import requests
 from mistral_llm_service import MistralLLMService
 
+# Document categories sent to Veryfi
+VERYFI_CATEGORIES = ["Grocery", "Food", "Restaurant"]
+
 class ReceiptProcessor:
     def __init__(self):
         """Initialize the Veryfi client."""
@@ -35,6 +40,15 @@ class ReceiptProcessor:
         """Process receipt using Veryfi API then enhance with LLM"""
         # Get raw OCR data from Veryfi
         veryfi_data = self._call_veryfi_api(image_path)
+        return self._with_ocr_text(veryfi_data)
+
+    def process_image_bytes(self, image_bytes, file_name="receipt.jpg"):
+        """Process an in-memory receipt image (upload buffer) with the Veryfi API"""
+        veryfi_data = self._call_veryfi_api_bytes(image_bytes, file_name)
+        return self._with_ocr_text(veryfi_data)
+
+    def _with_ocr_text(self, veryfi_data):
+        """Ensure the Veryfi response has an ocr_text, rebuilt from line items if needed"""
         ocr_text = veryfi_data.get('ocr_text', '')
         
         # If OCR text is empty, create a simple text representation from the line items
@@ -63,18 +77,40 @@ class ReceiptProcessor:
     def _call_veryfi_api(self, image_path):
         """Call Veryfi API to process receipt image"""
         try:
-            # Use the client directly instead of credentials dict
-            with open(image_path, 'rb') as image_file:
-                response = self.client.process_document(
-                    file_path=image_path,
-                    categories=["Grocery", "Food", "Restaurant"]
-                )
+            # Use the client directly instead of credentials dict (it reads the file itself)
+            response = self.client.process_document(
+                file_path=image_path,
+                categories=VERYFI_CATEGORIES
+            )
                 
             return response
         except Exception as e:
             print(f"Veryfi API error: {str(e)}")
             raise Exception(f"Veryfi API error: {str(e)}")
 
+    def _call_veryfi_api_bytes(self, image_bytes, file_name):
+        """Call Veryfi API with the image content instead of a file path"""
+        try:
+            if hasattr(self.client, 'process_document_base64string'):
+                response = self.client.process_document_base64string(
+                    base64_encoded_string=base64.b64encode(image_bytes).decode('ascii'),
+                    file_name=file_name,
+                    categories=VERYFI_CATEGORIES
+                )
+                return response
+        except Exception as e:
+            print(f"Veryfi API error: {str(e)}")
+            raise Exception(f"Veryfi API error: {str(e)}")
+
+        # Older clients only accept a file path
+        suffix = os.path.splitext(file_name)[1] or '.jpg'
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+            tmp.write(image_bytes)
+        try:
+            return self._call_veryfi_api(tmp.name)
+        finally:
+            os.remove(tmp.name)
+
     def save_receipt_data(self, result, image_path, base_dir):
         """Save processed data with LLM-enhanced items"""
         receipt_id = f"receipt_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
@@ -116,6 +152,7 @@ class ReceiptProcessor:
     def _verify_mistral_connection(self):
         """Verify Mistral API connectivity"""
         test_prompt = '{"status": "ok"}'
-        response = self.llm_service.generate(test_prompt)
+        # Connectivity probe: always reach the API, never the prompt cache
+        response = self.llm_service.generate(test_prompt, use_cache=False)
         if not response or "ok" not in response:
             raise ConnectionError("Failed to connect to Mistral API")
@@ -0,0 +1,186 @@
+import os
+import re
+import logging
+import threading
+
+import numpy as np
+
+# Taux de TVA français
+TVA_RATES = np.array([0.021, 0.055, 0.10, 0.20])
+# Écart toléré sur les montants (arrondis au centime)
+AMOUNT_TOLERANCE = 0.02
+
+SUBTOTAL_PATTERN = re.compile(r'(?:sous[ -]?total|total\s*h\.?t\.?)[^\n\d]{0,20}(\d+[.,]\d{2})', re.IGNORECASE)
+TAX_LINE_PATTERN = re.compile(r'^.*\b(?:tva|taxe)\b.*?(\d+[.,]\d{2})\s*(?:€|EUR)?\s*$', re.IGNORECASE | re.MULTILINE)
+
+# Décisions du filtre : Mistral sauté, classification seule, ou nettoyage et classification
+DECISION_SKIP = "skip_llm"
+DECISION_CLASSIFY_ONLY = "classify_only"
+DECISION_FULL = "full_llm"
+
+
+def _amount(value):
+    """Montant lu sur le ticket ('12,50' ou 12.5)"""
+    return float(str(value).replace(',', '.'))
+
+
+def extract_tax_amounts(text):
+    """
+    Sous-total HT et montant de TVA lus dans le texte OCR
+
+    :param text: Texte OCR
+    :return: Tuple (sous-total ou None, somme des lignes de TVA ou None)
+    """
+    subtotals = SUBTOTAL_PATTERN.findall(text or "")
+    subtotal = _amount(subtotals[-1]) if subtotals else None
+    taxes = [_amount(value) for value in TAX_LINE_PATTERN.findall(text or "")]
+    return subtotal, (round(sum(taxes), 2) if taxes else None)
+
+
+def check_arithmetic(line_items, total, subtotal=None, tax=None, tolerance=AMOUNT_TOLERANCE):
+    """
+    Vérifie que les articles, le sous-total, la TVA et le total concordent
+
+    :param line_items: Articles (quantity, price unitaire)
+    :param total: Total TTC du ticket
+    :param subtotal: Sous-total HT (optionnel)
+    :param tax: Montant de TVA (optionnel)
+    :param tolerance: Écart toléré en euros
+    :return: Dictionnaire (consistent, items_sum, difference, tva_rate, checks)
+    """
+    quantities = np.array([float(item.get("quantity") or 1) for item in line_items or []], dtype=float)
+    prices = np.array([float(item.get("price") or 0) for item in line_items or []], dtype=float)
+    items_sum = float(np.round((quantities * prices).sum(), 2)) if len(prices) else 0.0
+    total = float(total or 0)
+
+    checks = {"items": len(prices) > 0, "total": total > 0}
+    difference = round(items_sum - total, 2)
+    # Prix TTC (cas courant) ou prix HT additionnés au sous-total
+    checks["items_match_total"] = bool(len(prices) and abs(difference) <= tolerance)
+    if subtotal is not None and len(prices):
+        checks["items_match_subtotal"] = bool(abs(items_sum - subtotal) <= tolerance)
+    if subtotal is not None and tax is not None:
+        checks["subtotal_plus_tax"] = bool(abs(subtotal + tax - total) <= tolerance)
+
+    # Taux de TVA le plus proche du rapport TVA / HT (HT = total - TVA à défaut de sous-total)
+    tva_rate = None
+    if tax:
+        base = subtotal if subtotal else total - tax
+        if base > 0:
+            gaps = np.abs(TVA_RATES - tax / base)
+            index = int(np.argmin(gaps))
+            if gaps[index] <= 0.005:
+                tva_rate = float(TVA_RATES[index])
+            checks["tva_rate_known"] = tva_rate is not None
+
+    consistent = checks["items"] and checks["total"] and (
+        checks["items_match_total"] or checks.get("items_match_subtotal", False)
+    ) and checks.get("subtotal_plus_tax", True)
+    return {
+        "consistent": bool(consistent),
+        "items_sum": items_sum,
+        "difference": difference,
+        "tva_rate": tva_rate,
+        "checks": checks
+    }
+
+
+class LLMGate:
+    """
+    Décide si un ticket a besoin de Mistral à partir de la confiance OCR et de la
+    cohérence arithmétique des données extraites localement.
+
+    - texte OCR peu fiable : nettoyage et classification Mistral ;
+    - texte fiable, articles cohérents avec le total, date trouvée et enseigne identifiée
+      par le registre, un modèle ou une règle : pas d'appel Mistral ;
+    - articles cohérents mais enseigne non identifiée, date manquante ou confiance OCR
+      inconnue (texte Veryfi) : classification seule ;
+    - articles incohérents : nettoyage et classification, ticket à corriger.
+
+    L'enseigne de parse_fn (première ligne lisible du ticket, souvent un en-tête du
+    type BIENVENUE) ne suffit jamais à se passer de Mistral.
+    """
+    def __init__(self, parse_fn, min_ocr_confidence=None):
+        """
+        :param parse_fn: Extraction déterministe texte -> données structurées
+                         (SimplifiedReceiptProcessor.parse_receipt_text)
+        :param min_ocr_confidence: Confiance Tesseract moyenne (0-100) à partir de laquelle le texte
+                                   est jugé fiable (variable LLM_GATE_MIN_CONFIDENCE, 80 par défaut)
+        """
+        self.parse_fn = parse_fn
+        if min_ocr_confidence is None:
+            min_ocr_confidence = float(os.getenv("LLM_GATE_MIN_CONFIDENCE", "80"))
+        self.min_ocr_confidence = min_ocr_confidence
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._decisions = {DECISION_SKIP: 0, DECISION_CLASSIFY_ONLY: 0, DECISION_FULL: 0}
+
+    def evaluate(self, text, ocr_confidence=None, vendor=None):
+        """
+        :param text: Texte OCR
+        :param ocr_confidence: Confiance Tesseract moyenne, None si inconnue (texte Veryfi)
+        :param vendor: Enseigne identifiée par le registre, un modèle ou une règle (None sinon)
+        :return: Dictionnaire (decision, reason, needs_correction, data, arithmetic)
+        """
+        data = self.parse_fn(text)
+        if vendor:
+            data["vendor"] = vendor
+        subtotal, tax = extract_tax_amounts(text)
+        arithmetic = check_arithmetic(data.get("line_items"), data.get("total"), subtotal, tax)
+
+        if ocr_confidence is not None and ocr_confidence < self.min_ocr_confidence:
+            decision, reason = DECISION_FULL, "low_ocr_confidence"
+        elif not arithmetic["consistent"]:
+            decision, reason = DECISION_FULL, "items_mismatch"
+        elif ocr_confidence is None:
+            decision, reason = DECISION_CLASSIFY_ONLY, "unknown_ocr_confidence"
+        elif not vendor:
+            decision, reason = DECISION_CLASSIFY_ONLY, "vendor_unresolved"
+        elif data.get("date") == "Unknown":
+            decision, reason = DECISION_CLASSIFY_ONLY, "missing_fields"
+        else:
+            decision, reason = DECISION_SKIP, "consistent"
+
+        with self._lock:
+            self._decisions[decision] += 1
+        return {
+            "decision": decision,
+            "reason": reason,
+            "ocr_confidence": ocr_confidence,
+            "needs_correction": not arithmetic["consistent"],
+            "data": data,
+            "arithmetic": arithmetic
+        }
+
+    def stats(self):
+        """
+        :return: Dictionnaire (décisions, part des tickets sans aucun appel Mistral)
+        """
+        with self._lock:
+            decisions = dict(self._decisions)
+        evaluated = sum(decisions.values())
+        return {
+            "min_ocr_confidence": self.min_ocr_confidence,
+            "decisions": decisions,
+            "skip_rate": round(decisions[DECISION_SKIP] / evaluated, 3) if evaluated else 0.0
+        }
+
+    @staticmethod
+    def merge_stats(reports):
+        """
+        Cumule les indicateurs stats() publiés par plusieurs processus worker
+
+        :param reports: Liste de dictionnaires renvoyés par stats()
+        :return: Dictionnaire au format de stats(), avec le nombre de processus
+        """
+        decisions = {DECISION_SKIP: 0, DECISION_CLASSIFY_ONLY: 0, DECISION_FULL: 0}
+        for report in reports:
+            for decision, count in report.get("decisions", {}).items():
+                decisions[decision] = decisions.get(decision, 0) + count
+        evaluated = sum(decisions.values())
+        return {
+            "min_ocr_confidence": max((report.get("min_ocr_confidence", 0) for report in reports), default=None),
+            "decisions": decisions,
+            "skip_rate": round(decisions[DECISION_SKIP] / evaluated, 3) if evaluated else 0.0,
+            "workers": len(reports)
+        }
@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+from pathlib import Path
+
+BASE_DIR = Path(__file__).parent
+
+
+class SQLiteCache:
+    """
+    Cache clé/valeur persistant dans un fichier SQLite, avec expiration (TTL)
+    et éviction LRU au-delà d'un nombre maximal d'entrées.
+
+    Les compteurs de succès/échecs sont stockés dans le même fichier afin que
+    l'application Flask puisse exposer les statistiques de tous les workers.
+    """
+    table = "cache_entries"
+
+    def __init__(self, db_path, max_entries=5000, ttl_seconds=None):
+        """
+        :param db_path: Chemin du fichier SQLite
+        :param max_entries: Nombre maximal d'entrées conservées (éviction LRU)
+        :param ttl_seconds: Durée de vie par défaut d'une entrée (None = illimitée)
+        """
+        self.db_path = str(db_path)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.logger = logging.getLogger(__name__)
+        self._create_tables()
+
+    def _connect(self):
+        """Ouvre une connexion en mode autocommit"""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _create_tables(self):
+        """Crée les tables du cache si elles n'existent pas"""
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    cache_key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    expires_at REAL
+                )
+            """)
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.table}_access ON {self.table}(last_access)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_stats (
+                    name TEXT PRIMARY KEY,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    misses INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("INSERT OR IGNORE INTO cache_stats (name) VALUES (?)", (self.table,))
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """
+        Lit une entrée du cache
+
+        :param key: Clé de l'entrée
+        :return: Valeur décodée ou None si absente ou expirée
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE cache_key = ?", (key,)
+            ).fetchone()
+            if row and (row['expires_at'] is None or row['expires_at'] > now):
+                conn.execute(f"UPDATE {self.table} SET last_access = ? WHERE cache_key = ?", (now, key))
+                conn.execute("UPDATE cache_stats SET hits = hits + 1 WHERE name = ?", (self.table,))
+                return json.loads(row['value'])
+
+            if row:
+                conn.execute(f"DELETE FROM {self.table} WHERE cache_key = ?", (key,))
+            conn.execute("UPDATE cache_stats SET misses = misses + 1 WHERE name = ?", (self.table,))
+            return None
+        except (sqlite3.Error, ValueError) as e:
+            self.logger.error(f"Erreur de lecture du cache {self.table}: {str(e)}")
+            return None
+        finally:
+            conn.close()
+
+    def put(self, key, value, ttl_seconds=-1):
+        """
+        Ajoute ou remplace une entrée, puis applique l'éviction
+
+        :param key: Clé de l'entrée
+        :param value: Valeur sérialisable en JSON
+        :param ttl_seconds: Durée de vie de l'entrée (-1 = TTL par défaut, None = illimitée)
+        """
+        if ttl_seconds == -1:
+            ttl_seconds = self.ttl_seconds
+        now = time.time()
+        expires_at = now + ttl_seconds if ttl_seconds else None
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                f"""INSERT OR REPLACE INTO {self.table} (cache_key, value, created_at, last_access, expires_at)
+                    VALUES (?, ?, ?, ?, ?)""",
+                (key, json.dumps(value, default=str), now, now, expires_at)
+            )
+            self._evict(conn, now)
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            self.logger.error(f"Erreur d'écriture dans le cache {self.table}: {str(e)}")
+        finally:
+            conn.close()
+
+    def _evict(self, conn, now):
+        """Supprime les entrées expirées puis les moins récemment utilisées"""
+        conn.execute(f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        count = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        if self.max_entries and count > self.max_entries:
+            conn.execute(
+                f"""DELETE FROM {self.table} WHERE cache_key IN (
+                        SELECT cache_key FROM {self.table} ORDER BY last_access LIMIT ?
+                    )""",
+                (count - self.max_entries,)
+            )
+
+    def stats(self):
+        """
+        Statistiques du cache (tous processus confondus)
+
+        :return: Dictionnaire avec entrées, succès, échecs et taux de succès
+        """
+        conn = self._connect()
+        try:
+            entries = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            row = conn.execute("SELECT hits, misses FROM cache_stats WHERE name = ?", (self.table,)).fetchone()
+        finally:
+            conn.close()
+        hits, misses = (row['hits'], row['misses']) if row else (0, 0)
+        lookups = hits + misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0
+        }
+
+
+class ResultCache(SQLiteCache):
+    """
+    Cache des résultats de traitement d'un ticket, indexé par l'empreinte
+    SHA-256 de l'image : texte OCR, texte nettoyé et données classées.
+
+    Une image déjà traitée (nouvel envoi, double appui) passe directement
+    au stockage et à l'intégration fidélité sans rappeler Veryfi, Tesseract
+    ni Mistral.
+    """
+    table = "receipt_results"
+
+    def __init__(self, db_path=None, max_entries=None, ttl_seconds=None):
+        """
+        :param db_path: Chemin du fichier SQLite (variable RESULT_CACHE_PATH)
+        :param max_entries: Nombre maximal d'entrées (variable RESULT_CACHE_MAX_ENTRIES)
+        :param ttl_seconds: Durée de vie d'une entrée (variable RESULT_CACHE_TTL, 7 jours par défaut)
+        """
+        super().__init__(
+            db_path or os.getenv("RESULT_CACHE_PATH", str(BASE_DIR / 'result_cache.sqlite')),
+            max_entries=int(max_entries or os.getenv("RESULT_CACHE_MAX_ENTRIES", "5000")),
+            ttl_seconds=int(ttl_seconds or os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+        )
+
+    @staticmethod
+    def hash_bytes(data):
+        """Empreinte SHA-256 d'un contenu binaire"""
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def hash_file(path):
+        """Empreinte SHA-256 d'un fichier"""
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def get_result(self, image_hash):
+        """
+        Résultat mis en cache pour une image
+
+        :param image_hash: Empreinte SHA-256 de l'image
+        :return: Dictionnaire (ocr_text, cleaned_text, structured_data, ocr_source) ou None
+        """
+        return self.get(image_hash)
+
+    def put_result(self, image_hash, ocr_text, cleaned_text, structured_data, ocr_source=None):
+        """
+        Enregistre le résultat du traitement d'une image
+
+        :param image_hash: Empreinte SHA-256 de l'image
+        :param ocr_text: Texte OCR brut
+        :param cleaned_text: Texte nettoyé par Mistral
+        :param structured_data: Données classées
+        :param ocr_source: Moteur OCR ayant produit le texte
+        """
+        self.put(image_hash, {
+            "ocr_text": ocr_text,
+            "cleaned_text": cleaned_text,
+            "structured_data": structured_data,
+            "ocr_source": ocr_source
+        })
+
+    def warm_from_receipt(self, image_path, receipt_data):
+        """
+        Alimente le cache à partir d'un ticket déjà traité (scripts d'import)
+
+        :param image_path: Chemin de l'image du ticket
+        :param receipt_data: Données JSON du ticket
+        :return: True si une entrée a été ajoutée
+        """
+        if not image_path or not os.path.exists(image_path):
+            return False
+        ocr_text = receipt_data.get('ocr_text', '') or receipt_data.get('text_brut', '')
+        if not ocr_text:
+            return False
+
+        structured_keys = [
+            "vendor", "date", "total", "line_items", "category", "payment_method",
+            "store_address", "store_phone", "store_email", "store_website", "tax", "subtotal",
+            "siret", "tva_number", "capital", "naf_code", "cashier", "client_type"
+        ]
+        structured_data = {key: receipt_data[key] for key in structured_keys if key in receipt_data}
+        self.put_result(
+            self.hash_file(image_path),
+            ocr_text,
+            receipt_data.get('cleaned_text', ocr_text),
+            structured_data,
+            receipt_data.get('ocr_source', 'import')
+        )
+        return True
+
+
+class PromptCache(SQLiteCache):
+    """
+    Cache des réponses Mistral, indexé par le modèle, la température, max_tokens
+    et l'empreinte SHA-256 du prompt.
+
+    Un même texte renvoyé à Mistral (retraitement, nouvel essai après une erreur
+    de base, tests) réutilise la réponse déjà obtenue. Les réponses à température
+    0.0 (classification) sont déterministes et gardées sans limite de durée ; les
+    autres expirent après le TTL.
+    """
+    table = "llm_responses"
+
+    def __init__(self, db_path=None, max_entries=None, ttl_seconds=None):
+        """
+        :param db_path: Chemin du fichier SQLite (variable PROMPT_CACHE_PATH, fichier du cache des résultats par défaut)
+        :param max_entries: Nombre maximal d'entrées (variable PROMPT_CACHE_MAX_ENTRIES)
+        :param ttl_seconds: Durée de vie d'une réponse à température non nulle
+                            (variable PROMPT_CACHE_TTL, 1 jour par défaut)
+        """
+        super().__init__(
+            db_path or os.getenv("PROMPT_CACHE_PATH",
+                                 os.getenv("RESULT_CACHE_PATH", str(BASE_DIR / 'result_cache.sqlite'))),
+            max_entries=int(max_entries or os.getenv("PROMPT_CACHE_MAX_ENTRIES", "20000")),
+            ttl_seconds=int(ttl_seconds or os.getenv("PROMPT_CACHE_TTL", str(24 * 3600)))
+        )
+
+    @staticmethod
+    def prompt_key(model, temperature, max_tokens, prompt):
+        """Clé d'un appel : paramètres de génération et empreinte du prompt"""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return f"{model}|{float(temperature)}|{int(max_tokens)}|{prompt_hash}"
+
+    def get_response(self, model, temperature, max_tokens, prompt):
+        """
+        Réponse mise en cache pour un appel
+
+        :return: Texte généré ou None
+        """
+        return self.get(self.prompt_key(model, temperature, max_tokens, prompt))
+
+    def put_response(self, model, temperature, max_tokens, prompt, content):
+        """
+        Enregistre la réponse d'un appel (sans expiration à température 0.0)
+
+        :param content: Texte généré par Mistral
+        """
+        self.put(self.prompt_key(model, temperature, max_tokens, prompt), content,
+                 ttl_seconds=None if float(temperature) == 0.0 else -1)
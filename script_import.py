@@ -14,6 +14,7 @@ from datetime import datetime
 
 # Importer l'intégrateur de base de données
 from db_integrator import DatabaseIntegrator
+from result_cache import ResultCache
 
 # Configuration des chemins
 # Chemin vers la base de données SQLite
@@ -139,6 +140,10 @@ def import_receipt(receipt_info):
         db_integrator = DatabaseIntegrator(DB_PATH)
         success, transaction_id, message = db_integrator.process_receipt_data(processed_data, image_path)
         
+        # Alimenter le cache des résultats : un nouvel envoi de la même image ne sera pas retraité
+        if receipt_info['image_path'] and ResultCache().warm_from_receipt(receipt_info['image_path'], receipt_data):
+            print("Résultat ajouté au cache des tickets")
+        
         if success:
             print(f"✓ Importation réussie! Transaction ID: {transaction_id}")
             return True, transaction_id
@@ -104,14 +104,18 @@ document.addEventListener('DOMContentLoaded', function() {
             try {
                 console.log('Envoi de la requête...');
                 
-                // Utiliser la fonction avec retentative au lieu d'un simple fetch
-                const result = await uploadWithRetry(formData, 1); // Permettre 1 nouvelle tentative (2 au total)
+                // Pas de nouvelle tentative automatique : le serveur répond dès la mise en file,
+                // un second envoi créerait un doublon (et doublerait les appels OCR/LLM)
+                const result = await uploadWithRetry(formData, 0);
                 
                 console.log('Réponse reçue:', result);
 
                 if (result.success) {
+                    // Le ticket est en file : suivre les étapes du traitement par le worker
+                    resetUploadProgress();
+                    const job = await trackUploadJob(result, showUploadStage);
                     console.log('Traitement réussi, navigation vers la page de détails du ticket');
-                    window.location.href = '/receipt/' + result.receipt_id;
+                    window.location.href = '/receipt/' + job.receipt_id;
                 } else {
                     console.error('Échec du traitement avec erreur:', result.error);
                     alert('Erreur: ' + (result.error || 'Échec du traitement du ticket'));
@@ -277,7 +281,10 @@ function stopCamera() {
 
 // Function to upload with automatic retry - VERSION AMÉLIORÉE
 async function uploadWithRetry(formData, maxRetries = 1) {
+    // Délai imposé par le serveur (en-tête Retry-After d'une réponse 429)
+    let retryAfterMs = null;
     for (let attempt = 0; attempt <= maxRetries; attempt++) {
+        retryAfterMs = null;
         try {
             console.log(`Upload attempt ${attempt + 1}/${maxRetries + 1}`);
             
@@ -296,6 +303,15 @@ async function uploadWithRetry(formData, maxRetries = 1) {
             
             console.log('Response status:', response.status);
             
+            if (response.status === 401) {
+                window.location.href = '/login';
+                return { success: false, error: 'Veuillez vous connecter pour scanner un ticket' };
+            }
+            
+            if (response.status === 429) {
+                retryAfterMs = (parseInt(response.headers.get('Retry-After'), 10) || 10) * 1000;
+            }
+            
             if (!response.ok) {
                 const errorText = await response.text();
                 console.error(`HTTP error ${response.status}: ${errorText}`);
@@ -327,9 +343,118 @@ async function uploadWithRetry(formData, maxRetries = 1) {
             }
             
             // Wait before retrying with exponential backoff
-            const waitTime = Math.min(2000 * Math.pow(2, attempt), 10000);
+            const waitTime = retryAfterMs !== null ? retryAfterMs : Math.min(2000 * Math.pow(2, attempt), 10000);
             console.log(`Waiting ${waitTime}ms before retry...`);
             await new Promise(resolve => setTimeout(resolve, waitTime));
         }
     }
-}
\ No newline at end of file
+}
+
+// Libellés des étapes publiées par le worker
+const UPLOAD_STAGE_LABELS = {
+    saved: 'Image reçue',
+    codes: 'Lecture QR code / code-barres',
+    veryfi: 'OCR Veryfi',
+    tesseract: 'OCR Tesseract (secours)',
+    mistral_clean: 'Nettoyage du texte',
+    mistral_classify: 'Extraction des données',
+    gcs_image: 'Sauvegarde de l\'image',
+    gcs_json: 'Sauvegarde des données',
+    loyalty_db: 'Points de fidélité'
+};
+
+function resetUploadProgress() {
+    const list = document.getElementById('uploadStages');
+    const partial = document.getElementById('partialResult');
+    if (list) {
+        list.innerHTML = '';
+    }
+    if (partial) {
+        partial.style.display = 'none';
+        partial.textContent = '';
+    }
+}
+
+// Afficher une étape terminée et, dès la classification, le magasin et le montant
+function showUploadStage(stage) {
+    const list = document.getElementById('uploadStages');
+    if (list) {
+        let item = document.getElementById('upload-stage-' + stage.stage);
+        if (!item) {
+            item = document.createElement('li');
+            item.id = 'upload-stage-' + stage.stage;
+            item.className = 'list-group-item d-flex justify-content-between';
+            list.appendChild(item);
+        }
+        const icon = ['done', 'cached'].includes(stage.status) ? '✓' : (['skipped', 'discarded'].includes(stage.status) ? '–' : '✗');
+        const timing = stage.duration_ms !== null && stage.duration_ms !== undefined
+            ? `${(stage.duration_ms / 1000).toFixed(1)} s` : '';
+        item.textContent = '';
+        item.appendChild(document.createTextNode(`${icon} ${UPLOAD_STAGE_LABELS[stage.stage] || stage.stage}`));
+        const small = document.createElement('small');
+        small.className = 'text-muted';
+        small.textContent = timing;
+        item.appendChild(small);
+    }
+    
+    const partial = document.getElementById('partialResult');
+    if (partial && stage.stage === 'mistral_classify' && stage.detail && stage.detail.vendor) {
+        partial.textContent = `${stage.detail.vendor} — ${stage.detail.total} € (${stage.detail.date || ''})`;
+        partial.style.display = 'block';
+    }
+}
+
+// Suivre le traitement d'un ticket mis en file par /upload (SSE, sinon interrogation périodique)
+function trackUploadJob(upload, onStage = () => {}) {
+    if (!window.EventSource || !upload.events_url) {
+        return waitForUploadJob(upload.status_url, onStage);
+    }
+    
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(upload.events_url);
+        
+        source.addEventListener('stage', (e) => onStage(JSON.parse(e.data)));
+        source.addEventListener('done', (e) => {
+            source.close();
+            resolve(JSON.parse(e.data));
+        });
+        source.addEventListener('failed', (e) => {
+            source.close();
+            reject(new Error(JSON.parse(e.data).error || 'Échec du traitement du ticket'));
+        });
+        source.onerror = () => {
+            // Le navigateur abandonne la reconnexion (réponse non-SSE) : basculer sur l'interrogation
+            if (source.readyState === EventSource.CLOSED) {
+                waitForUploadJob(upload.status_url, onStage).then(resolve, reject);
+            }
+        };
+        source.addEventListener('timeout', () => {
+            // Le flux a expiré côté serveur : continuer par interrogation périodique
+            source.close();
+            waitForUploadJob(upload.status_url, onStage).then(resolve, reject);
+        });
+    });
+}
+
+// Attendre la fin du traitement d'un ticket mis en file par /upload
+async function waitForUploadJob(statusUrl, onStage = () => {}, pollInterval = 2000) {
+    while (true) {
+        const response = await fetch(statusUrl);
+        if (!response.ok) {
+            throw new Error(`HTTP error ${response.status}`);
+        }
+        
+        const job = await response.json();
+        console.log('Statut du traitement:', job.status);
+        (job.stages || []).forEach(onStage);
+        
+        if (job.status === 'done') {
+            return job;
+        }
+        if (job.status === 'failed') {
+            throw new Error(job.error || 'Échec du traitement du ticket');
+        }
+        
+        await new Promise(resolve => setTimeout(resolve, pollInterval));
+    }
+}
@@ -0,0 +1,40 @@
+import logging
+
+import pytest
+
+from advanced_receipt_ocr import SimplifiedReceiptProcessor
+
+
+class RecordingCache:
+    def __init__(self):
+        self.stored = []
+
+    def put_result(self, image_hash, ocr_text, cleaned_text, structured_data, ocr_source):
+        self.stored.append(structured_data)
+
+
+@pytest.fixture
+def processor():
+    # Sans Tesseract ni Mistral : seule l'analyse d'un texte déjà classé est testée
+    processor = SimplifiedReceiptProcessor.__new__(SimplifiedReceiptProcessor)
+    processor.logger = logging.getLogger(__name__)
+    return processor
+
+
+def test_error_payload_is_flagged(processor):
+    data = processor._parse_mistral_response('{"error": "Request failed with status code 429", "status": "error"}')
+    assert data["error"] == "Request failed with status code 429"
+    assert data["vendor"] == "Unknown"
+
+
+@pytest.mark.parametrize("text, data, cached", [
+    ("CARREFOUR\nTOTAL 5,00", {"vendor": "Carrefour", "total": 5.0}, True),
+    ("Error: Tesseract introuvable", {"vendor": "Carrefour", "total": 5.0}, False),
+    ("CARREFOUR\nTOTAL 5,00", {"vendor": "Unknown (error)", "total": 0}, False),
+    ("CARREFOUR\nTOTAL 5,00", {"vendor": "Unknown", "total": 0.0, "error": "Deadline exceeded"}, False),
+])
+def test_only_successful_analyses_are_cached(processor, text, data, cached):
+    cache = RecordingCache()
+    result = processor._analyze_text("ticket.jpg", text, "abc123", cache, (text, data))
+    assert result["success"]
+    assert bool(cache.stored) == cached
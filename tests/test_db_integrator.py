@@ -0,0 +1,64 @@
+import shutil
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from db_integrator import DatabaseIntegrator
+
+SAMPLE_DB = Path(__file__).resolve().parent.parent / "fidelity_db.sqlite"
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "fidelity_db.sqlite"
+    shutil.copy(SAMPLE_DB, path)
+    conn = sqlite3.connect(path)
+    try:
+        # Le trigger de points de la base d'exemple exige une carte sur la transaction,
+        # que l'insertion directe des tickets ne renseigne pas
+        conn.execute("DROP TRIGGER IF EXISTS update_client_points")
+        conn.commit()
+    finally:
+        conn.close()
+    return path
+
+
+def _count(db_path, query, params=()):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(query, params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _receipt(vendor, total):
+    return {
+        "vendor": vendor,
+        "date": "2024-03-01",
+        "total": total,
+        "line_items": [{"description": "Pain", "quantity": 1, "price": 12.5}],
+        "payment_method": "CB",
+    }
+
+
+def test_batch_rolls_back_only_the_failing_receipt(db_path):
+    transactions = _count(db_path, "SELECT COUNT(*) FROM transactions")
+
+    results = DatabaseIntegrator(str(db_path)).process_receipts_batch([
+        (_receipt("Boulangerie Savepoint", 12.5), "a.jpg", 1),
+        # Total illisible : échec après la création du magasin
+        (_receipt("Magasin Fautif", "abc"), "b.jpg", 1),
+        (_receipt("Epicerie Savepoint", 12.5), "c.jpg", 1),
+    ])
+
+    assert [success for success, _, _ in results] == [True, False, True]
+    assert results[1][1] is None
+    assert _count(db_path, "SELECT COUNT(*) FROM transactions") == transactions + 2
+    # Le magasin créé par le ticket en erreur est annulé avec lui
+    assert _count(db_path, "SELECT COUNT(*) FROM points_vente WHERE nom = ?", ("Magasin Fautif",)) == 0
+    assert _count(db_path, "SELECT COUNT(*) FROM points_vente WHERE nom = ?", ("Epicerie Savepoint",)) == 1
+
+
+def test_empty_batch(db_path):
+    assert DatabaseIntegrator(str(db_path)).process_receipts_batch([]) == []
@@ -0,0 +1,23 @@
+from degradation import TIER_DETERMINISTIC, TIER_FULL, TIER_NO_CLEAN, DegradationPolicy
+
+
+def test_backlog_thresholds_select_the_tier():
+    policy = DegradationPolicy(backlog_fn=lambda: 160, backlog_thresholds=[50, 150, 300], latency_threshold=15)
+    assert policy.select_tier() == "light_model"
+    assert DegradationPolicy(backlog_thresholds=[50], latency_threshold=15).select_tier(16) == TIER_NO_CLEAN
+
+
+def test_merge_stats_keeps_the_most_degraded_worker():
+    calm = DegradationPolicy(backlog_fn=lambda: 0, backlog_thresholds=[50, 150, 300])
+    busy = DegradationPolicy(backlog_fn=lambda: 400, backlog_thresholds=[50, 150, 300])
+    calm.select_tier()
+    busy.select_tier()
+    busy.select_tier()
+
+    merged = DegradationPolicy.merge_stats([calm.stats(), busy.stats()])
+    assert merged["tier"] == TIER_DETERMINISTIC
+    assert merged["backlog"] == 400
+    assert merged["receipts_by_tier"][TIER_FULL] == 1
+    assert merged["receipts_by_tier"][TIER_DETERMINISTIC] == 2
+    assert merged["workers"] == 2
+    assert DegradationPolicy.merge_stats([])["tier"] == TIER_FULL
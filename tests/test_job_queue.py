@@ -0,0 +1,115 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(tmp_path / "queue.sqlite", max_attempts=2)
+
+
+def _expire_lease(queue, job_id, seconds=3600):
+    """Recule le heartbeat d'un job comme si son worker avait disparu"""
+    conn = sqlite3.connect(queue.db_path)
+    try:
+        old = (datetime.now() - timedelta(seconds=seconds)).isoformat()
+        conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?", (old, job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _payload(queue, job_id):
+    conn = sqlite3.connect(queue.db_path)
+    try:
+        return conn.execute("SELECT payload FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_claim_returns_oldest_job_then_none(queue):
+    first = queue.enqueue("a.jpg", "a.jpg")
+    queue.enqueue("b.jpg", "b.jpg")
+
+    job = queue.claim("worker-1")
+    assert job["job_id"] == first
+    assert job["status"] == JobQueue.STATUS_RUNNING
+    assert job["attempts"] == 1
+    assert job["worker_id"] == "worker-1"
+
+    assert queue.claim("worker-2")["filename"] == "b.jpg"
+    assert queue.claim("worker-3") is None
+
+
+def test_claim_batch_reserves_jobs_of_the_same_batch(queue):
+    queue.enqueue("a.jpg", "a.jpg", batch_id="lot")
+    queue.enqueue("x.jpg", "x.jpg")
+    queue.enqueue("b.jpg", "b.jpg", batch_id="lot")
+
+    jobs = queue.claim_batch("worker-1")
+    assert [job["filename"] for job in jobs] == ["a.jpg", "b.jpg"]
+    assert [job["filename"] for job in queue.claim_batch("worker-1")] == ["x.jpg"]
+
+
+def test_fail_requeues_until_max_attempts_then_drops_payload(queue):
+    job_id = queue.enqueue("", "mem.jpg", payload=b"image")
+
+    queue.claim("worker-1")
+    queue.fail(job_id, "erreur temporaire")
+    job = queue.get_job(job_id)
+    assert job["status"] == JobQueue.STATUS_QUEUED
+    assert job["worker_id"] is None
+    assert _payload(queue, job_id) == b"image"
+
+    queue.claim("worker-1")
+    queue.fail(job_id, "erreur définitive")
+    job = queue.get_job(job_id)
+    assert job["status"] == JobQueue.STATUS_FAILED
+    assert job["error"] == "erreur définitive"
+    assert job["finished_at"] is not None
+    assert _payload(queue, job_id) is None
+
+
+def test_fail_without_retry_is_terminal(queue):
+    job_id = queue.enqueue("a.jpg", "a.jpg")
+    queue.claim("worker-1")
+    queue.fail(job_id, "image illisible", retry=False)
+    assert queue.get_job(job_id)["status"] == JobQueue.STATUS_FAILED
+
+
+def test_requeue_stale_requeues_expired_lease(queue):
+    stale = queue.enqueue("a.jpg", "a.jpg")
+    alive = queue.enqueue("b.jpg", "b.jpg")
+    queue.claim("worker-1")
+    queue.claim("worker-2")
+    _expire_lease(queue, stale)
+
+    assert queue.requeue_stale(lease_seconds=600) == 1
+    assert queue.get_job(stale)["status"] == JobQueue.STATUS_QUEUED
+    assert queue.get_job(stale)["worker_id"] is None
+    assert queue.get_job(alive)["status"] == JobQueue.STATUS_RUNNING
+
+
+def test_requeue_stale_fails_job_out_of_attempts(queue):
+    job_id = queue.enqueue("", "mem.jpg", payload=b"image")
+    for _ in range(2):
+        queue.claim("worker-1")
+        _expire_lease(queue, job_id)
+        queue.requeue_stale(lease_seconds=600)
+
+    job = queue.get_job(job_id)
+    assert job["status"] == JobQueue.STATUS_FAILED
+    assert job["error"] == "Worker lease expired"
+    assert _payload(queue, job_id) is None
+    assert queue.depth()[JobQueue.STATUS_FAILED] == 1
+
+
+def test_worker_stats_ignore_stale_reports(queue):
+    queue.report_worker_stats("host:1", {"pools": {"ocr": {"saturated": True}}})
+    queue.report_worker_stats("host:1", {"pools": {"ocr": {"saturated": False}}})
+
+    assert queue.worker_stats() == {"host:1": {"pools": {"ocr": {"saturated": False}}}}
+    assert queue.worker_stats(max_age_seconds=-1) == {}
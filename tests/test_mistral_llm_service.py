@@ -0,0 +1,48 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from mistral_llm_service import MistralLLMService
+
+
+class FailingSession:
+    closed = False
+
+    def post(self, *args, **kwargs):
+        raise aiohttp.ClientError("connection reset")
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setenv("MISTRAL_API_KEY", "test")
+    monkeypatch.setenv("PROMPT_CACHE_ENABLED", "false")
+    monkeypatch.setenv("MISTRAL_TOKENS_PER_MINUTE", "6000")
+    return MistralLLMService()
+
+
+def test_failed_request_gives_back_its_reservation(service, monkeypatch):
+    monkeypatch.setattr(service, "_async_state",
+                        lambda: (FailingSession(), asyncio.Semaphore(1), service._rate_limiter))
+    usage = {"prompt_tokens": 0, "completion_tokens": 0}
+
+    response = asyncio.run(service._agenerate("x" * 4000, 100, 0.0, usage))
+    assert '"status": "error"' in response
+    # Trois tentatives, une seule réservation, rendue après l'échec
+    assert service._rate_limiter._available == pytest.approx(6000, abs=5)
+
+
+def test_token_budget_is_kept_across_event_loops(service):
+    asyncio.run(service._rate_limiter.acquire(4000))
+    asyncio.run(service._rate_limiter.acquire(1000))
+    assert service._rate_limiter._available == pytest.approx(1000, abs=5)
+
+
+def test_open_session_of_a_previous_loop_is_not_replaced(service):
+    async def state():
+        return service._async_state()
+
+    asyncio.run(state())
+    with pytest.raises(RuntimeError):
+        asyncio.run(state())
+    service.run_async(service.aclose())
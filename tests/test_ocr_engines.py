@@ -0,0 +1,40 @@
+from ocr_engines import mean_confidence, merge_tile_lines
+
+
+def _line(text, y, h=20, conf=90):
+    return {"text": text, "bbox": [10, y, 200, h], "words": [[text, conf, 10, y, 200, h]]}
+
+
+def test_lines_are_moved_to_image_coordinates():
+    merged = merge_tile_lines([(0, 0, 100, [_line("CARREFOUR", 10)]),
+                               (80, 100, float("inf"), [_line("TOTAL 12,00", 40)])])
+    assert [line["text"] for line in merged] == ["CARREFOUR", "TOTAL 12,00"]
+    assert merged[1]["bbox"] == [10, 120, 200, 20]
+    assert merged[1]["words"][0][3] == 120
+
+
+def test_overlap_keeps_each_line_once():
+    # Bandes 0-120 et 80-200, limite au milieu du chevauchement (100)
+    top = [_line("PAIN 1,20", 10), _line("LAIT 0,95", 85)]
+    bottom = [_line("LAIT 0,95", 5), _line("TOTAL 2,15", 60)]
+    merged = merge_tile_lines([(0, 0, 100, top), (80, 100, float("inf"), bottom)])
+    assert [line["text"] for line in merged] == ["PAIN 1,20", "LAIT 0,95", "TOTAL 2,15"]
+    assert [line["bbox"][1] for line in merged] == [10, 85, 140]
+
+
+def test_line_read_twice_across_the_limit_is_dropped():
+    # Centre de la ligne du haut à 98, lecture de la bande du bas centrée à 101
+    merged = merge_tile_lines([(0, 0, 100, [_line("TVA 20%", 88)]),
+                               (80, 100, float("inf"), [_line("TVA 20%", 11)])])
+    assert [line["text"] for line in merged] == ["TVA 20%"]
+
+
+def test_repeated_line_far_below_is_kept():
+    merged = merge_tile_lines([(0, 0, 100, [_line("1 X BAGUETTE", 10)]),
+                               (80, 100, float("inf"), [_line("1 X BAGUETTE", 60)])])
+    assert len(merged) == 2
+
+
+def test_mean_confidence():
+    assert mean_confidence([_line("A", 0, conf=80), _line("B", 20, conf=100)]) == 90
+    assert mean_confidence([]) == 0.0
@@ -0,0 +1,47 @@
+from pathlib import Path
+
+import pytest
+
+from ocr_rules import RuleEngine
+
+SAMPLE_DB = Path(__file__).resolve().parent.parent / "fidelity_db.sqlite"
+
+RECEIPT = "{header}\nPAIN 2,50\nLAIT 2,50\nTOTAL 5,00\n01/03/2024\n"
+
+
+@pytest.fixture
+def engine():
+    return RuleEngine(SAMPLE_DB, min_confidence=0.8, min_ocr_confidence=80)
+
+
+def _confidences(result):
+    return {champ: field["confidence"] for champ, field in result["fields"].items()}
+
+
+def test_confidence_depends_on_how_the_field_was_matched(engine):
+    result = engine.extract(RECEIPT.format(header="CARREFOUR MARKET"), ocr_confidence=92)
+    # Total précédé de son libellé, date seule, enseigne lue sur la première ligne
+    assert _confidences(result) == {"montant_total": 0.95, "date": 0.9, "magasin": 0.6}
+
+
+def test_generic_header_is_not_a_vendor(engine):
+    result = engine.extract(RECEIPT.format(header="BIENVENUE"), ocr_confidence=92)
+    assert result["fields"]["magasin"]["confidence"] < engine.min_confidence
+    assert not result["complete"]
+    assert result["reason"] == "vendor_unconfirmed"
+
+
+def test_low_or_unknown_ocr_confidence_lowers_every_field(engine):
+    text = RECEIPT.format(header="CARREFOUR MARKET")
+    assert _confidences(engine.extract(text, ocr_confidence=60))["montant_total"] == 0.71
+    # Texte Veryfi : confiance inconnue
+    result = engine.extract(text, vendor="Carrefour")
+    assert _confidences(result)["montant_total"] == 0.81
+    assert not result["complete"]
+
+
+def test_confirmed_vendor_completes_the_receipt(engine):
+    result = engine.extract(RECEIPT.format(header="BIENVENUE"), ocr_confidence=92, vendor="Carrefour")
+    assert result["complete"]
+    data = engine.structured_data(result)
+    assert (data["vendor"], data["total"], data["date"]) == ("Carrefour", 5.0, "2024-03-01")
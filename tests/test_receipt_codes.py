@@ -0,0 +1,36 @@
+import pytest
+
+from receipt_codes import parse_payload
+
+
+def test_json_payload():
+    data = '{"ref": "T-1234", "total": "12,50", "date": "2024-03-01T10:00:00", "magasin": "Carrefour"}'
+    assert parse_payload(data) == {"invoice_number": "T-1234", "total": 12.5, "date": "2024-03-01",
+                                   "vendor": "Carrefour", "format": "json"}
+
+
+def test_url_payload():
+    assert parse_payload("https://ticket.example.fr/r?ref=A987&montant=8.40&dt=01/03/2024") == \
+        {"invoice_number": "A987", "total": 8.4, "date": "2024-03-01", "format": "url"}
+
+
+def test_key_value_payload():
+    assert parse_payload("REF=55;TOTAL=3,20;SIRET=73282932000074") == \
+        {"invoice_number": "55", "total": 3.2, "siret": "73282932000074", "format": "key_value"}
+
+
+def test_implausible_values_are_dropped():
+    # Montant nul et date hors plage : seule la référence est gardée
+    assert parse_payload("Numéro: 42\nMontant: 0\nDate: 01/01/1990") == {"invoice_number": "42",
+                                                                          "format": "key_value"}
+
+
+@pytest.mark.parametrize("data", ['{"total": "5"}', '{bad json', "bonjour", "[1, 2]"])
+def test_unknown_or_referenceless_qr_codes(data):
+    assert parse_payload(data) is None
+
+
+def test_linear_barcode_is_a_reference():
+    assert parse_payload("1234567890123", "EAN_13") == {"format": "barcode", "invoice_number": "1234567890123"}
+    # Un QR code au texte libre n'est pas une référence
+    assert parse_payload("1234567890123", "QRCODE") is None
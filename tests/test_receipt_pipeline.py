@@ -0,0 +1,62 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+from ocr_rules import RuleEngine
+from receipt_pipeline import ReceiptPipeline
+from receipt_validator import DECISION_SKIP, LLMGate
+
+SAMPLE_DB = Path(__file__).resolve().parent.parent / "fidelity_db.sqlite"
+
+TEXT = "BIENVENUE\nPAIN 2,50\nLAIT 2,50\nTOTAL 5,00\n01/03/2024\n"
+ITEMS = [{"description": "PAIN", "quantity": 1, "price": 2.5}, {"description": "LAIT", "quantity": 1, "price": 2.5}]
+PARSED = {"vendor": "BIENVENUE", "date": "2024-03-01", "total": 5.0, "line_items": ITEMS}
+
+
+class FakeRegistry:
+    def __init__(self, store=None):
+        self.store = store
+
+    def resolve(self, identifiers):
+        return self.store
+
+
+def _pipeline(monkeypatch, store=None):
+    pipeline = ReceiptPipeline(
+        None, None, None, SimpleNamespace(vendor_registry=FakeRegistry(store)), None, read_codes=False,
+        rule_engine=RuleEngine(SAMPLE_DB, min_confidence=0.8, min_ocr_confidence=80),
+        llm_gate=LLMGate(lambda text: dict(PARSED), min_ocr_confidence=80),
+    )
+    calls = []
+
+    def run_ocr(source, on_stage, deadline, filename=None, ocr_meta=None):
+        # Texte Tesseract lu avec une bonne confiance
+        ocr_meta["confidence"] = 92
+        return {}, TEXT, "tesseract"
+
+    def run_llm(raw_ocr_text, on_stage, deadline, tier=None, skip_clean=False):
+        calls.append(skip_clean)
+        return raw_ocr_text, dict(PARSED, vendor="Boulangerie Martin"), True
+
+    monkeypatch.setattr(pipeline, "_run_ocr_sequential", run_ocr)
+    monkeypatch.setattr(pipeline, "_run_llm_two_call", run_llm)
+    return pipeline, calls
+
+
+def test_generic_header_does_not_skip_mistral(monkeypatch):
+    pipeline, calls = _pipeline(monkeypatch)
+    result = pipeline.analyze("ticket.jpg", "ticket.jpg")
+
+    assert result["extraction_method"] == "llm"
+    assert result["rules_status"] == "vendor_unconfirmed"
+    assert result["llm_gate"]["decision"] != DECISION_SKIP
+    assert result["llm_gate"]["vendor_source"] is None
+    assert calls and result["vendor"] == "Boulangerie Martin"
+
+
+def test_registry_vendor_lets_the_rules_skip_mistral(monkeypatch):
+    pipeline, calls = _pipeline(monkeypatch, {"magasin_id": 7, "nom": "Carrefour"})
+    result = pipeline.analyze("ticket.jpg", "ticket.jpg")
+
+    assert result["extraction_method"] == "rules"
+    assert not calls
+    assert (result["vendor"], result["total"], result["store_id"]) == ("Carrefour", 5.0, 7)
@@ -0,0 +1,81 @@
+import pytest
+
+from receipt_validator import (
+    DECISION_CLASSIFY_ONLY, DECISION_FULL, DECISION_SKIP, LLMGate, check_arithmetic, extract_tax_amounts,
+)
+
+ITEMS = [{"description": "Pain", "quantity": 2, "price": 1.25}, {"description": "Lait", "quantity": 1, "price": 2.5}]
+
+
+def test_items_matching_total_are_consistent():
+    result = check_arithmetic(ITEMS, 5.0)
+    assert result["consistent"]
+    assert result["items_sum"] == 5.0
+    assert result["difference"] == 0.0
+
+
+def test_items_not_matching_total_are_inconsistent():
+    result = check_arithmetic(ITEMS, 6.0)
+    assert not result["consistent"]
+    assert result["difference"] == -1.0
+
+
+def test_no_items_is_inconsistent():
+    assert not check_arithmetic([], 5.0)["consistent"]
+
+
+def test_subtotal_plus_tax_and_tva_rate():
+    # Prix HT additionnés au sous-total, TVA à 20 %
+    result = check_arithmetic(ITEMS, 6.0, subtotal=5.0, tax=1.0)
+    assert result["consistent"]
+    assert result["tva_rate"] == pytest.approx(0.20)
+    assert result["checks"]["subtotal_plus_tax"]
+
+    assert not check_arithmetic(ITEMS, 6.5, subtotal=5.0, tax=1.0)["consistent"]
+
+
+def test_extract_tax_amounts():
+    text = "PAIN 2,50\nSOUS-TOTAL 5,00\nTVA 20% 1,00\nTOTAL 6,00"
+    assert extract_tax_amounts(text) == (5.0, 1.0)
+    assert extract_tax_amounts("TOTAL 6,00") == (None, None)
+
+
+def _gate(**overrides):
+    data = {"vendor": "BIENVENUE", "date": "2024-03-01", "total": 5.0, "line_items": ITEMS}
+    data.update(overrides)
+    return LLMGate(lambda text: dict(data), min_ocr_confidence=80)
+
+
+@pytest.mark.parametrize("gate_kwargs, evaluate_kwargs, decision, reason", [
+    ({}, {"ocr_confidence": 92, "vendor": "Carrefour"}, DECISION_SKIP, "consistent"),
+    ({}, {"ocr_confidence": 60, "vendor": "Carrefour"}, DECISION_FULL, "low_ocr_confidence"),
+    ({"total": 9.0}, {"ocr_confidence": 92, "vendor": "Carrefour"}, DECISION_FULL, "items_mismatch"),
+    # Texte Veryfi : confiance inconnue, jamais traitée comme fiable
+    ({}, {"ocr_confidence": None, "vendor": "Carrefour"}, DECISION_CLASSIFY_ONLY, "unknown_ocr_confidence"),
+    # Enseigne lue par parse_fn seule (en-tête BIENVENUE) : non identifiée
+    ({}, {"ocr_confidence": 92}, DECISION_CLASSIFY_ONLY, "vendor_unresolved"),
+    ({"date": "Unknown"}, {"ocr_confidence": 92, "vendor": "Carrefour"}, DECISION_CLASSIFY_ONLY, "missing_fields"),
+])
+def test_gate_decisions(gate_kwargs, evaluate_kwargs, decision, reason):
+    result = _gate(**gate_kwargs).evaluate("ticket", **evaluate_kwargs)
+    assert (result["decision"], result["reason"]) == (decision, reason)
+    assert result["needs_correction"] == (reason == "items_mismatch")
+
+
+def test_gate_uses_identified_vendor():
+    result = _gate().evaluate("ticket", ocr_confidence=92, vendor="Carrefour")
+    assert result["data"]["vendor"] == "Carrefour"
+
+
+def test_gate_stats_and_merge():
+    gate = _gate()
+    gate.evaluate("ticket", ocr_confidence=92, vendor="Carrefour")
+    gate.evaluate("ticket", ocr_confidence=92)
+    stats = gate.stats()
+    assert stats["decisions"] == {DECISION_SKIP: 1, DECISION_CLASSIFY_ONLY: 1, DECISION_FULL: 0}
+    assert stats["skip_rate"] == 0.5
+
+    merged = LLMGate.merge_stats([stats, stats])
+    assert merged["decisions"][DECISION_SKIP] == 2
+    assert merged["skip_rate"] == 0.5
+    assert merged["workers"] == 2
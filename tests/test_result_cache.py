@@ -0,0 +1,45 @@
+import time
+
+import pytest
+
+from result_cache import PromptCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PromptCache(tmp_path / "cache.sqlite", max_entries=100, ttl_seconds=60)
+
+
+def test_prompt_key_covers_generation_parameters():
+    key = PromptCache.prompt_key("mistral-small", 0, 512, "Classe ce ticket")
+    assert key == PromptCache.prompt_key("mistral-small", 0.0, 512.0, "Classe ce ticket")
+    assert key.startswith("mistral-small|0.0|512|")
+    assert len({
+        key,
+        PromptCache.prompt_key("mistral-large", 0.0, 512, "Classe ce ticket"),
+        PromptCache.prompt_key("mistral-small", 0.3, 512, "Classe ce ticket"),
+        PromptCache.prompt_key("mistral-small", 0.0, 1024, "Classe ce ticket"),
+        PromptCache.prompt_key("mistral-small", 0.0, 512, "Classe ce ticket."),
+    }) == 5
+
+
+def test_response_is_reused_only_for_identical_calls(cache):
+    cache.put_response("mistral-small", 0.0, 512, "prompt", '{"vendor": "Carrefour"}')
+
+    assert cache.get_response("mistral-small", 0.0, 512, "prompt") == '{"vendor": "Carrefour"}'
+    assert cache.get_response("mistral-small", 0.0, 256, "prompt") is None
+    assert cache.get_response("mistral-small", 0.2, 512, "prompt") is None
+    assert cache.get_response("mistral-large", 0.0, 512, "prompt") is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 3)
+
+
+def test_only_non_deterministic_responses_expire(cache, monkeypatch):
+    cache.put_response("mistral-small", 0.0, 512, "classification", "stable")
+    cache.put_response("mistral-small", 0.7, 512, "nettoyage", "variable")
+
+    later = time.time() + 120
+    monkeypatch.setattr(time, "time", lambda: later)
+    assert cache.get_response("mistral-small", 0.0, 512, "classification") == "stable"
+    assert cache.get_response("mistral-small", 0.7, 512, "nettoyage") is None
@@ -0,0 +1,58 @@
+import pytest
+
+from vendor_registry import luhn_valid, normalize_siret, normalize_tva, receipt_identifiers
+
+
+def test_luhn():
+    assert luhn_valid("732829320")
+    assert not luhn_valid("732829321")
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("732 829 320 00074", "73282932000074"),
+    ("73282932000074", "73282932000074"),
+    ("73282932000075", None),      # clé du SIRET fausse
+    ("73282932100074", None),      # clé du SIREN fausse
+    ("7328293200007", None),       # 13 chiffres
+    ("35600000000001", "35600000000001"),  # La Poste : somme des chiffres multiple de 5
+    ("35600000000002", None),
+    (None, None),
+])
+def test_normalize_siret(value, expected):
+    assert normalize_siret(value) == expected
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("FR 44 732829320", "FR44732829320"),
+    ("fr44732829320", "FR44732829320"),
+    ("FR45732829320", None),       # clé numérique fausse
+    ("FR44732829321", None),       # SIREN invalide
+    ("732829320", None),
+])
+def test_normalize_tva(value, expected):
+    assert normalize_tva(value) == expected
+
+
+def test_labelled_siret_in_text():
+    text = "CARREFOUR\nSIRET : 732 829 320 00074\nTOTAL 12,00"
+    assert receipt_identifiers({}, text) == {"siret": "73282932000074", "siren": "732829320"}
+
+
+def test_unlabelled_digits_are_not_a_siret():
+    # Numéro de téléphone, de carte ou de transaction de 14 chiffres sans libellé
+    assert receipt_identifiers({}, "CARREFOUR\nTEL 732 829 320 00074\nCB 73282932000074") == {}
+
+
+def test_labelled_siret_with_bad_checksum_is_ignored():
+    assert receipt_identifiers({}, "SIRET 732 829 320 00075") == {}
+
+
+def test_classified_fields_take_precedence_over_text():
+    identifiers = receipt_identifiers({"siret": "73282932000074", "tva_number": "FR44732829320"},
+                                      "SIRET 35600000000001")
+    assert identifiers == {"siret": "73282932000074", "tva": "FR44732829320", "siren": "732829320"}
+
+
+def test_siren_from_tva_only():
+    assert receipt_identifiers({"siret": "73282932000075", "tva_number": "FR44732829320"}) == \
+        {"tva": "FR44732829320", "siren": "732829320"}
@@ -0,0 +1,12 @@
+from vendor_templates import VendorTemplates
+
+
+def test_merge_stats_sums_worker_counters():
+    report = {"receipts": 10, "matched": 4, "learned": 3, "templates": 5, "usable_templates": 2, "matched_ratio": 0.4}
+    merged = VendorTemplates.merge_stats([report, dict(report, receipts=30, matched=16, templates=6)])
+    assert (merged["receipts"], merged["matched"], merged["learned"]) == (40, 20, 6)
+    # Modèles lus dans la même base : comptés une seule fois
+    assert (merged["templates"], merged["usable_templates"]) == (6, 2)
+    assert merged["matched_ratio"] == 0.5
+    assert merged["workers"] == 2
+    assert VendorTemplates.merge_stats([])["matched_ratio"] == 0.0
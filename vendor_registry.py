@@ -0,0 +1,261 @@
+import re
+import sqlite3
+import unicodedata
+import logging
+import threading
+
+# SIRET imprimé sur le ticket : libellé SIRET (ou SIRE) suivi de 14 chiffres, éventuellement groupés 3/3/3/5
+SIRET_PATTERN = re.compile(r'\bSIRE[TN]?\b[^\d\n]{0,15}(\d{3}\s?\d{3}\s?\d{3}\s?\d{5})\b', re.IGNORECASE)
+# Numéro de TVA intracommunautaire français : FR, clé à deux caractères, SIREN
+TVA_PATTERN = re.compile(r'\bFR\s?([0-9A-Z]{2})\s?(\d{3}\s?\d{3}\s?\d{3})\b', re.IGNORECASE)
+
+# SIREN de La Poste : ses SIRET suivent une clé propre (somme des chiffres multiple de 5)
+LA_POSTE_SIREN = "356000000"
+
+# Champs de points_vente repris pour compléter un ticket
+STORE_COLUMNS = ("magasin_id", "nom", "adresse", "code_postal", "ville", "telephone", "email")
+# Valeurs par défaut de find_or_create_store, à ne pas recopier sur un ticket
+PLACEHOLDERS = ("", "Adresse inconnue", "Magasin inconnu")
+# Mots d'en-tête communs à toutes les enseignes, qui ne servent pas à les reconnaître (sans accents)
+GENERIC_HEADER_TOKENS = {
+    "TICKET", "CAISSE", "CAISSIER", "CAISSIERE", "BIENVENUE", "BONJOUR", "MERCI", "VISITE", "CLIENT",
+    "FACTURE", "COPIE", "DUPLICATA", "VENTE", "MAGASIN", "TVA", "TTC", "EUR", "EUROS", "SIRET", "SIREN",
+    "SIRE", "NAF", "APE", "RCS", "CAPITAL", "SAS", "SARL", "TEL", "FAX", "RUE", "AVENUE", "BOULEVARD",
+    "PLACE", "ROUTE", "CEDEX", "FRANCE", "WWW", "COM", "DATE", "HEURE", "VENDEUR", "NUMERO", "VOTRE",
+    "VOUS", "NOUS", "LES", "DES", "POUR", "AVEC", "SUR", "PAR", "AUX", "ET", "OUVERT", "HORAIRES",
+    "LUNDI", "MARDI", "MERCREDI", "JEUDI", "VENDREDI", "SAMEDI", "DIMANCHE"
+}
+
+
+def generic_token(token):
+    """
+    :param token: Mot d'en-tête en majuscules
+    :return: True si le mot est commun à toutes les enseignes (comparaison sans accents)
+    """
+    return unicodedata.normalize("NFKD", token).encode("ascii", "ignore").decode() in GENERIC_HEADER_TOKENS
+
+
+def generic_vendor(name):
+    """
+    :param name: Enseigne lue sur le ticket
+    :return: True si aucun mot de trois lettres ou plus ne la distingue ('BIENVENUE', 'TICKET DE CAISSE')
+    """
+    return all(generic_token(token) for token in re.findall(r'[A-Za-zÀ-ÿ]{3,}', str(name or "").upper()))
+
+
+def luhn_valid(digits):
+    """
+    :param digits: Chaîne de chiffres (SIREN ou SIRET)
+    :return: True si la clé de Luhn est correcte
+    """
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit) * (2 if position % 2 else 1)
+        total += value - 9 if value > 9 else value
+    return total % 10 == 0
+
+
+def normalize_siret(value):
+    """
+    :param value: SIRET tel que lu ou classé ('552 018 020 00012')
+    :return: 14 chiffres, ou None si la valeur n'est pas un SIRET valide
+    """
+    digits = re.sub(r'\D', '', str(value or ""))
+    if len(digits) != 14 or not luhn_valid(digits[:9]):
+        return None
+    if digits.startswith(LA_POSTE_SIREN) and digits != LA_POSTE_SIREN + "00012":
+        return digits if sum(int(digit) for digit in digits) % 5 == 0 else None
+    return digits if luhn_valid(digits) else None
+
+
+def normalize_tva(value):
+    """
+    :param value: Numéro de TVA tel que lu ou classé ('FR 40 552018020')
+    :return: Numéro sans espaces en majuscules ('FR40552018020'), ou None si la clé ou le SIREN est invalide
+    """
+    match = TVA_PATTERN.search(str(value or "").upper())
+    if not match:
+        return None
+    key, siren = match.group(1).upper(), re.sub(r'[^0-9]', '', match.group(2))
+    if not luhn_valid(siren):
+        return None
+    # Clé numérique calculée sur le SIREN (les clés alphanumériques ne se vérifient pas)
+    if key.isdigit() and int(key) != (12 + 3 * (int(siren) % 97)) % 97:
+        return None
+    return f"FR{key}{siren}"
+
+
+def receipt_identifiers(receipt_data, text=None):
+    """
+    Identifiants d'entreprise d'un ticket : champs classés, sinon texte OCR
+
+    Dans le texte, seul un SIRET précédé de son libellé est retenu ; SIRET et
+    numéro de TVA doivent avoir des clés de contrôle correctes.
+
+    :param receipt_data: Données du ticket (siret, tva_number)
+    :param text: Texte OCR (optionnel)
+    :return: Dictionnaire {"siret", "tva", "siren"} des identifiants trouvés
+    """
+    siret = normalize_siret(receipt_data.get("siret"))
+    tva = normalize_tva(receipt_data.get("tva_number"))
+    if siret is None and text:
+        match = SIRET_PATTERN.search(text)
+        siret = normalize_siret(match.group(1)) if match else None
+    if tva is None and text:
+        tva = normalize_tva(text)
+
+    identifiers = {}
+    if siret:
+        identifiers["siret"] = siret
+    if tva:
+        identifiers["tva"] = tva
+    # Le SIREN (9 premiers chiffres du SIRET, ou fin du numéro de TVA) identifie l'entreprise
+    siren = siret[:9] if siret else (tva[4:] if tva else None)
+    if siren:
+        identifiers["siren"] = siren
+    return identifiers
+
+
+class VendorRegistry:
+    """
+    Registre des points de vente indexé par SIRET, SIREN et numéro de TVA.
+
+    La table identifiants_points_vente associe chaque identifiant normalisé à un
+    magasin de points_vente ; les correspondances déjà lues sont gardées en mémoire.
+    Le SIRET désigne un établissement ; le SIREN et la TVA désignent l'entreprise et
+    ne résolvent un magasin que si elle n'en a qu'un seul enregistré.
+    """
+    def __init__(self, db_path):
+        """
+        :param db_path: Chemin de la base de fidélité
+        """
+        self.db_path = str(db_path)
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._stores = None
+        self._stats = {"lookups": 0, "hits": 0}
+
+    def _create_table(self, cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS identifiants_points_vente (
+                type TEXT NOT NULL CHECK (type IN ('siret', 'siren', 'tva')),
+                identifiant TEXT NOT NULL,
+                magasin_id INTEGER NOT NULL,
+                PRIMARY KEY (type, identifiant, magasin_id),
+                FOREIGN KEY (magasin_id) REFERENCES points_vente(magasin_id)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_identifiants_magasin ON identifiants_points_vente(magasin_id)")
+
+    def _key(self, kind, value):
+        return f"{kind}:{value}"
+
+    def _load(self):
+        """Charge toutes les correspondances identifiant -> magasin"""
+        stores = {}
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            try:
+                self._create_table(conn.cursor())
+                conn.commit()
+                rows = conn.execute(f"""
+                    SELECT i.identifiant, i.type, {", ".join("p." + c for c in STORE_COLUMNS)}
+                    FROM identifiants_points_vente i
+                    JOIN points_vente p ON p.magasin_id = i.magasin_id
+                """).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            self.logger.error(f"Impossible de charger le registre des points de vente: {str(e)}")
+            return stores
+        for row in rows:
+            stores.setdefault(self._key(row["type"], row["identifiant"]), []).append(
+                {column: row[column] for column in STORE_COLUMNS})
+        self.logger.info(f"{len(rows)} identifiant(s) de points de vente chargé(s)")
+        return stores
+
+    def _stores_for(self, kind, value, cursor=None):
+        """Magasins associés à un identifiant : mémoire, sinon base (index de la clé primaire)"""
+        key = self._key(kind, value)
+        with self._lock:
+            if self._stores is None:
+                self._stores = self._load()
+            if key in self._stores:
+                return self._stores[key]
+        if cursor is None:
+            return []
+        # Magasin enregistré par un autre processus depuis le chargement
+        cursor.execute(f"""
+            SELECT {", ".join("p." + c for c in STORE_COLUMNS)}
+            FROM identifiants_points_vente i
+            JOIN points_vente p ON p.magasin_id = i.magasin_id
+            WHERE i.type = ? AND i.identifiant = ?
+        """, (kind, value))
+        stores = [{column: row[column] for column in STORE_COLUMNS} for row in cursor.fetchall()]
+        if stores:
+            with self._lock:
+                self._stores[key] = stores
+        return stores
+
+    def resolve(self, identifiers, cursor=None):
+        """
+        Magasin correspondant aux identifiants d'un ticket
+
+        :param identifiers: Résultat de receipt_identifiers()
+        :param cursor: Curseur de la connexion en cours (optionnel), pour les magasins
+                       absents de la mémoire
+        :return: Dictionnaire du magasin (magasin_id, nom, adresse, ...) ou None
+        """
+        with self._lock:
+            self._stats["lookups"] += 1
+        store = None
+        if "siret" in identifiers:
+            # Un SIRET inconnu désigne un nouvel établissement, même si l'entreprise est connue
+            stores = self._stores_for("siret", identifiers["siret"], cursor)
+            store = stores[0] if stores else None
+        for kind in ("tva", "siren"):
+            if store is None and "siret" not in identifiers and kind in identifiers:
+                stores = self._stores_for(kind, identifiers[kind], cursor)
+                # Entreprise à un seul magasin connu : pas d'ambiguïté
+                store = stores[0] if len(stores) == 1 else None
+        if store is not None:
+            with self._lock:
+                self._stats["hits"] += 1
+        return store
+
+    def register(self, store, identifiers, cursor):
+        """
+        Associe les identifiants d'un ticket à un magasin, dans la transaction en cours
+
+        :param store: Dictionnaire du magasin (au moins magasin_id)
+        :param identifiers: Résultat de receipt_identifiers()
+        :param cursor: Curseur de la connexion de DatabaseIntegrator
+        """
+        self._create_table(cursor)
+        # Plusieurs magasins d'une même entreprise partagent SIREN et TVA
+        cursor.executemany(
+            "INSERT OR IGNORE INTO identifiants_points_vente (type, identifiant, magasin_id) VALUES (?, ?, ?)",
+            [(kind, value, store["magasin_id"]) for kind, value in identifiers.items()]
+        )
+        with self._lock:
+            if self._stores is not None:
+                for kind, value in identifiers.items():
+                    stores = self._stores.setdefault(self._key(kind, value), [])
+                    if all(s["magasin_id"] != store["magasin_id"] for s in stores):
+                        stores.append(store)
+
+    def clear(self):
+        """Vide la mémoire (après l'annulation d'une transaction) ; elle sera rechargée au besoin"""
+        with self._lock:
+            self._stores = None
+
+    def stats(self):
+        """
+        :return: Dictionnaire (identifiants en mémoire, recherches, magasins trouvés)
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["identifiers"] = len(self._stores or {})
+        stats["hit_ratio"] = round(stats["hits"] / stats["lookups"], 3) if stats["lookups"] else 0.0
+        return stats
@@ -0,0 +1,388 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+from advanced_receipt_ocr import parse_line_items
+from ocr_rules import DATE_FORMATS
+from receipt_validator import check_arithmetic
+from vendor_registry import receipt_identifiers, generic_token
+
+DATE_TOKEN_PATTERN = re.compile(r'\b\d{1,4}[/.-]\d{1,2}[/.-]\d{2,4}\b')
+AMOUNT_PATTERN = re.compile(r'(\d+[.,]\d{2})')
+# Lignes d'en-tête dont les mots identifient l'enseigne
+HEADER_LINES = 5
+# Mots d'en-tête conservés par modèle
+MAX_HEADER_TOKENS = 50
+# Champs du magasin repris de la classification la plus fréquente
+STORE_FIELDS = ("store_address", "store_phone", "store_email", "store_website", "siret", "tva_number")
+
+
+def _label(line, amount_start):
+    """Libellé d'une ligne de montant : texte avant le montant, en majuscules sans ponctuation"""
+    return " ".join(re.sub(r'[^A-Za-zÀ-ÿ]+', ' ', line[:amount_start]).upper().split())
+
+
+def _header_tokens(lines):
+    """Mots d'au moins trois lettres des premières lignes du ticket, hors mots communs à toutes les enseignes"""
+    tokens = {token.upper() for line in lines[:HEADER_LINES] for token in re.findall(r'[A-Za-zÀ-ÿ]{3,}', line)}
+    return {token for token in tokens if not generic_token(token)}
+
+
+def _most_common(counter, default=None):
+    """Valeur la plus fréquente d'un compteur {valeur: nombre}"""
+    return max(counter.items(), key=lambda item: item[1])[0] if counter else default
+
+
+def _count(counter, value):
+    if value not in (None, ""):
+        counter[str(value)] = counter.get(str(value), 0) + 1
+
+
+def vendor_key(text, structured_data=None):
+    """
+    Clé d'un modèle d'enseigne : SIRET du ticket, sinon nom de l'enseigne normalisé
+
+    :param text: Texte OCR
+    :param structured_data: Données classées (optionnelles)
+    :return: 'siret:<14 chiffres>', 'nom:<NOM>' ou None
+    """
+    structured_data = structured_data or {}
+    siret = receipt_identifiers(structured_data, text).get("siret")
+    if siret:
+        return f"siret:{siret}"
+    vendor = str(structured_data.get("vendor") or "")
+    name = re.sub(r'[^A-Z]', '', vendor.upper())
+    return f"nom:{name}" if len(name) >= 3 and not vendor.startswith("Unknown") else None
+
+
+class VendorTemplates:
+    """
+    Modèles de mise en page par enseigne, appris sur les tickets déjà classés.
+
+    Pour chaque enseigne (SIRET, ou à défaut nom), le modèle compte les mots de
+    l'en-tête, le libellé de la ligne du total, le format de date, la ligne où
+    commencent les articles et les valeurs classées (enseigne, catégorie, moyen de
+    paiement, magasin).
+    Les compteurs sont stockés dans la table modeles_tickets de la base de fidélité
+    et complétés à chaque nouveau ticket classé par Mistral dont les montants concordent.
+
+    Un ticket d'une enseigne connue est ensuite extrait avec son modèle ; la
+    classification Mistral n'est sautée que si le score de correspondance atteint
+    le seuil et que les articles concordent avec le total.
+    """
+    def __init__(self, db_path, min_score=None, min_receipts=None, reload_seconds=300):
+        """
+        :param db_path: Chemin de la base de fidélité
+        :param min_score: Score minimal (0-1) pour extraire sans Mistral (variable TEMPLATE_MIN_SCORE, 0.8)
+        :param min_receipts: Nombre de tickets appris avant d'utiliser un modèle
+                             (variable TEMPLATE_MIN_RECEIPTS, 3)
+        :param reload_seconds: Intervalle de relecture des modèles appris par les autres processus
+        """
+        self.db_path = str(db_path)
+        if min_score is None:
+            min_score = float(os.getenv("TEMPLATE_MIN_SCORE", "0.8"))
+        if min_receipts is None:
+            min_receipts = int(os.getenv("TEMPLATE_MIN_RECEIPTS", "3"))
+        self.min_score = min_score
+        self.min_receipts = min_receipts
+        self.reload_seconds = reload_seconds
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._templates = None
+        self._loaded_at = 0.0
+        self._stats = {"receipts": 0, "matched": 0, "learned": 0}
+        self._create_table()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _create_table(self):
+        """Crée la table des modèles si elle n'existe pas"""
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS modeles_tickets (
+                    modele_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    cle TEXT NOT NULL UNIQUE,
+                    enseigne TEXT,
+                    nb_tickets INTEGER NOT NULL DEFAULT 0,
+                    modele TEXT NOT NULL,
+                    date_maj TIMESTAMP
+                )
+            """)
+        except sqlite3.Error as e:
+            self.logger.error(f"Impossible de créer la table modeles_tickets: {str(e)}")
+        finally:
+            conn.close()
+
+    def templates(self):
+        """
+        Modèles en mémoire, relus périodiquement
+
+        :return: Dictionnaire {clé: modèle}
+        """
+        with self._lock:
+            if self._templates is None or time.monotonic() - self._loaded_at > self.reload_seconds:
+                self._templates = self._load()
+                self._loaded_at = time.monotonic()
+            return self._templates
+
+    def reload(self):
+        """Relit les modèles de la base"""
+        with self._lock:
+            self._templates = self._load()
+            self._loaded_at = time.monotonic()
+
+    def _load(self):
+        try:
+            conn = self._connect()
+            try:
+                rows = conn.execute("SELECT cle, nb_tickets, modele FROM modeles_tickets").fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            self.logger.error(f"Impossible de charger les modèles d'enseignes: {str(e)}")
+            return {}
+        templates = {}
+        for row in rows:
+            try:
+                templates[row["cle"]] = dict(json.loads(row["modele"]), receipts=row["nb_tickets"])
+            except ValueError:
+                self.logger.warning(f"Modèle d'enseigne illisible ignoré: {row['cle']}")
+        return templates
+
+    def _observe(self, lines, structured_data):
+        """
+        Positions et motifs relevés sur un ticket classé
+
+        :return: Dictionnaire (total_label, date_format, item_start, header_tokens)
+        """
+        observation = {"header_tokens": _header_tokens(lines)}
+        total = float(structured_data.get("total") or 0)
+        total_index = len(lines)
+        # Dernière ligne portant le montant total, de préférence libellée TOTAL (et non le paiement CB)
+        candidates = []
+        for index, line in enumerate(lines):
+            match = next((m for m in AMOUNT_PATTERN.finditer(line)
+                          if abs(float(m.group(1).replace(',', '.')) - total) < 0.005), None)
+            if match and _label(line, match.start()):
+                candidates.append((index, _label(line, match.start())))
+        if candidates:
+            total_index, label = max(candidates, key=lambda c: ("TOTAL" in c[1], c[0]))
+            observation["total_label"] = label
+
+        date = str(structured_data.get("date") or "")
+        for token in DATE_TOKEN_PATTERN.findall("\n".join(lines)):
+            fmt = next((f for f in DATE_FORMATS if self._parse_date(token, f) == date), None)
+            if fmt:
+                observation["date_format"] = fmt
+                break
+
+        observation["item_start"] = next(
+            (index for index in range(1, total_index) if parse_line_items([lines[index]])), None)
+        return observation
+
+    @staticmethod
+    def _parse_date(token, fmt):
+        try:
+            return datetime.strptime(token, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            return None
+
+    def learn(self, text, structured_data):
+        """
+        Complète le modèle de l'enseigne avec un ticket classé par Mistral
+
+        :param text: Texte OCR
+        :param structured_data: Données classées
+        :return: True si le ticket a été appris
+        """
+        key = vendor_key(text, structured_data)
+        lines = [line.strip() for line in (text or "").splitlines() if line.strip()]
+        if key is None or not lines:
+            return False
+        # Seuls les tickets dont les montants concordent servent de modèle
+        if not check_arithmetic(structured_data.get("line_items"), structured_data.get("total"))["consistent"]:
+            return False
+        observation = self._observe(lines, structured_data)
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT nb_tickets, modele FROM modeles_tickets WHERE cle = ?", (key,)).fetchone()
+            template = json.loads(row["modele"]) if row else {
+                "vendor": {}, "category": {}, "payment_method": {}, "store": {field: {} for field in STORE_FIELDS},
+                "header_tokens": {}, "total_labels": {}, "date_formats": {}, "item_start": {}
+            }
+            receipts = (row["nb_tickets"] if row else 0) + 1
+            _count(template["vendor"], structured_data.get("vendor"))
+            _count(template["category"], structured_data.get("category"))
+            if structured_data.get("payment_method") != "Unknown":
+                _count(template.setdefault("payment_method", {}), structured_data.get("payment_method"))
+            for field in STORE_FIELDS:
+                _count(template["store"][field], structured_data.get(field))
+            for token in observation["header_tokens"]:
+                _count(template["header_tokens"], token)
+            template["header_tokens"] = dict(sorted(template["header_tokens"].items(),
+                                                    key=lambda item: -item[1])[:MAX_HEADER_TOKENS])
+            _count(template["total_labels"], observation.get("total_label"))
+            _count(template["date_formats"], observation.get("date_format"))
+            _count(template["item_start"], observation.get("item_start"))
+            conn.execute(
+                """INSERT INTO modeles_tickets (cle, enseigne, nb_tickets, modele, date_maj)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(cle) DO UPDATE SET enseigne = excluded.enseigne, nb_tickets = excluded.nb_tickets,
+                                                  modele = excluded.modele, date_maj = excluded.date_maj""",
+                (key, _most_common(template["vendor"]), receipts, json.dumps(template),
+                 datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            self.logger.error(f"Impossible d'enregistrer le modèle {key}: {str(e)}")
+            return False
+        finally:
+            conn.close()
+
+        with self._lock:
+            if self._templates is not None:
+                self._templates[key] = dict(template, receipts=receipts)
+            self._stats["learned"] += 1
+        return True
+
+    def _identity(self, key, tokens, template):
+        """
+        Part des mots d'en-tête habituels de l'enseigne retrouvés sur le ticket
+
+        1 si le ticket porte le SIRET du modèle, 0 s'il porte un autre SIRET que celui
+        appris pour l'enseigne (autre magasin, même en-tête générique).
+        """
+        siret = key[len("siret:"):] if key is not None and key.startswith("siret:") else None
+        template_siret = template["key"][len("siret:"):] if template["key"].startswith("siret:") \
+            else _most_common(template["store"].get("siret", {}))
+        if siret and template_siret:
+            return 1.0 if re.sub(r'\D', '', template_siret) == siret else 0.0
+        usual = {token for token, count in template["header_tokens"].items()
+                 if count >= template["receipts"] / 2 and not generic_token(token)}
+        return len(usual & tokens) / len(usual) if usual else 0.0
+
+    def match(self, text):
+        """
+        Modèle de l'enseigne la plus proche d'un ticket
+
+        :param text: Texte OCR
+        :return: Tuple (modèle ou None, score d'identification entre 0 et 1)
+        """
+        lines = [line.strip() for line in (text or "").splitlines() if line.strip()]
+        key = vendor_key(text)
+        tokens = _header_tokens(lines)
+        best, best_identity = None, 0.0
+        for template_key, template in self.templates().items():
+            if template["receipts"] < self.min_receipts:
+                continue
+            identity = self._identity(key, tokens, dict(template, key=template_key))
+            if identity > best_identity:
+                best, best_identity = dict(template, key=template_key), identity
+        return best, best_identity
+
+    def extract(self, text):
+        """
+        Extraction d'un ticket avec le modèle de son enseigne
+
+        :param text: Texte OCR
+        :return: Dictionnaire (key, identity, score, complete, data, arithmetic) ou None sans modèle proche
+        """
+        with self._lock:
+            self._stats["receipts"] += 1
+        template, identity = self.match(text)
+        if template is None:
+            return None
+        lines = [line.strip() for line in (text or "").splitlines() if line.strip()]
+
+        total, total_index = 0.0, len(lines)
+        labels = sorted(template["total_labels"], key=lambda label: -template["total_labels"][label])
+        for index in range(len(lines) - 1, -1, -1):
+            amounts = list(AMOUNT_PATTERN.finditer(lines[index]))
+            if amounts and _label(lines[index], amounts[-1].start()) in labels:
+                total, total_index = float(amounts[-1].group(1).replace(',', '.')), index
+                break
+
+        date = None
+        for fmt in sorted(template["date_formats"], key=lambda f: -template["date_formats"][f]):
+            date = next((d for d in (self._parse_date(t, fmt) for t in DATE_TOKEN_PATTERN.findall(text)) if d), None)
+            if date:
+                break
+
+        item_start = int(_most_common(template["item_start"], 1))
+        line_items = parse_line_items(lines[item_start:total_index])
+        arithmetic = check_arithmetic(line_items, total)
+
+        found = sum(1 for value in (total, date, line_items) if value)
+        score = identity * found / 3 * (1.0 if arithmetic["consistent"] else 0.5)
+        data = {
+            "vendor": _most_common(template["vendor"], "Unknown"),
+            "date": date or "Unknown",
+            "total": total,
+            "line_items": line_items,
+            "category": _most_common(template["category"], "Uncategorized"),
+            "payment_method": _most_common(template.get("payment_method", {}), "Unknown")
+        }
+        for field in STORE_FIELDS:
+            value = _most_common(template["store"].get(field, {}))
+            if value:
+                data[field] = value
+
+        complete = score >= self.min_score and arithmetic["consistent"]
+        if complete:
+            with self._lock:
+                self._stats["matched"] += 1
+        return {
+            "key": template["key"],
+            "receipts": template["receipts"],
+            "identity": round(identity, 3),
+            "score": round(score, 3),
+            "complete": complete,
+            "data": data,
+            "arithmetic": arithmetic
+        }
+
+    def stats(self):
+        """
+        :return: Dictionnaire (modèles, tickets analysés, extraits par modèle, appris)
+        """
+        templates = self.templates()
+        with self._lock:
+            stats = dict(self._stats)
+        stats["templates"] = len(templates)
+        stats["usable_templates"] = sum(1 for t in templates.values() if t["receipts"] >= self.min_receipts)
+        stats["matched_ratio"] = round(stats["matched"] / stats["receipts"], 3) if stats["receipts"] else 0.0
+        return stats
+
+    @staticmethod
+    def merge_stats(reports):
+        """
+        Cumule les indicateurs stats() publiés par plusieurs processus worker
+
+        :param reports: Liste de dictionnaires renvoyés par stats()
+        :return: Dictionnaire au format de stats(), avec le nombre de processus
+        """
+        receipts = sum(report.get("receipts", 0) for report in reports)
+        matched = sum(report.get("matched", 0) for report in reports)
+        return {
+            "receipts": receipts,
+            "matched": matched,
+            "learned": sum(report.get("learned", 0) for report in reports),
+            # Modèles partagés par la base : chaque processus les compte tous
+            "templates": max((report.get("templates", 0) for report in reports), default=0),
+            "usable_templates": max((report.get("usable_templates", 0) for report in reports), default=0),
+            "matched_ratio": round(matched / receipts, 3) if receipts else 0.0,
+            "workers": len(reports)
+        }
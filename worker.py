@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Worker de traitement des tickets.
+
+Récupère les jobs déposés par /upload dans la file SQLite (job_queue.py) et
+exécute le pipeline complet (OCR, Mistral, GCS, base de fidélité).
+
+Exemples :
+    python worker.py                  # un worker
+    python worker.py --processes 4    # quatre processus sur cette machine
+
+Plusieurs machines peuvent lancer des workers sur la même file tant qu'elles
+partagent le fichier de la file et le dossier d'upload.
+"""
+
+import os
+import sys
+import time
+import socket
+import signal
+import logging
+import argparse
+import threading
+import traceback
+import multiprocessing
+from pathlib import Path
+from dotenv import load_dotenv
+
+from job_queue import JobQueue
+from executors import pool_stats
+
+BASE_DIR = Path(__file__).parent
+DEFAULT_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", str(BASE_DIR / 'job_queue.sqlite'))
+# Nombre maximal de tickets d'un même lot réservés ensemble par un worker
+BATCH_CLAIM_LIMIT = int(os.getenv("BATCH_CLAIM_LIMIT", "50"))
+# Intervalle en secondes entre deux publications des indicateurs du processus dans la file
+STATS_INTERVAL = float(os.getenv("WORKER_STATS_INTERVAL", "10"))
+
+
+def build_pipeline(queue=None):
+    """
+    Construit un pipeline avec ses propres processeurs (un par processus worker)
+
+    :param queue: Instance de JobQueue dont la profondeur pilote le mode dégradé (optionnelle)
+    :return: Instance de ReceiptPipeline
+    """
+    from receipt_utils import ReceiptProcessor
+    from advanced_receipt_ocr import SimplifiedReceiptProcessor
+    from db_integrator import DatabaseIntegrator
+    from gcp_storage import GCPStorageManager
+    from receipt_pipeline import ReceiptPipeline
+    from result_cache import ResultCache
+    from degradation import DegradationPolicy
+    from ocr_pool import pool_from_env
+    from ocr_rules import RuleEngine
+    from receipt_validator import LLMGate
+    from vendor_templates import VendorTemplates
+
+    load_dotenv()
+    storage_manager = GCPStorageManager(
+        bucket_name=os.getenv("GCP_BUCKET_NAME", "teasy_bucket"),
+        credentials_path=os.getenv("GCP_CREDENTIALS_PATH", str(BASE_DIR / "hackathon-ocr-2025-dbp-client.json")),
+        use_local_fallback=False
+    )
+    ocr_processor = SimplifiedReceiptProcessor()
+    return ReceiptPipeline(
+        veryfi_processor=ReceiptProcessor(),
+        ocr_processor=ocr_processor,
+        storage_manager=storage_manager,
+        db_integrator=DatabaseIntegrator(str(BASE_DIR / 'fidelity_db.sqlite')),
+        data_dir=BASE_DIR / 'data',
+        result_cache=ResultCache() if os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true" else None,
+        degradation=(DegradationPolicy(backlog_fn=queue.backlog if queue else None)
+                     if os.getenv("DEGRADATION_ENABLED", "true").lower() == "true" else None),
+        tesseract_pool=pool_from_env(),
+        rule_engine=(RuleEngine(BASE_DIR / 'fidelity_db.sqlite')
+                     if os.getenv("RULES_ENABLED", "true").lower() == "true" else None),
+        llm_gate=(LLMGate(ocr_processor.parse_receipt_text)
+                  if os.getenv("LLM_GATE_ENABLED", "true").lower() == "true" else None),
+        vendor_templates=(VendorTemplates(BASE_DIR / 'fidelity_db.sqlite')
+                          if os.getenv("VENDOR_TEMPLATES_ENABLED", "true").lower() == "true" else None)
+    )
+
+
+def collect_stats(pipeline):
+    """
+    Indicateurs du processus publiés dans la file, lus par /metrics et le contrôle d'admission
+
+    :param pipeline: Instance de ReceiptPipeline du processus
+    :return: Dictionnaire d'indicateurs
+    """
+    stats = {"pools": pool_stats(), "llm_connections": pipeline.ocr_processor.llm_service.connection_stats()}
+    if pipeline.rule_engine:
+        stats["rules"] = pipeline.rule_engine.stats()
+    if pipeline.llm_gate:
+        stats["llm_gate"] = pipeline.llm_gate.stats()
+    if pipeline.degradation:
+        stats["degradation"] = pipeline.degradation.stats()
+    if pipeline.vendor_templates:
+        stats["vendor_templates"] = pipeline.vendor_templates.stats()
+    return stats
+
+
+def start_stats_reporter(queue, pipeline, stop_event, interval=STATS_INTERVAL):
+    """
+    Démarre un thread daemon qui publie périodiquement les indicateurs du processus
+    dans la file (un enregistrement par processus, même avec plusieurs threads worker)
+
+    :param queue: Instance de JobQueue
+    :param pipeline: Instance de ReceiptPipeline du processus
+    :param stop_event: threading.Event ou multiprocessing.Event signalant l'arrêt
+    :param interval: Secondes entre deux publications
+    :return: Thread démarré
+    """
+    logger = logging.getLogger(__name__)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def report():
+        while not stop_event.is_set():
+            try:
+                queue.report_worker_stats(worker_id, collect_stats(pipeline))
+            except Exception as e:
+                logger.error(f"Impossible de publier les indicateurs du worker {worker_id}: {str(e)}")
+            stop_event.wait(interval)
+
+    thread = threading.Thread(target=report, name="worker-stats", daemon=True)
+    thread.start()
+    return thread
+
+
+def run_job(queue, pipeline, job):
+    """
+    Exécute un job réservé et enregistre son résultat dans la file
+
+    :param queue: Instance de JobQueue
+    :param pipeline: Instance de ReceiptPipeline
+    :param job: Dictionnaire du job réservé
+    """
+    logger = logging.getLogger(__name__)
+    job_id = job['job_id']
+    logger.info(f"Traitement du job {job_id} (tentative {job['attempts']})")
+
+    def on_stage(stage, status, duration_ms, detail):
+        queue.record_stage(job_id, stage, status, duration_ms, detail)
+
+    try:
+        result = pipeline.process(job['filepath'] or None, job['filename'], job['client_id'], on_stage=on_stage,
+                                  image_bytes=job.get('payload'))
+        queue.complete(job_id, result)
+        logger.info(f"Job {job_id} terminé: {result.get('receipt_id')}")
+    except Exception as e:
+        logger.error(f"Échec du job {job_id}: {str(e)}")
+        logger.debug(traceback.format_exc())
+        queue.fail(job_id, str(e))
+
+
+def run_batch(queue, pipeline, jobs):
+    """
+    Exécute les jobs réservés d'un même lot : traitement parallèle puis
+    intégration fidélité en une seule transaction
+
+    :param queue: Instance de JobQueue
+    :param pipeline: Instance de ReceiptPipeline
+    :param jobs: Liste des jobs réservés du lot
+    """
+    logger = logging.getLogger(__name__)
+    job_ids = [job['job_id'] for job in jobs]
+    logger.info(f"Traitement du lot {jobs[0]['batch_id']} ({len(jobs)} job(s))")
+
+    def make_on_stage(job_id):
+        def on_stage(stage, status, duration_ms, detail):
+            queue.record_stage(job_id, stage, status, duration_ms, detail)
+            # Les jobs encore en attente dans le pool gardent leur réservation
+            queue.heartbeat(job_ids)
+        return on_stage
+
+    items = [
+        {
+            'filepath': job['filepath'] or None,
+            'filename': job['filename'],
+            'client_id': job['client_id'],
+            'on_stage': make_on_stage(job['job_id']),
+            'image_bytes': job.get('payload')
+        }
+        for job in jobs
+    ]
+    try:
+        results = pipeline.process_batch(items)
+    except Exception as e:
+        logger.error(f"Échec du lot {jobs[0]['batch_id']}: {str(e)}")
+        logger.debug(traceback.format_exc())
+        results = [e] * len(jobs)
+
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            queue.fail(job['job_id'], str(result))
+        else:
+            queue.complete(job['job_id'], result)
+            logger.info(f"Job {job['job_id']} terminé: {result.get('receipt_id')}")
+
+
+def run_worker(queue, pipeline, stop_event, poll_interval=1.0, lease_seconds=600):
+    """
+    Boucle principale d'un worker : réserve et traite les jobs jusqu'à l'arrêt
+
+    :param queue: Instance de JobQueue
+    :param pipeline: Instance de ReceiptPipeline
+    :param stop_event: threading.Event ou multiprocessing.Event signalant l'arrêt
+    :param poll_interval: Attente en secondes quand la file est vide
+    :param lease_seconds: Délai sans heartbeat avant de reprendre un job abandonné
+    """
+    logger = logging.getLogger(__name__)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    logger.info(f"Worker {worker_id} démarré sur {queue.db_path}")
+
+    last_requeue = 0
+    while not stop_event.is_set():
+        try:
+            # Reprendre périodiquement les jobs des workers disparus
+            if time.monotonic() - last_requeue > 60:
+                queue.requeue_stale(lease_seconds)
+                last_requeue = time.monotonic()
+
+            jobs = queue.claim_batch(worker_id, BATCH_CLAIM_LIMIT)
+            if not jobs:
+                stop_event.wait(poll_interval)
+                continue
+
+            if len(jobs) == 1:
+                run_job(queue, pipeline, jobs[0])
+            else:
+                run_batch(queue, pipeline, jobs)
+        except Exception as e:
+            logger.error(f"Erreur dans la boucle du worker {worker_id}: {str(e)}")
+            stop_event.wait(poll_interval)
+
+    logger.info(f"Worker {worker_id} arrêté")
+
+
+def start_worker_threads(queue, pipeline, count, poll_interval=1.0):
+    """
+    Démarre des workers dans le processus courant (threads daemon)
+
+    Pratique en développement : l'application Flask traite elle-même sa file
+    sans lancer worker.py séparément.
+
+    :param queue: Instance de JobQueue
+    :param pipeline: Instance de ReceiptPipeline partagée par les threads
+    :param count: Nombre de threads
+    :param poll_interval: Attente en secondes quand la file est vide
+    :return: Event permettant d'arrêter les threads
+    """
+    stop_event = threading.Event()
+    start_stats_reporter(queue, pipeline, stop_event)
+    for i in range(count):
+        thread = threading.Thread(
+            target=run_worker,
+            args=(queue, pipeline, stop_event, poll_interval),
+            name=f"receipt-worker-{i}",
+            daemon=True
+        )
+        thread.start()
+    return stop_event
+
+
+def _process_main(queue_path, poll_interval, stop_event):
+    """Point d'entrée d'un processus worker"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(processName)s - %(message)s')
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    queue = JobQueue(queue_path)
+    pipeline = build_pipeline(queue)
+    start_stats_reporter(queue, pipeline, stop_event)
+    run_worker(queue, pipeline, stop_event, poll_interval)
+
+
+def main():
+    """Lance un ou plusieurs processus worker"""
+    parser = argparse.ArgumentParser(description="Worker de traitement des tickets")
+    parser.add_argument('--processes', type=int, default=int(os.getenv("WORKER_PROCESSES", "1")),
+                        help="Nombre de processus worker à lancer")
+    parser.add_argument('--queue', default=DEFAULT_QUEUE_PATH, help="Chemin du fichier SQLite de la file")
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help="Attente en secondes quand la file est vide")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(processName)s - %(message)s')
+    stop_event = multiprocessing.Event()
+
+    def shutdown(signum, frame):
+        logging.info("Arrêt demandé, fin des jobs en cours...")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    processes = []
+    for i in range(max(1, args.processes)):
+        process = multiprocessing.Process(
+            target=_process_main,
+            args=(args.queue, args.poll_interval, stop_event),
+            name=f"receipt-worker-{i}"
+        )
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())